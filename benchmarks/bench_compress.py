@@ -0,0 +1,118 @@
+"""Throughput and ratio of the build-tar compression modes.
+
+Builds an uncompressed tar in memory, either of a directory given on the
+command line or of generated source-like files, and compresses it with
+single-threaded ``tarfile`` compression (``w:gz`` and ``w:xz``) and with
+``compressed_writer`` at a few worker counts. Throughput is uncompressed
+MB per second, ratio is compressed size over uncompressed size.
+
+    python benchmarks/bench_compress.py [directory] [level]
+"""
+
+import io
+import os
+from pathlib import Path
+import random
+import sys
+import tarfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from rebuildr.compress import (  # noqa: E402
+    COMPRESS_GZIP,
+    COMPRESS_XZ,
+    CompressOptions,
+    compressed_writer,
+)
+
+GENERATED_FILES = 2000
+GENERATED_FILE_SIZE = 16 << 10
+
+
+def _generated_files() -> list[tuple[str, bytes]]:
+    rng = random.Random(0)
+    words = [
+        w.encode() for w in "def class return import self value for in if else".split()
+    ]
+    files = []
+    for i in range(GENERATED_FILES):
+        lines = []
+        size = 0
+        while size < GENERATED_FILE_SIZE:
+            line = (
+                b"    " * rng.randrange(4)
+                + b" ".join(rng.choice(words) for _ in range(rng.randrange(2, 10)))
+                + f" {rng.randrange(1000)}\n".encode()
+            )
+            lines.append(line)
+            size += len(line)
+        files.append((f"pkg{i % 50}/module_{i}.py", b"".join(lines)))
+    return files
+
+
+def _directory_files(root: Path) -> list[tuple[str, bytes]]:
+    files = []
+    for dirpath, _, names in os.walk(root):
+        for name in sorted(names):
+            path = Path(dirpath) / name
+            if path.is_file() and not path.is_symlink():
+                files.append((path.relative_to(root).as_posix(), path.read_bytes()))
+    return files
+
+
+def _tar(files: list[tuple[str, bytes]], mode: str, out, **kwargs) -> None:
+    with tarfile.open(fileobj=out, mode=mode, **kwargs) as tar:
+        for name, content in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+
+def _timed(compress) -> tuple[float, int]:
+    out = io.BytesIO()
+    started = time.perf_counter()
+    compress(out)
+    return time.perf_counter() - started, len(out.getvalue())
+
+
+def main():
+    root = Path(sys.argv[1]) if len(sys.argv) > 1 else None
+    level = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    files = _directory_files(root) if root else _generated_files()
+    plain = io.BytesIO()
+    _tar(files, "w:", plain)
+    data = plain.getvalue()
+    mb = len(data) / 1e6
+
+    def tarfile_mode(mode: str, **kwargs):
+        return lambda out: _tar(files, mode, out, **kwargs)
+
+    def writer(compression: str, workers: int):
+        def compress(out):
+            options = CompressOptions(compression, level, workers)
+            with compressed_writer(out, options) as writer:
+                writer.write(data)
+
+        return compress
+
+    cpus = os.cpu_count() or 1
+    runs = [
+        ("tarfile w:gz", tarfile_mode("w:gz", compresslevel=level)),
+        *[
+            (f"parallel gzip x{workers}", writer(COMPRESS_GZIP, workers))
+            for workers in sorted({1, 2, 4, cpus})
+        ],
+        ("tarfile w:xz", tarfile_mode("w:xz", preset=level)),
+        ("xz", writer(COMPRESS_XZ, 1)),
+    ]
+
+    print(f"{mb:.1f} MB uncompressed tar, level {level}")
+    print(f"{'mode':>20} {'MB/s':>8} {'ratio':>7}")
+    for name, compress in runs:
+        seconds, size = _timed(compress)
+        print(f"{name:>20} {mb / seconds:>8.1f} {size / len(data):>7.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Content id throughput of each hash algorithm on typical input trees.
+
+Generates a few tree shapes in a temporary directory and computes their
+content id with every algorithm in ``HASH_ALGORITHMS``, with the digest
+cache disabled and the files already in the page cache, so the numbers
+reflect hashing cost only.
+
+    python benchmarks/bench_hash_algorithms.py [repeats]
+"""
+
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from rebuildr.descriptor import Descriptor, GlobInput, Inputs  # noqa: E402
+from rebuildr.hashing import HASH_ALGORITHMS  # noqa: E402
+from rebuildr.stable_descriptor import (  # noqa: E402
+    CONTENT_ID_SCHEMES,
+    HashOptions,
+    StableDescriptor,
+    StableEnvironment,
+)
+
+# name -> list of (number of files, size of each file in bytes)
+TREE_SHAPES = {
+    "source tree (5000 x 4 KiB)": [(5000, 4 << 10)],
+    "mixed (2000 x 16 KiB, 50 x 2 MiB)": [(2000, 16 << 10), (50, 2 << 20)],
+    "artifacts (4 x 128 MiB)": [(4, 128 << 20)],
+}
+
+
+def _make_tree(root: Path, shape: list[tuple[int, int]]) -> int:
+    total = 0
+    for group, (count, size) in enumerate(shape):
+        for index in range(count):
+            directory = root / f"g{group}" / f"d{index % 50}"
+            directory.mkdir(parents=True, exist_ok=True)
+            (directory / f"f{index}.bin").write_bytes(os.urandom(size))
+            total += size
+    return total
+
+
+def _content_id_seconds(root: Path, scheme: str, algorithm: str) -> float:
+    desc = StableDescriptor.from_descriptor(
+        Descriptor(inputs=Inputs(files=[GlobInput(pattern="**/*")])),
+        root,
+        HashOptions(digest_cache=False, scheme=scheme, algorithm=algorithm),
+    )
+    started = time.perf_counter()
+    desc.content_id(StableEnvironment({}, {}))
+    return time.perf_counter() - started
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    print(f"{'tree':<36} {'scheme':>6} {'algorithm':>9} {'seconds':>8} {'MB/s':>8}")
+    for name, shape in TREE_SHAPES.items():
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            total = _make_tree(root, shape)
+            # warm the page cache
+            _content_id_seconds(root, CONTENT_ID_SCHEMES[0], HASH_ALGORITHMS[0])
+            for scheme in CONTENT_ID_SCHEMES:
+                for algorithm in HASH_ALGORITHMS:
+                    seconds = min(
+                        _content_id_seconds(root, scheme, algorithm)
+                        for _ in range(repeats)
+                    )
+                    print(
+                        f"{name:<36} {scheme:>6} {algorithm:>9} {seconds:>8.3f} {total / seconds / 1e6:>8.1f}"
+                    )
+
+
+if __name__ == "__main__":
+    main()
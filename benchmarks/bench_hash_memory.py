@@ -0,0 +1,70 @@
+"""Peak memory of hashing a single input file as its size grows.
+
+Compares reading the whole file into one ``bytes`` object (the previous
+behaviour) with ``StableFileInput.hash_update``, which streams the file
+through a fixed buffer. Each measurement runs in a fresh subprocess and
+reports its peak RSS.
+
+    python benchmarks/bench_hash_memory.py [size-in-MB ...]
+"""
+
+import hashlib
+import os
+from pathlib import Path, PurePath
+import resource
+import subprocess
+import sys
+import tempfile
+
+SIZES_MB = [16, 64, 256, 1024]
+
+
+def _measure(mode: str, path: str):
+    if mode == "read":
+        with open(path, "rb") as f:
+            hashlib.sha256(f.read()).hexdigest()
+    else:
+        from rebuildr.stable_descriptor import StableFileInput
+
+        StableFileInput(
+            target_path=PurePath("input.bin"), absolute_src_path=Path(path)
+        ).hash_update(hashlib.sha256())
+
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        maxrss //= 1024
+    print(maxrss // 1024)
+
+
+def _run(mode: str, path: str) -> int:
+    repo_root = Path(__file__).resolve().parent.parent
+    result = subprocess.run(
+        [sys.executable, __file__, "--measure", mode, path],
+        check=True,
+        capture_output=True,
+        text=True,
+        env={**os.environ, "PYTHONPATH": str(repo_root)},
+    )
+    return int(result.stdout.strip())
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--measure":
+        _measure(sys.argv[2], sys.argv[3])
+        return
+
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES_MB
+    print(f"{'size MB':>8} {'read() RSS MB':>14} {'streamed RSS MB':>16}")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "input.bin")
+        for size_mb in sizes:
+            with open(path, "wb") as f:
+                chunk = os.urandom(1 << 20)
+                for _ in range(size_mb):
+                    f.write(chunk)
+            print(f"{size_mb:>8} {_run('read', path):>14} {_run('stream', path):>16}")
+
+
+if __name__ == "__main__":
+    main()
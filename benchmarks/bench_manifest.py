@@ -0,0 +1,78 @@
+"""Memory and lookup time of the file input manifest as the file count grows.
+
+Compares a plain list of ``StableFileInput`` objects (the previous
+representation) with ``FileManifest``. Memory is the traced allocation of
+building each structure, divided by the number of entries; lookups find
+every 100th target path, by a linear scan in the list and through the
+index in the manifest.
+
+    python benchmarks/bench_manifest.py [file-count ...]
+"""
+
+from pathlib import Path, PurePath
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from rebuildr.stable_descriptor import FileManifest, StableFileInput  # noqa: E402
+
+COUNTS = [10_000, 100_000, 300_000]
+
+
+def _deps(count: int) -> list[StableFileInput]:
+    root = Path("/home/user/src/monorepo")
+    deps = []
+    for i in range(count):
+        target = PurePath(f"services/svc{i % 97}/pkg{i % 13}/module_{i}.py")
+        deps.append(
+            StableFileInput(target_path=target, absolute_src_path=root / target)
+        )
+    return deps
+
+
+def _traced(build):
+    tracemalloc.start()
+    value = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return value, size
+
+
+def _scan(deps: list[StableFileInput], path: PurePath):
+    for dep in deps:
+        if dep.target_path == path:
+            return dep
+    return None
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or COUNTS
+    print(
+        f"{'files':>8} {'list B/entry':>13} {'manifest B/entry':>17}"
+        f" {'scan us/lookup':>15} {'index us/lookup':>16}"
+    )
+    for count in counts:
+        deps, list_size = _traced(lambda: _deps(count))
+        manifest, manifest_size = _traced(lambda: FileManifest(_deps(count)))
+        queries = [deps[i].target_path for i in range(0, count, 100)]
+
+        started = time.perf_counter()
+        for path in queries:
+            _scan(deps, path)
+        scan_us = (time.perf_counter() - started) / len(queries) * 1e6
+
+        started = time.perf_counter()
+        for path in queries:
+            manifest.find(path)
+        index_us = (time.perf_counter() - started) / len(queries) * 1e6
+
+        print(
+            f"{count:>8} {list_size // count:>13} {manifest_size // count:>17}"
+            f" {scan_us:>15.1f} {index_us:>16.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
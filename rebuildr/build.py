@@ -4,6 +4,8 @@ from pathlib import Path
 import subprocess
 import sys
 import tempfile
+import threading
+from typing import BinaryIO, Callable, Optional
 
 from rebuildr.containers.docker import docker_bin
 
@@ -50,8 +52,17 @@ class DockerCLIBuilder(object):
         build_context=None,
         do_load=False,
         build_and_push=False,
+        context_writer: Optional[Callable[[BinaryIO], None]] = None,
     ):
-        if dockerfile:
+        """Run ``docker buildx build`` on ``root_dir``.
+
+        With ``context_writer`` the context is not read from ``root_dir`` but
+        written by ``context_writer`` as a tar to buildx's stdin while the
+        build runs, and ``dockerfile`` is a path inside that tar.
+        """
+        if context_writer is not None:
+            dockerfile = dockerfile or "Dockerfile"
+        elif dockerfile:
             if not dockerfile.is_absolute():
                 dockerfile = root_dir / dockerfile
         else:
@@ -83,14 +94,24 @@ class DockerCLIBuilder(object):
             command_builder.add_arg("--build-context", context)
         if build_and_push:
             command_builder.add_flag("--push", True)
-        args = command_builder.build([root_dir])
+        args = command_builder.build(["-" if context_writer else root_dir])
 
         subprocess.run([docker_bin(), "buildx", "ls"], check=True)
         subprocess.run("export", check=True, shell=True)
 
+        with _ContextPipe(context_writer) as stdin:
+            self._run(args, dockerfile, stdin)
+        self.maybe_run_postprocess_cmd(
+            metadata_file.name, tags, build_and_push, do_load
+        )
+
+        return None
+
+    def _run(self, args: list[str], dockerfile, stdin):
         if self.quiet:
             with subprocess.Popen(
                 args,
+                stdin=stdin,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
                 universal_newlines=True,
@@ -113,16 +134,54 @@ class DockerCLIBuilder(object):
 
         else:
             with subprocess.Popen(
-                args, stdout=sys.stderr.buffer, universal_newlines=True
+                args, stdin=stdin, stdout=sys.stderr.buffer, universal_newlines=True
             ) as p:
                 exit_code = p.wait()
                 if exit_code != 0:
                     raise RuntimeError(f"Builder exited with code {exit_code}")
-        self.maybe_run_postprocess_cmd(
-            metadata_file.name, tags, build_and_push, do_load
-        )
 
-        return None
+
+class _ContextPipe(object):
+    """Pipe feeding a build context tar to the builder's stdin from a thread.
+
+    Yields the read end for ``Popen(stdin=...)``, or None without a writer.
+    On exit it waits for the writer and re-raises its error, which explains
+    a failed build better than the builder's complaint about a short tar.
+    """
+
+    def __init__(self, writer: Optional[Callable[[BinaryIO], None]]):
+        self._writer = writer
+        self._error: Optional[BaseException] = None
+
+    def _write(self, fd: int):
+        try:
+            with os.fdopen(fd, "wb") as out:
+                self._writer(out)
+        except BrokenPipeError:
+            # the builder exited early, its exit code tells why
+            pass
+        except BaseException as e:
+            self._error = e
+
+    def __enter__(self) -> Optional[int]:
+        if self._writer is None:
+            return None
+        read_fd, write_fd = os.pipe()
+        self._read_fd = read_fd
+        self._thread = threading.Thread(
+            target=self._write, args=(write_fd,), name="rebuildr-context"
+        )
+        self._thread.start()
+        return read_fd
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._writer is None:
+            return False
+        os.close(self._read_fd)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return False
 
 
 class _CommandBuilder(object):
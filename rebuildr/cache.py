@@ -0,0 +1,99 @@
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import os
+from pathlib import Path
+import tempfile
+from typing import Optional
+
+
+def env_flag(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value != "" and value != "0" and value.lower() not in ("false", "no")
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"Invalid value for {name}: {value}")
+
+
+def cache_dir() -> Path:
+    """Root directory for rebuildr's persistent caches.
+
+    ``REBUILDR_CACHE_DIR`` takes precedence, then ``$XDG_CACHE_HOME/rebuildr``
+    and finally ``~/.cache/rebuildr``.
+    """
+    override = os.getenv("REBUILDR_CACHE_DIR")
+    if override:
+        return Path(override)
+    xdg_cache_home = os.getenv("XDG_CACHE_HOME")
+    if xdg_cache_home:
+        return Path(xdg_cache_home) / "rebuildr"
+    return Path.home() / ".cache" / "rebuildr"
+
+
+def cache_key(*parts: str) -> str:
+    m = hashlib.sha256()
+    for part in parts:
+        m.update(part.encode())
+        m.update(b"\0")
+    return m.hexdigest()[:32]
+
+
+def read_json(path: Path) -> Optional[dict]:
+    """Read a JSON cache file, treating missing or corrupt files as absent."""
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def atomic_write_json(
+    path: Path, data: dict, indent: Optional[int] = None, mode: Optional[int] = None
+):
+    """Write ``data`` to ``path`` so readers never observe a partial file.
+
+    With ``indent`` the file is meant to be read by people, keys are sorted
+    and it ends with a newline. ``mode`` replaces the private mode of the
+    temporary file the data is written to.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        if mode is not None:
+            os.fchmod(fd, mode)
+        with os.fdopen(fd, "w") as f:
+            if indent is None:
+                json.dump(data, f, separators=(",", ":"))
+            else:
+                json.dump(data, f, indent=indent, sort_keys=True)
+                f.write("\n")
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+@contextmanager
+def file_lock(path: Path, shared: bool = False):
+    """Hold an advisory ``flock`` on ``path`` for the duration of the block."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
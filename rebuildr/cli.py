@@ -1,8 +1,10 @@
-import json
+from contextlib import ExitStack
+from dataclasses import replace
 import logging
 import os
-from pathlib import Path
+from pathlib import Path, PurePath
 import shutil
+from typing import Optional
 from rebuildr.build import DockerCLIBuilder
 from rebuildr.containers.docker import check_registry_availability
 from rebuildr.containers.util import (
@@ -15,17 +17,35 @@ from rebuildr.containers.util import (
 import importlib.util
 import sys
 
+from rebuildr.cache import env_flag
+from rebuildr.compress import CompressOptions
 from rebuildr.context import LocalContext
-from rebuildr.fs import TarContext
+from rebuildr.daemon import query_daemon, run_daemon
+from rebuildr.descriptor import Descriptor
+from rebuildr.explain import (
+    diff_manifests,
+    input_manifest,
+    last_build,
+    load_manifest,
+    normalize_content_id,
+    record_last_build,
+    save_manifest,
+)
+from rebuildr.fs import STREAM_BUILDERS_DIR, write_context_tar, write_tar
+from rebuildr.lockfile import RefLock, git_refs, lock_path
 from rebuildr.stable_descriptor import (
+    ContentId,
+    HashOptions,
     StableDescriptor,
     StableEnvironment,
     StableImageTarget,
     StableInputs,
 )
+from rebuildr.tools.git import git_ls_remote_all
 
 
-def load_py_desc(path: str | Path) -> StableDescriptor:
+def exec_py_desc(path: str | Path) -> Descriptor:
+    """Execute a rebuildr file and return the ``Descriptor`` it defines as ``image``."""
     # Disable bytecode generation for this import
     spec = importlib.util.spec_from_file_location("rebuildr.external.desc", path)
     if spec is None or spec.loader is None:
@@ -41,20 +61,56 @@ def load_py_desc(path: str | Path) -> StableDescriptor:
         # Restore the original setting
         sys.dont_write_bytecode = original_dont_write_bytecode
 
+    return module.image
+
+
+def py_desc_root_dir(path: str | Path, root_dir_override: Optional[str]) -> Path:
     root_absolute_dirname = Path(os.path.dirname(os.path.abspath(path)))
-    # Check for environment variable to override the root directory
-    root_dir_override = os.environ.get("REBUILDR_OVERRIDE_ROOT_DIR")
     if root_dir_override:
         logging.info(f"Overriding root directory with {root_dir_override}")
         root_absolute_dirname = Path(root_dir_override).resolve()
-    image = StableDescriptor.from_descriptor(module.image, root_absolute_dirname)
+    return root_absolute_dirname
+
+
+def load_py_desc(
+    path: str | Path, hashing: Optional[HashOptions] = None
+) -> StableDescriptor:
+    # Check for environment variable to override the root directory
+    root_absolute_dirname = py_desc_root_dir(
+        path, os.environ.get("REBUILDR_OVERRIDE_ROOT_DIR")
+    )
+    image = StableDescriptor.from_descriptor(
+        exec_py_desc(path),
+        root_absolute_dirname,
+        hashing=hashing,
+        lock=RefLock.load(lock_path(path)),
+    )
 
     return image
 
 
-def load_and_parse(path: str, build_args: dict[str, str]) -> dict[str, str]:
-    desc = load_py_desc(path)
+def load_desc(
+    path: str, build_args: dict[str, str], hashing: Optional[HashOptions] = None
+) -> tuple[StableDescriptor, StableEnvironment]:
+    """Load a rebuildr file, from the hashing daemon when one is running.
+
+    The daemon answers with the resolved descriptor and its content id, so
+    nothing is executed, globbed or hashed locally. Without a daemon the
+    rebuildr file is loaded as usual.
+    """
     env = StableEnvironment.from_os_env(build_args)
+    if hashing is None:
+        hashing = HashOptions.from_env()
+    desc = query_daemon(path, env, hashing)
+    if desc is None:
+        desc = load_py_desc(path, hashing)
+    return desc, env
+
+
+def load_and_parse(
+    path: str, build_args: dict[str, str], hashing: Optional[HashOptions] = None
+) -> tuple[StableDescriptor, StableEnvironment, str]:
+    desc, env = load_desc(path, build_args, hashing)
 
     if desc.targets is None or len(desc.targets) != 1:
         raise ValueError(
@@ -62,13 +118,58 @@ def load_and_parse(path: str, build_args: dict[str, str]) -> dict[str, str]:
         )
     target = desc.targets[0]
 
-    return (desc.stable_inputs_dict(env), target.content_id_tag(desc.inputs, env))
+    return desc, env, target.content_id_tag(desc.inputs, env)
 
 
-def parse_and_print_py(path: str, build_args: dict[str, str]):
-    data, _ = load_and_parse(path, build_args)
+def record_input_manifest(desc: StableDescriptor, env: StableEnvironment) -> ContentId:
+    """Compute the content id and keep its input manifest for ``explain``."""
+    content_id = desc.content_id(env)
+    save_manifest(content_id.tag(), input_manifest(desc.inputs, content_id, env))
+    return content_id
 
-    print(json.dumps(data, indent=4, sort_keys=True))
+
+def explain(
+    path: str,
+    build_args: dict[str, str],
+    old_content_id: Optional[str],
+    hashing: Optional[HashOptions] = None,
+):
+    desc, env = load_desc(path, build_args, hashing)
+    content_id = record_input_manifest(desc, env)
+
+    if old_content_id is None:
+        old_content_id = last_build(Path(path))
+        if old_content_id is None:
+            logging.error(
+                f"No previous build of {path} recorded, pass the content id to compare with"
+            )
+            sys.exit(1)
+
+    old_manifest = load_manifest(old_content_id)
+    if old_manifest is None:
+        logging.error(f"No input manifest stored for {old_content_id}")
+        sys.exit(1)
+
+    print(f"{normalize_content_id(old_content_id)} -> {content_id.tag()}")
+    differences = diff_manifests(
+        old_manifest, input_manifest(desc.inputs, content_id, env)
+    )
+    for line in differences:
+        print(line)
+    if len(differences) == 0:
+        print("no input differences")
+
+
+def parse_and_print_py(
+    path: str,
+    build_args: dict[str, str],
+    hashing: Optional[HashOptions] = None,
+    compact: bool = False,
+):
+    desc, env, _ = load_and_parse(path, build_args, hashing)
+
+    desc.write_stable_inputs(env, sys.stdout, compact)
+    sys.stdout.write("\n")
 
 
 def parse_and_write_bazel_stable_metadata(
@@ -76,12 +177,16 @@ def parse_and_write_bazel_stable_metadata(
     build_args: dict[str, str],
     stable_metadata_file: str,
     stable_image_tag_file: str,
+    hashing: Optional[HashOptions] = None,
+    compact: bool = False,
 ):
-    data, content_id_tag = load_and_parse(path, build_args)
+    desc, env, content_id_tag = load_and_parse(path, build_args, hashing)
+    # hash before opening the file, so failures leave no partial metadata
+    desc.content_id(env)
 
     try:
         with open(stable_metadata_file, "w") as f:
-            json.dump(data, f, indent=4, sort_keys=True)
+            desc.write_stable_inputs(env, f, compact)
             f.write("\n")
     except (OSError, IOError) as e:
         raise RuntimeError(
@@ -98,6 +203,34 @@ def parse_and_write_bazel_stable_metadata(
         )
 
 
+def write_lock(path: str):
+    """Resolve the refs of the rebuildr file at ``path`` into its lock file.
+
+    Refs of other rebuildr files sharing the lock file are kept.
+    """
+    refs = git_refs(exec_py_desc(path))
+    # remotes are contacted before the lock file is locked
+    commits = git_ls_remote_all(refs)
+    lock = RefLock.update(lock_path(path), zip(refs, commits))
+    print(lock.path)
+
+
+def print_outdated(path: str):
+    """Print refs whose remote moved since they were locked, exit 1 if any."""
+    refs = list(dict.fromkeys(git_refs(exec_py_desc(path))))
+    lock = RefLock.load(lock_path(path))
+    outdated = 0
+    for (url, ref), commit in zip(refs, git_ls_remote_all(refs)):
+        locked = lock.get(url, ref)
+        if locked != commit:
+            print(f"{url} {ref}: {locked or 'not locked'} -> {commit}")
+            outdated += 1
+    if outdated == 0:
+        print("all refs are up to date")
+    else:
+        sys.exit(1)
+
+
 def is_truthy(value: str) -> bool:
     return (
         value is not None
@@ -108,6 +241,43 @@ def is_truthy(value: str) -> bool:
     )
 
 
+def parse_hash_option(arg: str, hashing: HashOptions) -> HashOptions:
+    """Apply a single ``--option[=value]`` load-py flag to ``hashing``."""
+    name, _, value = arg.partition("=")
+    if name == "--hash-workers":
+        try:
+            return replace(hashing, workers=int(value))
+        except ValueError:
+            raise ValueError(f"Invalid value for --hash-workers: {value}")
+    if name == "--content-id":
+        return replace(hashing, scheme=value)
+    if name == "--no-digest-cache":
+        return replace(hashing, digest_cache=False)
+    if name == "--no-glob-cache":
+        return replace(hashing, glob_cache=False)
+    if name == "--hash-algorithm":
+        return replace(hashing, algorithm=value)
+    if name == "--locked":
+        return replace(hashing, locked=True)
+    raise ValueError(f"Unknown option: {arg}")
+
+
+def parse_compress_option(arg: str, compress: CompressOptions) -> CompressOptions:
+    """Apply a single ``--compress*=value`` build-tar flag to ``compress``."""
+    name, _, value = arg.partition("=")
+    if name == "--compress":
+        return replace(compress, compression=value)
+    if name in ("--compress-level", "--compress-workers"):
+        try:
+            number = int(value)
+        except ValueError:
+            raise ValueError(f"Invalid value for {name}: {value}")
+        if name == "--compress-level":
+            return replace(compress, level=number)
+        return replace(compress, workers=number)
+    raise ValueError(f"Unknown build-tar option: {arg}")
+
+
 def parse_build_args(args: list[str]) -> dict[str, str]:
     build_args = {}
     for arg in args:
@@ -117,6 +287,21 @@ def parse_build_args(args: list[str]) -> dict[str, str]:
     return build_args
 
 
+# how BuildCtx.build hands the context to buildx: staged in a temporary
+# directory or streamed as a tar to its stdin
+CONTEXT_STAGED = "staged"
+CONTEXT_STREAM = "stream"
+
+
+def context_mode() -> str:
+    mode = os.getenv("REBUILDR_CONTEXT") or CONTEXT_STAGED
+    if mode not in (CONTEXT_STAGED, CONTEXT_STREAM):
+        raise ValueError(
+            f"Unknown build context mode {mode}, expected {CONTEXT_STAGED} or {CONTEXT_STREAM}"
+        )
+    return mode
+
+
 class BuildCtx:
     tags: list[str]
     content_id_tag: str | None
@@ -124,10 +309,15 @@ class BuildCtx:
     desc: StableDescriptor
     env: StableEnvironment
     inputs: StableInputs
+    content_id: ContentId
 
-    def __init__(self, path: str, build_args: dict[str, str]):
-        desc = load_py_desc(path)
-        env = StableEnvironment.from_os_env(build_args)
+    def __init__(
+        self,
+        path: str,
+        build_args: dict[str, str],
+        hashing: Optional[HashOptions] = None,
+    ):
+        desc, env = load_desc(path, build_args, hashing)
         if desc.targets is None or len(desc.targets) != 1:
             raise ValueError(
                 "TODO:for now - Only one target is supported for docker build"
@@ -138,6 +328,8 @@ class BuildCtx:
                 "TODO:for now - Image target is supported for docker build"
             )
 
+        # hash the inputs once, tags below reuse the memoized result
+        self.content_id = desc.content_id(env)
         content_id_tag = (
             target.content_id_tag(desc.inputs, env)
             if target.also_tag_with_content_id
@@ -147,6 +339,7 @@ class BuildCtx:
         self.build_args = desc.inputs.build_args_dict(env)
         logging.info(f"Build args: {self.build_args}")
 
+        self.path = path
         self.target = target
         self.env = env
         self.desc = desc
@@ -187,8 +380,11 @@ class BuildCtx:
         push: bool = False,
         override_tags: list[str] = [],
     ) -> None:
+        # only what is built is recorded for explain, not every parsed id
+        record_input_manifest(self.desc, self.env)
         if not force_build and self._load_cached(fetch_if_not_local):
             logging.info(f"Image {self.content_id_tag} already exists")
+            record_last_build(Path(self.path), self.content_id.tag())
             return
 
         tags = self.tags
@@ -197,10 +393,53 @@ class BuildCtx:
         if len(tags) == 0:
             raise ValueError("No tags specified")
 
-        ctx = LocalContext.temp()
-        ctx.prepare_from_descriptor(self.desc)
-        dockerfile_path = ctx.root_dir / self.target.dockerfile
+        # inputs are verified against the content id while they are staged
+        # or streamed
+        content_id = (
+            self.content_id if env_flag("REBUILDR_VERIFY_INPUTS", True) else None
+        )
+        with ExitStack() as stack:
+            stream = context_mode() == CONTEXT_STREAM
+            if stream:
+                # the context is written straight into buildx, nothing is
+                # staged; the builder files in it are ignored by the build
+                root_dir = None
+                dockerfile_path = PurePath(STREAM_BUILDERS_DIR) / self.target.dockerfile
+            else:
+                # buildx only reads the context, so inputs may be hardlinked into it
+                if env_flag("REBUILDR_PERSISTENT_CONTEXT", False):
+                    # locked until the build is done
+                    ctx = stack.enter_context(
+                        LocalContext.persistent(self._context_key(), read_only=True)
+                    )
+                else:
+                    ctx = LocalContext.temp(read_only=True)
+                ctx.prepare_from_descriptor(self.desc, content_id)
+                root_dir = ctx.src_path()
+                dockerfile_path = ctx.root_dir / self.target.dockerfile
+
+            self._run_builder(push, tags, root_dir, dockerfile_path, stream, content_id)
+        record_last_build(Path(self.path), self.content_id.tag())
+
+    def _context_key(self) -> tuple[str, ...]:
+        """Identifies the persistent context of this descriptor and target."""
+        return (
+            str(Path(self.path).resolve()),
+            self.target.repository,
+            str(self.target.dockerfile),
+            self.target.target or "",
+            "" if self.target.platform is None else self.target.platform.value,
+        )
 
+    def _run_builder(
+        self,
+        push: bool,
+        tags: list[str],
+        root_dir: Optional[Path],
+        dockerfile_path: PurePath,
+        stream: bool,
+        content_id: Optional[ContentId],
+    ):
         target_platforms = "linux/amd64,linux/arm64"
         do_load = False
         if self.target.platform is not None:
@@ -210,29 +449,33 @@ class BuildCtx:
 
         builder = DockerCLIBuilder()
         builder.build(
-            root_dir=ctx.src_path(),
+            root_dir=root_dir,
             dockerfile=dockerfile_path,
             buildargs=self.build_args,
             tags=tags,
             platform=target_platforms,
             do_load=do_load,
             build_and_push=push,
+            context_writer=(
+                (
+                    lambda out: write_context_tar(
+                        self.desc, out, content_id, PurePath(self.target.dockerfile)
+                    )
+                )
+                if stream
+                else None
+            ),
         )
 
 
-def build_tar(path: str, output: str):
-    desc = load_py_desc(path)
-
-    ctx = TarContext()
-    ctx.prepare_from_descriptor(desc)
-
-    ctx.copy_to_file(Path(output))
+def build_tar(path: str, output: str, compress: CompressOptions = CompressOptions()):
+    write_tar(load_py_desc(path), output, compress)
 
 
 def print_usage():
     print("Usage: rebuildr <command> <args>")
     print("Commands:")
-    print("  load-py <rebuildr-file> [build-arg=value build-arg2=value2 ...]")
+    print("  load-py <rebuildr-file> [options] [build-arg=value build-arg2=value2 ...]")
     print(
         "  load-py <rebuildr-file> [build-arg=value build-arg2=value2 ...] bazel-stable-metadata <stable-metadata-file> <stable-image-tag-file>"
     )
@@ -242,7 +485,27 @@ def print_usage():
     print(
         "  load-py <rebuildr-file> [build-arg=value build-arg2=value2 ...] push-image [--only-content-id-tag] [--force-build] [<override-tag>] ",
     )
-    print("  load-py <rebuildr-file> build-tar <output>")
+    print(
+        "  load-py <rebuildr-file> build-tar [--compress=none|gzip|xz] [--compress-level=N] [--compress-workers=N] <output|->"
+    )
+    print(
+        "  load-py <rebuildr-file> [build-arg=value build-arg2=value2 ...] explain [<old-content-id>]"
+    )
+    print("  load-py <rebuildr-file> lock")
+    print("  load-py <rebuildr-file> outdated")
+    print("  daemon")
+    print("Options:")
+    print("  --hash-workers=N    read and digest input files with N threads")
+    print("  --no-digest-cache   do not use the persistent file digest cache")
+    print("  --no-glob-cache     do not use the persistent directory listing cache")
+    print("  --compact           write metadata JSON without indentation")
+    print("  --locked            fail if a git ref is missing from rebuildr.lock")
+    print(
+        "  --content-id=v1|v2|git  content id scheme, v2 is a Merkle tree of file digests, git uses blob ids from the git index"
+    )
+    print(
+        "  --hash-algorithm=sha256|blake2b  content id hash, blake2b ids are tagged src-id-b2-"
+    )
 
 
 def parse_cli():
@@ -257,6 +520,10 @@ def parse_cli():
         parse_cli_parse_py(args[1:])
         return
 
+    if args[0] == "daemon":
+        run_daemon()
+        return
+
     logging.error(f"Unknown command: {args[0]}")
     print_usage()
     return
@@ -271,10 +538,28 @@ def parse_cli_parse_py(args):
     args = args[1:]
 
     build_args = {}
-    # parse build args until first subcommand
-    while len(args) > 0 and "=" in args[0]:
-        key, value = args[0].split("=", 1)
-        build_args[key] = value
+    try:
+        hashing = HashOptions.from_env()
+    except ValueError as e:
+        logging.error(str(e))
+        return
+    compact = False
+    # parse options and build args until first subcommand
+    while len(args) > 0 and (args[0].startswith("--") or "=" in args[0]):
+        if args[0] == "--help":
+            break
+        if args[0] == "--compact":
+            compact = True
+        elif args[0].startswith("--"):
+            try:
+                hashing = parse_hash_option(args[0], hashing)
+            except ValueError as e:
+                logging.error(str(e))
+                print_usage()
+                return
+        else:
+            key, value = args[0].split("=", 1)
+            build_args[key] = value
         args = args[1:]
 
     # ignore empty args before first subcommand
@@ -282,7 +567,7 @@ def parse_cli_parse_py(args):
         args = args[1:]
 
     if len(args) == 0:
-        parse_and_print_py(file_path, build_args)
+        parse_and_print_py(file_path, build_args, hashing, compact)
         return
     if any(arg in ("-h", "--help") for arg in args):
         print_usage()
@@ -294,13 +579,13 @@ def parse_cli_parse_py(args):
             return
         else:
             parse_and_write_bazel_stable_metadata(
-                file_path, build_args, args[1], args[2]
+                file_path, build_args, args[1], args[2], hashing, compact
             )
         return
 
     if "materialize-image" == args[0]:
         # TODO: support build in place mode where buildx is used with the default driver - so that the image doesn't have to be transfered into the docker daemon
-        ctx = BuildCtx(file_path, build_args)
+        ctx = BuildCtx(file_path, build_args, hashing)
         force_build = False
         if "--force-build" in args:
             force_build = True
@@ -328,7 +613,7 @@ def parse_cli_parse_py(args):
         if len(args) > 1 and args[1] != "":
             override_tag = args[1]
 
-        ctx = BuildCtx(file_path, build_args)
+        ctx = BuildCtx(file_path, build_args, hashing)
         tags_to_push = ctx.tags
         specific_tag = ctx.most_specific_tag()
 
@@ -349,7 +634,7 @@ def parse_cli_parse_py(args):
         print(specific_tag)
         return
     if "check-target-registry-reachability" == args[0]:
-        ctx = BuildCtx(file_path, build_args)
+        ctx = BuildCtx(file_path, build_args, hashing)
         specific_tag = ctx.most_specific_tag()
         if check_registry_availability(specific_tag):
             logging.info(f"Registry for image {specific_tag} is available")
@@ -358,12 +643,34 @@ def parse_cli_parse_py(args):
             sys.exit(1)
         return
 
+    if "explain" == args[0]:
+        explain(file_path, build_args, args[1] if len(args) > 1 else None, hashing)
+        return
+
+    if "lock" == args[0]:
+        write_lock(file_path)
+        return
+
+    if "outdated" == args[0]:
+        print_outdated(file_path)
+        return
+
     if "build-tar" == args[0]:
-        if len(args) < 2:
+        compress = CompressOptions()
+        args = args[1:]
+        while len(args) > 0 and args[0].startswith("--"):
+            try:
+                compress = parse_compress_option(args[0], compress)
+            except ValueError as e:
+                logging.error(str(e))
+                print_usage()
+                return
+            args = args[1:]
+        if len(args) < 1:
             logging.error("Tar path is required")
             return
         else:
-            build_tar(file_path, args[1])
+            build_tar(file_path, args[0], compress)
         return
 
     logging.error(f"Unknown command: {args[0]}")
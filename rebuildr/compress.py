@@ -0,0 +1,135 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+import gzip
+import lzma
+import os
+from typing import BinaryIO, Iterator, Optional
+
+COMPRESS_NONE = "none"
+COMPRESS_GZIP = "gzip"
+COMPRESS_XZ = "xz"
+COMPRESSIONS = (COMPRESS_NONE, COMPRESS_GZIP, COMPRESS_XZ)
+
+DEFAULT_LEVEL = 6
+
+# uncompressed size of every gzip member; members are compressed without the
+# history of the previous ones, large chunks keep the ratio close to a single
+# member
+GZIP_CHUNK_SIZE = 1 << 20
+
+
+@dataclass(frozen=True)
+class CompressOptions:
+    """How ``build-tar`` compresses its output.
+
+    ``workers`` only changes how many gzip members are compressed at once,
+    the output is the same for any number of workers.
+    """
+
+    compression: str = COMPRESS_NONE
+    level: int = DEFAULT_LEVEL
+    workers: Optional[int] = None
+
+    def __post_init__(self):
+        if self.compression not in COMPRESSIONS:
+            raise ValueError(
+                f"Unknown compression {self.compression}, expected one of {', '.join(COMPRESSIONS)}"
+            )
+        if not 0 <= self.level <= 9:
+            raise ValueError(f"Compression level must be 0-9, got {self.level}")
+        if self.workers is not None and self.workers < 1:
+            raise ValueError(
+                f"Compression workers must be positive, got {self.workers}"
+            )
+
+
+class ParallelGzipWriter(object):
+    """Writes a gzip stream of independent members compressed on a thread pool.
+
+    The data is cut into ``chunk_size`` chunks, each compressed into its own
+    gzip member with a zero modification time. zlib releases the GIL while
+    compressing, so chunks are compressed in parallel; concatenated members
+    are a valid gzip stream that ``gzip -d`` and ``tar xz`` read as one.
+    At most two chunks per worker are held in memory.
+    """
+
+    def __init__(
+        self,
+        out: BinaryIO,
+        level: int = DEFAULT_LEVEL,
+        workers: Optional[int] = None,
+        chunk_size: int = GZIP_CHUNK_SIZE,
+    ):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self._out = out
+        self._level = level
+        self._chunk_size = chunk_size
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._max_pending = 2 * workers
+        self._pending: deque[Future] = deque()
+        self._buffer = bytearray()
+        self._members = 0
+
+    def __enter__(self) -> "ParallelGzipWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._pool.shutdown(cancel_futures=True)
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast("B")
+        size = len(view)
+        if len(self._buffer) > 0:
+            taken = min(size, self._chunk_size - len(self._buffer))
+            self._buffer += view[:taken]
+            view = view[taken:]
+            if len(self._buffer) < self._chunk_size:
+                return size
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        # whole chunks of large writes are not copied into the buffer first
+        while len(view) >= self._chunk_size:
+            self._submit(bytes(view[: self._chunk_size]))
+            view = view[self._chunk_size :]
+        self._buffer += view
+        return size
+
+    def _submit(self, chunk: bytes):
+        self._pending.append(
+            self._pool.submit(gzip.compress, chunk, self._level, mtime=0)
+        )
+        self._members += 1
+        while len(self._pending) > self._max_pending:
+            self._out.write(self._pending.popleft().result())
+
+    def close(self):
+        """Compress the remaining data and write all members in order."""
+        # an empty input is still a valid, empty gzip stream
+        if len(self._buffer) > 0 or self._members == 0:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        try:
+            while len(self._pending) > 0:
+                self._out.write(self._pending.popleft().result())
+        finally:
+            self._pool.shutdown(cancel_futures=True)
+
+
+@contextmanager
+def compressed_writer(out: BinaryIO, options: CompressOptions) -> Iterator[BinaryIO]:
+    """Yield a file object that compresses what is written to it into ``out``."""
+    if options.compression == COMPRESS_NONE:
+        yield out
+    elif options.compression == COMPRESS_GZIP:
+        with ParallelGzipWriter(out, options.level, options.workers) as writer:
+            yield writer
+    else:
+        # lzma has no multi-threaded mode in the standard library
+        with lzma.LZMAFile(out, "w", preset=options.level) as writer:
+            yield writer
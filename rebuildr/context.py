@@ -1,35 +1,120 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 import logging
+import os
 from pathlib import Path, PurePath
-import shutil
 import tempfile
+import time
+from typing import Iterator, Optional
 
 from rebuildr.build import DockerCLIBuilder
+from rebuildr.cache import (
+    atomic_write_json,
+    cache_dir,
+    cache_key,
+    env_int,
+    file_lock,
+    read_json,
+)
+from rebuildr.digest_cache import RACY_WINDOW_NS, fingerprint
 from rebuildr.stable_descriptor import (
+    ContentId,
     StableEnvInput,
     StableFileInput,
     StableDescriptor,
     StableGitHubCommitInput,
     StableGitRepoInput,
 )
-from rebuildr.tools.git import git_better_clone
+from rebuildr.staging import FileStager
+from rebuildr.tools.git import (
+    git_better_clone,
+    git_fetch_to_cache,
+    run_concurrently,
+)
+from rebuildr.verify import InputCheck, InputVerifier
+
+
+_STATE_VERSION = 3
+
+
+def _staged_stat(path: Path) -> Optional[list[int]]:
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    return [st.st_ino, st.st_size, st.st_mtime_ns, st.st_mode]
 
 
 class LocalContext(object):
-    def __init__(self, root_dir):
+    """A build context directory staged from the inputs of a descriptor.
+
+    ``staging`` selects how input files are placed into it, one of
+    ``STAGING_STRATEGIES`` (``REBUILDR_STAGING`` or ``auto`` when None).
+    ``read_only`` promises that nothing writes to staged files, which lets
+    ``auto`` hardlink inputs. Files are staged by ``workers`` threads
+    (``REBUILDR_STAGING_WORKERS`` or 8 when None).
+    """
+
+    def __init__(
+        self,
+        root_dir,
+        staging: Optional[str] = None,
+        read_only: bool = False,
+        workers: Optional[int] = None,
+        state_path: Optional[Path] = None,
+    ):
         if isinstance(root_dir, tempfile.TemporaryDirectory):
             self.temp_dir = root_dir
             self.root_dir = Path(root_dir.name)
         else:
             self.root_dir = Path(root_dir)
+        self.stager = FileStager(staging, read_only)
+        if workers is None:
+            workers = env_int("REBUILDR_STAGING_WORKERS", 8)
+        if workers < 1:
+            raise ValueError(f"Staging workers must be at least 1, got {workers}")
+        self.workers = workers
+        # set for persistent contexts, which are synced incrementally
+        self.state_path = state_path
 
     @staticmethod
-    def temp() -> "LocalContext":
+    def temp(
+        staging: Optional[str] = None,
+        read_only: bool = False,
+        workers: Optional[int] = None,
+    ) -> "LocalContext":
         root_dir = tempfile.TemporaryDirectory()
-        return LocalContext(root_dir)
+        return LocalContext(root_dir, staging, read_only, workers)
 
     @staticmethod
-    def from_path(path: Path) -> "LocalContext":
-        return LocalContext(path)
+    def from_path(
+        path: Path,
+        staging: Optional[str] = None,
+        read_only: bool = False,
+        workers: Optional[int] = None,
+    ) -> "LocalContext":
+        return LocalContext(path, staging, read_only, workers)
+
+    @staticmethod
+    @contextmanager
+    def persistent(
+        key: tuple[str, ...],
+        staging: Optional[str] = None,
+        read_only: bool = False,
+        workers: Optional[int] = None,
+    ) -> Iterator["LocalContext"]:
+        """A context directory in the cache directory, reused for every ``key``.
+
+        ``prepare_from_descriptor`` syncs it with the descriptor instead of
+        staging everything again. The context is locked until the block
+        exits, so concurrent processes never build from a half synced one.
+        """
+        root_dir = cache_dir() / "contexts" / cache_key(*key)
+        with file_lock(root_dir.with_suffix(".lock")):
+            yield LocalContext(
+                root_dir, staging, read_only, workers, root_dir.with_suffix(".json")
+            )
 
     def src_path(self) -> Path:
         return self.root_dir / "src"
@@ -37,74 +122,276 @@ class LocalContext(object):
     def builders_path(self) -> Path:
         return self.root_dir / "builders"
 
-    @staticmethod
-    def _copy_file(src_path: Path, dest_path: Path):
-        dest_dir = dest_path.parent
-        if dest_dir.is_file():
-            raise ValueError(
-                f"Destination {dest_dir} is a file but should be a directory, check configured inputs"
+    def _copy_file(
+        self, src_path: Path, dest_path: Path, check: Optional[InputCheck] = None
+    ) -> int:
+        """Stage a file whose destination directory exists, returning its size."""
+        try:
+            # every method preserves file modification times and mode
+            return self.stager.stage(src_path, dest_path, check)
+        except (OSError, IOError) as e:
+            raise RuntimeError(f"Failed to copy {src_path} to {dest_path}: {e}")
+
+    def _make_dest_dirs(self, staged: dict[Path, Path]):
+        """Create every destination directory once, before any file is staged."""
+        dest_dirs = {}
+        for dest_path, src_path in staged.items():
+            dest_dirs.setdefault(dest_path.parent, (src_path, dest_path))
+        for dest_dir in sorted(dest_dirs):
+            src_path, dest_path = dest_dirs[dest_dir]
+            if dest_dir in staged or dest_dir.is_file():
+                raise ValueError(
+                    f"Destination {dest_dir} is a file but should be a directory, check configured inputs"
+                )
+            try:
+                dest_dir.mkdir(parents=True, exist_ok=True)
+            except (OSError, IOError) as e:
+                raise RuntimeError(f"Failed to copy {src_path} to {dest_path}: {e}")
+
+    def _stage_files(
+        self,
+        staged: dict[Path, Path],
+        changed: Optional[dict[Path, Path]] = None,
+        checks: Optional[dict[Path, InputCheck]] = None,
+    ):
+        """Stage ``changed`` files, all of ``staged`` when None.
+
+        Files with an entry in ``checks`` are verified while they are staged.
+        """
+        self._make_dest_dirs(staged)
+        if changed is None:
+            changed = staged
+        if checks is None:
+            checks = {}
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="rebuildr-stage"
+        ) as executor:
+            size = sum(
+                executor.map(
+                    self._copy_file,
+                    changed.values(),
+                    changed.keys(),
+                    [checks.get(dest_path) for dest_path in changed],
+                )
             )
+        elapsed = max(time.monotonic() - started, 1e-9)
+
+        logging.info(
+            f"Staged {len(changed)} files ({size / 1e6:.1f} MB) with {self.stager.strategy} in {elapsed:.2f}s, "
+            f"{len(changed) / elapsed:.0f} files/s, {size / 1e6 / elapsed:.1f} MB/s"
+        )
 
-        logging.debug(f"Copying {src_path} to {dest_path}")
+    def _remove_stale(self, staged: dict[Path, Path], external_dirs: set[Path]):
+        """Delete everything in the context that is not staged from the inputs.
+
+        External repositories are synced by git and generated builder files
+        are rewritten when needed, both are left alone.
+        """
+        keep_dirs = {self.builders_path()} | external_dirs
+        visited = []
+        for dirpath, dirnames, filenames in os.walk(self.root_dir):
+            directory = Path(dirpath)
+            visited.append(directory)
+            for name in list(dirnames):
+                path = directory / name
+                if path in keep_dirs:
+                    dirnames.remove(name)
+                elif path.is_symlink():
+                    # staging never creates symlinks, os.walk lists those to
+                    # directories along with the directories
+                    dirnames.remove(name)
+                    path.unlink()
+            for name in filenames:
+                path = directory / name
+                if path not in staged:
+                    path.unlink()
+        # children before parents, directories still needed are created again
+        for directory in reversed(visited[1:]):
+            if directory == self.src_path():
+                continue
+            try:
+                directory.rmdir()
+            except OSError:
+                pass
+
+    def _sync_files(
+        self,
+        staged: dict[Path, Path],
+        external_dirs: set[Path],
+        known: dict,
+        checks: dict[Path, InputCheck],
+    ) -> dict:
+        """Stage only files whose source or staged copy changed since the last sync.
+
+        The state file maps every staged file to the fingerprint of its
+        source and the stat of the staged file, both taken when it was
+        staged. Sources modified right before staging are not recorded, so
+        they are staged again on the next sync. Files that are not staged
+        again were checked when they were staged, their source is unchanged
+        since.
+        """
+        self._remove_stale(staged, external_dirs)
+
+        started_ns = time.time_ns()
+        files = {}
+        changed = {}
+        for dest_path, src_path in staged.items():
+            try:
+                src_st = os.stat(src_path)
+            except OSError as e:
+                raise RuntimeError(f"Failed to copy {src_path} to {dest_path}: {e}")
+            record = known.get(str(dest_path))
+            if (
+                record is not None
+                and record["source"] == str(src_path)
+                and record["fingerprint"] == fingerprint(src_st)
+                and _staged_stat(dest_path) == record["staged"]
+            ):
+                files[str(dest_path)] = record
+                continue
+            changed[dest_path] = src_path
+            if (
+                max(src_st.st_mtime_ns, src_st.st_ctime_ns)
+                < started_ns - RACY_WINDOW_NS
+            ):
+                files[str(dest_path)] = {
+                    "source": str(src_path),
+                    "fingerprint": fingerprint(src_st),
+                }
+
+        self._stage_files(staged, changed, checks)
+        for dest_path in changed:
+            record = files.get(str(dest_path))
+            if record is not None:
+                record["staged"] = _staged_stat(dest_path)
+        return files
+
+    def _sync_external(
+        self,
+        url: str,
+        commit: str,
+        target_path: Path,
+        subpath: Optional[PurePath],
+        state: dict,
+    ):
+        """Export ``commit`` into ``target_path`` unless it is there already."""
+        if subpath is None:
+            checked_out = commit
+        else:
+            checked_out = f"{commit}:{subpath.as_posix()}"
+        if state.get(str(target_path)) == checked_out and target_path.is_dir():
+            return
         try:
-            dest_dir.mkdir(parents=True, exist_ok=True)
-            # Preserve file modification and creation times
-            shutil.copy2(src_path, dest_path)  # copy2 preserves metadata
+            target_path.mkdir(parents=True, exist_ok=True)
         except (OSError, IOError) as e:
-            raise RuntimeError(f"Failed to copy {src_path} to {dest_path}: {e}")
+            raise RuntimeError(
+                f"Failed to create external directory {target_path}: {e}"
+            )
+        git_better_clone(url, target_path, commit, subpath)
+        state[str(target_path)] = checked_out
+
+    def prepare_from_descriptor(
+        self, descriptor: StableDescriptor, content_id: Optional[ContentId] = None
+    ):
+        """Stage the inputs of ``descriptor``.
 
-    def prepare_from_descriptor(self, descriptor: StableDescriptor):
+        With ``content_id`` every input file is read once, while it is
+        staged, and the build fails if it is not what the content id was
+        computed from.
+        """
         files_path = self.src_path()
         try:
             files_path.mkdir(parents=True, exist_ok=True)
         except (OSError, IOError) as e:
             raise RuntimeError(f"Failed to create files directory {files_path}: {e}")
 
+        # destination -> source, of inputs staged at the same path the last wins
+        staged: dict[Path, Path] = {}
+        checks: dict[Path, InputCheck] = {}
+        verifier = InputVerifier(content_id) if content_id is not None else None
         for file in descriptor.inputs.files:
             dest_path = files_path / file.target_path
-            src_path = file.absolute_src_path
-            LocalContext._copy_file(src_path, dest_path)
+            staged[dest_path] = file.absolute_src_path
+            if verifier is not None:
+                checks[dest_path] = verifier.check(
+                    file.absolute_src_path, file.target_path, builder=False
+                )
 
         for file in descriptor.inputs.builders:
             if isinstance(file, StableFileInput):
                 dest_path = self.root_dir / file.target_path
-                src_path = file.absolute_src_path
-                LocalContext._copy_file(src_path, dest_path)
+                staged[dest_path] = file.absolute_src_path
+                if verifier is not None:
+                    checks[dest_path] = verifier.check(
+                        file.absolute_src_path, file.target_path, builder=True
+                    )
             elif isinstance(file, StableEnvInput):
                 pass
             else:
                 raise ValueError("Unknown input type")
 
-        for external in descriptor.inputs.external:
-            if isinstance(external, StableGitHubCommitInput):
-                target_path = self.src_path() / external.target_path
-                try:
-                    target_path.mkdir(parents=True, exist_ok=True)
-                except (OSError, IOError) as e:
-                    raise RuntimeError(
-                        f"Failed to create external directory {target_path}: {e}"
-                    )
-                # TODO: improve caching in remote builders
-                # if not self.attempt_to_load_from_current_builder(
-                #     external.commit, target_path
-                # ):
-                git_better_clone(external.url, target_path, external.commit)
-            # self.store_in_docker_current_builder(external.commit, target_path)
+        external_dirs = {
+            self.src_path() / external.target_path
+            for external in descriptor.inputs.external
+        }
+        state = {}
+        if self.state_path is not None:
+            state = read_json(self.state_path) or {}
+            if state.get("version") != _STATE_VERSION:
+                state = {}
+        if self.state_path is None:
+            self._stage_files(staged, checks=checks)
+        else:
+            files = self._sync_files(
+                staged, external_dirs, state.get("files", {}), checks
+            )
 
-            elif isinstance(external, StableGitRepoInput):
-                target_path = self.src_path() / external.target_path
-                try:
-                    target_path.mkdir(parents=True, exist_ok=True)
-                except (OSError, IOError) as e:
-                    raise RuntimeError(
-                        f"Failed to create external directory {target_path}: {e}"
-                    )
+        externals = state.get("externals", {})
+        git_externals = [
+            external
+            for external in descriptor.inputs.external
+            if isinstance(external, (StableGitHubCommitInput, StableGitRepoInput))
+        ]
+        # fetched concurrently up front, then exported from the cache in
+        # declaration order, so externals nested in one another are placed
+        # like they were one after the other
+        run_concurrently(
+            [
+                partial(
+                    git_fetch_to_cache, external.url, external.commit, external.subpath
+                )
+                for external in git_externals
+            ]
+        )
+        for external in git_externals:
+            # TODO: improve caching in remote builders
+            # if not self.attempt_to_load_from_current_builder(
+            #     external.commit, target_path
+            # ):
+            self._sync_external(
+                external.url,
+                external.commit,
+                self.src_path() / external.target_path,
+                external.subpath,
+                externals,
+            )
+            # self.store_in_docker_current_builder(external.commit, target_path)
 
-                # if not self.attempt_to_load_from_current_builder(
-                #     external.commit, target_path
-                # ):
-                git_better_clone(external.url, target_path, external.commit)
-                # self.store_in_docker_current_builder(external.commit, target_path)
+        if self.state_path is not None:
+            atomic_write_json(
+                self.state_path,
+                {
+                    "version": _STATE_VERSION,
+                    "files": files,
+                    "externals": {
+                        target: commit
+                        for target, commit in externals.items()
+                        if Path(target) in external_dirs
+                    },
+                },
+            )
 
     def write_builders_file(self, path: str | PurePath, content: str):
         file_path = self.builders_path() / path
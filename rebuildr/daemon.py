@@ -0,0 +1,638 @@
+import ctypes
+import ctypes.util
+from dataclasses import asdict, dataclass, field
+import errno
+import json
+import logging
+import os
+from pathlib import Path, PurePath
+import select
+import socket
+import struct
+import time
+from typing import Optional
+
+from rebuildr.cache import cache_dir, env_flag
+from rebuildr.descriptor import Descriptor, GitRepoInput, GlobInput, Platform
+from rebuildr.stable_descriptor import (
+    ContentId,
+    HashOptions,
+    InputDigest,
+    StableBuildArgsInput,
+    StableDescriptor,
+    StableEnvInput,
+    StableEnvironment,
+    StableExcludeInput,
+    StableFileInput,
+    StableGitHubCommitInput,
+    StableGitRepoInput,
+    StableImageTarget,
+    StableInputs,
+)
+from rebuildr.lockfile import RefLock, git_refs, lock_path
+from rebuildr.tools.git import git_ls_remote_all
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+
+# struct inotify_event without the trailing name
+_EVENT_HEADER = struct.Struct("iIII")
+
+# dirty descriptors are hashed again once their inputs were quiet for this long
+_SETTLE_SECONDS = 0.2
+
+# a query gives up when the inputs keep changing while they are hashed
+_MAX_ATTEMPTS = 3
+
+# a busy or hung daemon is given up on after this long and the content id is
+# computed locally; it bounds every socket operation, including the wait for
+# the first query of a rebuildr file, which hashes all of its inputs
+_QUERY_TIMEOUT_SECONDS = 10.0
+
+_PROTOCOL_VERSION = 3
+
+
+class Inotify(object):
+    """Minimal ctypes binding of the Linux inotify API."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise RuntimeError("The rebuildr daemon requires inotify (Linux)")
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._add_watch.restype = ctypes.c_int
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self._rm_watch.restype = ctypes.c_int
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1 failed: {os.strerror(err)}")
+
+    def add_watch(self, path: Path, mask: int = _WATCH_MASK) -> int:
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), str(path))
+        return wd
+
+    def rm_watch(self, wd: int):
+        # fails when the kernel already removed the watch, which is fine
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self) -> list[tuple[int, int, str]]:
+        """Return all queued ``(wd, mask, name)`` events without blocking."""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_len = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset : offset + name_len].rstrip(b"\0")
+                offset += name_len
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def socket_path() -> Path:
+    override = os.getenv("REBUILDR_DAEMON_SOCKET")
+    if override:
+        return Path(override)
+    return cache_dir() / "daemon.sock"
+
+
+def _file_to_json(file_dep: StableFileInput) -> dict:
+    return {
+        "target_path": str(file_dep.target_path),
+        "absolute_src_path": str(file_dep.absolute_src_path),
+        "ignore_target_path": file_dep.ignore_target_path,
+    }
+
+
+def _file_from_json(data: dict) -> StableFileInput:
+    return StableFileInput(
+        target_path=PurePath(data["target_path"]),
+        absolute_src_path=Path(data["absolute_src_path"]),
+        ignore_target_path=data["ignore_target_path"],
+    )
+
+
+def _descriptor_to_json(desc: StableDescriptor) -> dict:
+    inputs = desc.inputs
+    return {
+        "absolute_path": str(desc.absolute_path),
+        "envs": [[dep.key, dep.default] for dep in inputs.envs],
+        "build_args": [[dep.key, dep.default] for dep in inputs.build_args],
+        "files": [_file_to_json(dep) for dep in inputs.files],
+        "builders": [_file_to_json(dep) for dep in inputs.builders],
+        "external": [
+            [
+                "github" if isinstance(dep, StableGitHubCommitInput) else "git",
+                dep.url,
+                dep.commit,
+                str(dep.target_path),
+                None if dep.subpath is None else str(dep.subpath),
+            ]
+            for dep in inputs.external
+        ],
+        "excludes": [[str(dep.root), dep.pattern] for dep in inputs.excludes],
+        "hashing": asdict(inputs.hashing),
+        "targets": [
+            {
+                "repository": target.repository,
+                "dockerfile": str(target.dockerfile),
+                "tag": target.tag,
+                "dockerfile_absolute_path": str(target.dockerfile_absolute_path),
+                "also_tag_with_content_id": target.also_tag_with_content_id,
+                "target": target.target,
+                "platform": None if target.platform is None else target.platform.value,
+            }
+            for target in desc.targets or []
+        ],
+    }
+
+
+def _descriptor_from_json(data: dict) -> StableDescriptor:
+    external = []
+    for kind, url, commit, target_path, subpath in data["external"]:
+        external_class = (
+            StableGitHubCommitInput if kind == "github" else StableGitRepoInput
+        )
+        external.append(
+            external_class(
+                url=url,
+                commit=commit,
+                target_path=PurePath(target_path),
+                subpath=None if subpath is None else PurePath(subpath),
+            )
+        )
+
+    inputs = StableInputs(
+        envs=[
+            StableEnvInput(key=key, default=default) for key, default in data["envs"]
+        ],
+        build_args=[
+            StableBuildArgsInput(key=key, default=default)
+            for key, default in data["build_args"]
+        ],
+        files=[_file_from_json(dep) for dep in data["files"]],
+        builders=[_file_from_json(dep) for dep in data["builders"]],
+        external=external,
+        excludes=[
+            StableExcludeInput(root=PurePath(root), pattern=pattern)
+            for root, pattern in data["excludes"]
+        ],
+        hashing=HashOptions(**data["hashing"]),
+    )
+    targets = [
+        StableImageTarget(
+            repository=target["repository"],
+            dockerfile=PurePath(target["dockerfile"]),
+            tag=target["tag"],
+            dockerfile_absolute_path=Path(target["dockerfile_absolute_path"]),
+            also_tag_with_content_id=target["also_tag_with_content_id"],
+            target=target["target"],
+            platform=None
+            if target["platform"] is None
+            else Platform(target["platform"]),
+        )
+        for target in data["targets"]
+    ]
+    return StableDescriptor(
+        absolute_path=Path(data["absolute_path"]), inputs=inputs, targets=targets
+    )
+
+
+def _digests_to_json(digests: dict[PurePath, InputDigest]) -> dict:
+    return {
+        str(path): [input_digest.digest, input_digest.mode, input_digest.size]
+        for path, input_digest in digests.items()
+    }
+
+
+def _digests_from_json(data: dict) -> dict[PurePath, InputDigest]:
+    return {
+        PurePath(path): InputDigest(digest=digest, mode=mode, size=size)
+        for path, (digest, mode, size) in data.items()
+    }
+
+
+def _content_id_to_json(content_id: ContentId) -> dict:
+    return {
+        "digest": content_id.digest,
+        "files": _digests_to_json(content_id.files),
+        "builders": _digests_to_json(content_id.builders),
+        "scheme": content_id.scheme,
+        "algorithm": content_id.algorithm,
+    }
+
+
+def _content_id_from_json(data: dict) -> ContentId:
+    return ContentId(
+        digest=data["digest"],
+        files=_digests_from_json(data["files"]),
+        builders=_digests_from_json(data["builders"]),
+        scheme=data["scheme"],
+        algorithm=data["algorithm"],
+    )
+
+
+def _request(path: Path, request: dict, timeout: Optional[float] = None) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(path))
+        sock.sendall(json.dumps(request).encode())
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(64 * 1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return json.loads(b"".join(chunks))
+
+
+def query_daemon(
+    path: str | Path, env: StableEnvironment, hashing: HashOptions
+) -> Optional[StableDescriptor]:
+    """Ask a running daemon for the descriptor at ``path`` and its content id.
+
+    Returns None when no daemon is running, it is disabled with
+    ``REBUILDR_DAEMON=0`` or it fails, so callers load the descriptor
+    themselves.
+    """
+    if not env_flag("REBUILDR_DAEMON", True):
+        return None
+    sock_path = socket_path()
+    if not sock_path.exists():
+        return None
+
+    request = {
+        "version": _PROTOCOL_VERSION,
+        "op": "content_id",
+        "path": os.path.abspath(path),
+        "root_dir_override": os.environ.get("REBUILDR_OVERRIDE_ROOT_DIR"),
+        "env": dict(env.env),
+        "build_args": dict(env.build_args),
+        "hashing": asdict(hashing),
+    }
+    started = time.monotonic()
+    try:
+        response = _request(sock_path, request, _QUERY_TIMEOUT_SECONDS)
+    except (OSError, ValueError) as e:
+        logging.debug(f"Rebuildr daemon at {sock_path} is not available: {e}")
+        return None
+    if "error" in response:
+        logging.warning(f"Rebuildr daemon failed, hashing locally: {response['error']}")
+        return None
+
+    desc = _descriptor_from_json(response["descriptor"])
+    desc.inputs.remember_content_id(env, _content_id_from_json(response["content_id"]))
+    logging.info(
+        f"Content id of {path} from daemon in {(time.monotonic() - started) * 1000:.1f}ms"
+    )
+    return desc
+
+
+@dataclass
+class _Registration:
+    path: str
+    root_dir_override: Optional[str]
+    hashing: HashOptions
+    desc: Optional[StableDescriptor] = None
+    # (url, ref, resolved commit) of GitRepoInput externals
+    refs: list[tuple[str, str, str]] = field(default_factory=list)
+    dirty: bool = True
+    changed_at: float = 0.0
+    # environment of the last query, used to hash again after changes
+    last_env: Optional[StableEnvironment] = None
+
+
+class Daemon(object):
+    """Keeps content ids of registered rebuildr files up to date.
+
+    A rebuildr file is registered by the first query for it. Its root, glob
+    roots and the directories of all resolved inputs are watched with
+    inotify; any change marks the registration dirty, and it is loaded and
+    hashed again once the changes settle. Hashing goes through the digest
+    cache, so only changed files are read. Queries are answered from memory
+    while nothing changed.
+
+    Pending inotify events are drained before every answer. The kernel
+    queues events when the write happens, so a change a client made before
+    its query is never missed.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._inotify = Inotify()
+        self._registrations: dict[str, _Registration] = {}
+        self._wd_dirs: dict[int, Path] = {}
+        self._dir_wds: dict[Path, int] = {}
+        # registration keys interested in each watched directory
+        self._dir_keys: dict[Path, set[str]] = {}
+        # registration keys that watch new subdirectories of a directory too
+        self._dir_recursive_keys: dict[Path, set[str]] = {}
+        self._stopped = False
+        # the digest cache is written while hashing and must not trigger events
+        self._cache_dir = cache_dir()
+        self._socket = self._listen(path)
+
+    @staticmethod
+    def _listen(path: Path) -> socket.socket:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.exists():
+            try:
+                _request(path, {"version": _PROTOCOL_VERSION, "op": "ping"}, 1)
+            except (OSError, ValueError):
+                os.unlink(path)
+            else:
+                raise RuntimeError(f"Rebuildr daemon is already running at {path}")
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        original_umask = os.umask(0o077)
+        try:
+            sock.bind(str(path))
+        finally:
+            os.umask(original_umask)
+        sock.listen(16)
+        return sock
+
+    def serve_forever(self):
+        logging.info(f"Rebuildr daemon listening on {self.path}")
+        try:
+            while not self._stopped:
+                readable, _, _ = select.select(
+                    [self._socket, self._inotify.fd], [], [], _SETTLE_SECONDS / 2
+                )
+                self._drain()
+                if self._socket in readable:
+                    self._accept()
+                self._refresh_settled()
+        finally:
+            self.close()
+
+    def stop(self):
+        self._stopped = True
+
+    def close(self):
+        self._socket.close()
+        self._inotify.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _accept(self):
+        conn, _ = self._socket.accept()
+        with conn:
+            chunks = []
+            while True:
+                chunk = conn.recv(64 * 1024)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            try:
+                response = self._handle(json.loads(b"".join(chunks)))
+            except Exception as e:
+                logging.exception("Rebuildr daemon request failed")
+                response = {"error": str(e)}
+            try:
+                conn.sendall(json.dumps(response).encode())
+            except OSError as e:
+                logging.warning(f"Failed to answer rebuildr daemon client: {e}")
+
+    def _handle(self, request: dict) -> dict:
+        if request.get("version") != _PROTOCOL_VERSION:
+            raise ValueError(f"Unsupported protocol version {request.get('version')}")
+        if request["op"] == "ping":
+            return {"pong": True}
+        if request["op"] == "stop":
+            self.stop()
+            return {"stopped": True}
+        if request["op"] == "content_id":
+            return self._content_id(request)
+        raise ValueError(f"Unknown request {request['op']}")
+
+    def _content_id(self, request: dict) -> dict:
+        started = time.monotonic()
+        hashing = HashOptions(**request["hashing"])
+        key = json.dumps(
+            [request["path"], request["root_dir_override"], asdict(hashing)]
+        )
+        registration = self._registrations.get(key)
+        if registration is None:
+            registration = _Registration(
+                path=request["path"],
+                root_dir_override=request["root_dir_override"],
+                hashing=hashing,
+            )
+            self._registrations[key] = registration
+        env = StableEnvironment(request["env"], request["build_args"])
+        registration.last_env = env
+
+        for _ in range(_MAX_ATTEMPTS):
+            if self._refs_moved(registration):
+                registration.dirty = True
+            if registration.dirty or registration.desc is None:
+                self._load(key, registration)
+            content_id = registration.desc.content_id(env)
+            self._drain()
+            if not registration.dirty:
+                logging.info(
+                    f"Content id of {registration.path} in {(time.monotonic() - started) * 1000:.1f}ms"
+                )
+                return {
+                    "descriptor": _descriptor_to_json(registration.desc),
+                    "content_id": _content_id_to_json(content_id),
+                }
+        raise RuntimeError(f"Inputs of {registration.path} keep changing")
+
+    def _load(self, key: str, registration: _Registration):
+        from rebuildr.cli import exec_py_desc, py_desc_root_dir
+
+        # events from here on mark the registration dirty again
+        registration.dirty = False
+        registration.desc = None
+        self._unwatch(key)
+
+        descriptor_path = Path(registration.path)
+        root = py_desc_root_dir(descriptor_path, registration.root_dir_override)
+        self._watch(key, descriptor_path.parent, recursive=False)
+        descriptor = exec_py_desc(descriptor_path)
+        # glob roots are watched before globbing so no new file is missed
+        for glob_root in self._glob_roots(descriptor, root):
+            self._watch(key, glob_root, recursive=True)
+
+        lock = RefLock.load(lock_path(descriptor_path))
+        desc = StableDescriptor.from_descriptor(
+            descriptor, root, registration.hashing, lock
+        )
+        for file_dep in desc.inputs.files + desc.inputs.builders:
+            self._watch(key, file_dep.absolute_src_path.parent, recursive=False)
+            # changes to symlink targets are reported in the target's directory
+            real_path = Path(os.path.realpath(file_dep.absolute_src_path))
+            if real_path != file_dep.absolute_src_path:
+                self._watch(key, real_path.parent, recursive=False)
+
+        # locked refs only change with the lock file, which is watched with
+        # the descriptor's directory
+        unlocked = set(lock.unlocked(git_refs(descriptor)))
+        registration.refs = [
+            (dep.url, dep.ref, stable_dep.commit)
+            for dep, stable_dep in zip(descriptor.inputs.external, desc.inputs.external)
+            if isinstance(dep, GitRepoInput) and (dep.url, dep.ref) in unlocked
+        ]
+        registration.desc = desc
+
+    @staticmethod
+    def _glob_roots(descriptor: Descriptor, root: Path) -> list[Path]:
+        glob_roots = {root}
+        for dep in descriptor.inputs.files + descriptor.inputs.builders:
+            if isinstance(dep, GlobInput) and dep.root_dir is not None:
+                glob_roots.add(Path(os.path.normpath(root / dep.root_dir)))
+        return sorted(glob_roots)
+
+    def _refs_moved(self, registration: _Registration) -> bool:
+        # refs of remote repositories can move without any local event
+        resolved = git_ls_remote_all([(url, ref) for url, ref, _ in registration.refs])
+        return any(
+            new_commit != commit
+            for new_commit, (_, _, commit) in zip(resolved, registration.refs)
+        )
+
+    def _watch(self, key: str, directory: Path, recursive: bool):
+        pending = [directory]
+        while len(pending) > 0:
+            current = pending.pop()
+            if current == self._cache_dir:
+                continue
+            if current not in self._dir_wds:
+                try:
+                    wd = self._inotify.add_watch(current)
+                except OSError as e:
+                    if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                        continue
+                    if e.errno == errno.ENOSPC:
+                        raise RuntimeError(
+                            f"Out of inotify watches while watching {current}, raise fs.inotify.max_user_watches"
+                        )
+                    raise
+                self._wd_dirs[wd] = current
+                self._dir_wds[current] = wd
+            self._dir_keys.setdefault(current, set()).add(key)
+            if not recursive:
+                continue
+            self._dir_recursive_keys.setdefault(current, set()).add(key)
+            try:
+                entries = list(os.scandir(current))
+            except OSError:
+                continue
+            for entry in entries:
+                # git's own bookkeeping is no input but changes on every git command
+                if entry.name != ".git" and entry.is_dir(follow_symlinks=False):
+                    pending.append(Path(entry.path))
+
+    def _unwatch(self, key: str):
+        for directory in list(self._dir_keys):
+            keys = self._dir_keys[directory]
+            keys.discard(key)
+            self._dir_recursive_keys.get(directory, set()).discard(key)
+            if len(keys) == 0:
+                self._forget_dir(directory)
+                self._inotify.rm_watch(self._dir_wds.pop(directory))
+
+    def _forget_dir(self, directory: Path):
+        del self._dir_keys[directory]
+        self._dir_recursive_keys.pop(directory, None)
+        wd = self._dir_wds.get(directory)
+        if wd is not None:
+            self._wd_dirs.pop(wd, None)
+
+    def _mark_dirty(self, keys):
+        now = time.monotonic()
+        for key in keys:
+            registration = self._registrations.get(key)
+            if registration is not None:
+                registration.dirty = True
+                registration.changed_at = now
+
+    def _drain(self):
+        for wd, mask, name in self._inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("inotify queue overflowed, rehashing everything")
+                self._mark_dirty(list(self._registrations))
+                continue
+            directory = self._wd_dirs.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                # the directory is gone, its parent reported the removal
+                self._mark_dirty(self._dir_keys.get(directory, ()))
+                self._forget_dir(directory)
+                self._dir_wds.pop(directory, None)
+                continue
+            self._mark_dirty(self._dir_keys.get(directory, ()))
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                for key in list(self._dir_recursive_keys.get(directory, ())):
+                    self._watch(key, directory / name, recursive=True)
+
+    def _refresh_settled(self):
+        """Hash dirty registrations again once their inputs stopped changing."""
+        now = time.monotonic()
+        for key, registration in list(self._registrations.items()):
+            if not registration.dirty or registration.last_env is None:
+                continue
+            if now - registration.changed_at < _SETTLE_SECONDS:
+                continue
+            try:
+                self._load(key, registration)
+                registration.desc.content_id(registration.last_env)
+            except Exception as e:
+                # retried and reported by the next query instead of in a loop
+                logging.warning(f"Failed to rehash {registration.path}: {e}")
+                registration.dirty = True
+                registration.last_env = None
+
+
+def run_daemon():
+    daemon = Daemon(socket_path())
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Rebuildr daemon stopped")
@@ -18,6 +18,8 @@ class GlobInput:
     pattern: str
     root_dir: Optional[str | PurePath] = None
     target_path: Optional[str | PurePath] = None
+    # .dockerignore style patterns, relative to root_dir
+    exclude: list[str] = field(default_factory=list)
 
 
 @dataclass
@@ -38,11 +40,15 @@ class GitHubCommitInput:
     repo: str
     commit: str
     target_path: str | PurePath
+    # directory of the repository placed at target_path, the whole repository
+    # when None; only its files are fetched
+    subpath: Optional[str | PurePath] = None
 
     def __post_init__(self):
         logging.debug(f"GitHubCommitInput {self.target_path}")
         validators.target_path_is_set(self.target_path, self.__class__)
         validators.target_path_is_not_root(self.target_path, self.__class__)
+        validators.subpath_is_relative(self.subpath, self.__class__)
 
 
 @dataclass
@@ -50,10 +56,13 @@ class GitRepoInput:
     url: str
     ref: str
     target_path: str | PurePath
+    # directory of the repository placed at target_path, see GitHubCommitInput
+    subpath: Optional[str | PurePath] = None
 
     def __post_init__(self):
         validators.target_path_is_set(self.target_path, self.__class__)
         validators.target_path_is_not_root(self.target_path, self.__class__)
+        validators.subpath_is_relative(self.subpath, self.__class__)
 
 
 @dataclass
@@ -65,6 +74,11 @@ class Inputs:
         default_factory=list
     )
     external: list[str | GitHubCommitInput | GitRepoInput] = field(default_factory=list)
+    # .dockerignore style patterns relative to the descriptor directory, applied
+    # to every glob and directory input
+    exclude: list[str] = field(default_factory=list)
+    # also exclude the patterns of the .dockerignore next to the Dockerfile
+    dockerignore: bool = False
 
 
 @dataclass
@@ -87,3 +101,5 @@ class ImageTarget:
 class Descriptor:
     inputs: Inputs
     targets: Optional[list[ImageTarget]] = None
+    # "sha256" (default) or "blake2b", ids are tagged src-id-b2-<hash> for the latter
+    hash_algorithm: Optional[str] = None
@@ -0,0 +1,165 @@
+import logging
+import os
+from pathlib import Path
+import time
+from typing import Iterable, Optional
+
+from rebuildr.cache import (
+    atomic_write_json,
+    cache_dir,
+    cache_key,
+    file_lock,
+    read_json,
+)
+
+_INDEX_VERSION = 1
+
+# A file whose mtime or ctime is this close to the moment it was hashed may
+# still be written within the same timestamp granule without its stat
+# fingerprint changing ("racy git"), so such digests are never stored.
+RACY_WINDOW_NS = 2_000_000_000
+
+# entries that were not used for this long are dropped when the index is written
+_EXPIRY_DAYS = 30
+
+
+def fingerprint(st: os.stat_result) -> list[int]:
+    return [
+        st.st_dev,
+        st.st_ino,
+        st.st_size,
+        st.st_mtime_ns,
+        st.st_ctime_ns,
+        st.st_mode,
+    ]
+
+
+def _today() -> int:
+    return int(time.time() // 86400)
+
+
+class DigestCache(object):
+    """Persistent map from file path and stat fingerprint to content digest.
+
+    Works like the git index: a file whose (dev, inode, size, mtime, ctime,
+    mode) fingerprint is unchanged since it was hashed is assumed to have the
+    same content, so its digest can be reused after a single ``stat``.
+
+    The index is a JSON file replaced atomically on ``flush``. Concurrent
+    writers merge their updates under a lock file, so several processes can
+    share one cache directory.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._today = _today()
+        self._files: dict[str, dict] = {}
+        self._ids: dict[str, dict] = {}
+        self._updated_files: set[str] = set()
+        self._updated_ids: set[str] = set()
+
+        data = read_json(path)
+        if data is not None and data.get("version") == _INDEX_VERSION:
+            self._files = data.get("files", {})
+            self._ids = data.get("ids", {})
+
+    @staticmethod
+    def for_paths(paths: Iterable[Path]) -> Optional["DigestCache"]:
+        """Open the index shard shared by all inputs below the paths' common root."""
+        paths = [str(path) for path in paths]
+        if len(paths) == 0:
+            return None
+        root = os.path.commonpath(paths)
+        return DigestCache(cache_dir() / "digests" / f"{cache_key(root)}.json")
+
+    def lookup(self, path: Path, st: os.stat_result, algorithm: str) -> Optional[str]:
+        entry = self._files.get(str(path))
+        if entry is None or entry.get("fingerprint") != fingerprint(st):
+            return None
+        digest = entry.get(algorithm)
+        if digest is not None:
+            self._touch(entry, self._updated_files, str(path))
+        return digest
+
+    def store(
+        self,
+        path: Path,
+        st: os.stat_result,
+        algorithm: str,
+        digest: str,
+        started_ns: int,
+    ):
+        """Record ``digest`` for ``path`` as it was when ``st`` was taken.
+
+        ``started_ns`` is the wall clock time taken before the file was
+        stat'ed and read; digests of files modified shortly before it are not
+        stored to stay clear of racy timestamps.
+        """
+        if max(st.st_mtime_ns, st.st_ctime_ns) >= started_ns - RACY_WINDOW_NS:
+            return
+
+        key = str(path)
+        entry = self._files.get(key)
+        if entry is None or entry.get("fingerprint") != fingerprint(st):
+            entry = {"fingerprint": fingerprint(st)}
+        if entry.get(algorithm) == digest and entry.get("used") == self._today:
+            return
+        entry[algorithm] = digest
+        entry["used"] = self._today
+        self._files[key] = entry
+        self._updated_files.add(key)
+
+    def lookup_id(self, key: str) -> Optional[str]:
+        entry = self._ids.get(key)
+        if entry is None:
+            return None
+        self._touch(entry, self._updated_ids, key)
+        return entry.get("digest")
+
+    def store_id(self, key: str, digest: str):
+        entry = self._ids.get(key)
+        if entry is not None and entry.get("digest") == digest:
+            self._touch(entry, self._updated_ids, key)
+            return
+        self._ids[key] = {"digest": digest, "used": self._today}
+        self._updated_ids.add(key)
+
+    def _touch(self, entry: dict, updated: set[str], key: str):
+        if entry.get("used") != self._today:
+            entry["used"] = self._today
+            updated.add(key)
+
+    def flush(self):
+        """Merge the updates made by this process into the on-disk index."""
+        if len(self._updated_files) == 0 and len(self._updated_ids) == 0:
+            return
+
+        try:
+            with file_lock(self.path.with_suffix(".lock")):
+                data = read_json(self.path)
+                if data is None or data.get("version") != _INDEX_VERSION:
+                    data = {"version": _INDEX_VERSION, "files": {}, "ids": {}}
+                files = self._merge(
+                    data.get("files", {}), self._files, self._updated_files
+                )
+                ids = self._merge(data.get("ids", {}), self._ids, self._updated_ids)
+                atomic_write_json(
+                    self.path,
+                    {"version": _INDEX_VERSION, "files": files, "ids": ids},
+                )
+        except OSError as e:
+            logging.warning(f"Failed to write digest cache {self.path}: {e}")
+            return
+
+        self._updated_files.clear()
+        self._updated_ids.clear()
+
+    def _merge(self, on_disk: dict, ours: dict, updated: set[str]) -> dict:
+        merged = {
+            key: entry
+            for key, entry in on_disk.items()
+            if self._today - entry.get("used", 0) <= _EXPIRY_DAYS
+        }
+        for key in updated:
+            merged[key] = ours[key]
+        return merged
@@ -0,0 +1,154 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import tempfile
+import time
+from typing import Optional
+
+from rebuildr.cache import cache_dir, cache_key
+from rebuildr.stable_descriptor import ContentId, StableEnvironment, StableInputs
+
+_MANIFEST_VERSION = 1
+
+# manifests that were not written or read for this long are removed
+_EXPIRY_SECONDS = 30 * 86400
+
+
+def _manifests_dir() -> Path:
+    return cache_dir() / "manifests"
+
+
+def _value_digest(value: Optional[str]) -> str:
+    # env values may be secrets, only their digest is kept
+    if value is None:
+        return "unset"
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+def input_manifest(
+    inputs: StableInputs, content_id: ContentId, env: StableEnvironment
+) -> dict[str, str]:
+    """Flat map from input name to the digest it contributed to ``content_id``."""
+    manifest = {}
+    for path, input_digest in content_id.files.items():
+        manifest[f"files/{path}"] = f"{input_digest.mode:o} {input_digest.digest}"
+    for path, input_digest in content_id.builders.items():
+        manifest[f"builders/{path}"] = f"{input_digest.mode:o} {input_digest.digest}"
+    for env_dep in inputs.envs:
+        manifest[f"envs/{env_dep.key}"] = _value_digest(env_dep.value(env))
+    for build_arg_dep in inputs.build_args:
+        manifest[f"build_args/{build_arg_dep.key}"] = _value_digest(
+            build_arg_dep.value(env)
+        )
+    for external_dep in inputs.external:
+        value = f"{external_dep.url} {external_dep.commit}"
+        if external_dep.subpath is not None:
+            value += f" {external_dep.subpath.as_posix()}"
+        manifest[f"external/{external_dep.target_path}"] = value
+    return manifest
+
+
+def save_manifest(tag: str, manifest: dict[str, str]):
+    """Store the manifest of content id ``tag`` unless it is already stored."""
+    path = _manifests_dir() / f"{tag}.json.gz"
+    try:
+        if path.exists():
+            os.utime(path)
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+        with os.fdopen(fd, "wb") as f:
+            with gzip.GzipFile(fileobj=f, mode="wb", mtime=0) as gz:
+                gz.write(
+                    json.dumps(
+                        {"version": _MANIFEST_VERSION, "tag": tag, "inputs": manifest},
+                        sort_keys=True,
+                        separators=(",", ":"),
+                    ).encode()
+                )
+        os.replace(tmp_path, path)
+        _prune_manifests()
+    except OSError as e:
+        logging.warning(f"Failed to store input manifest for {tag}: {e}")
+
+
+def _prune_manifests():
+    cutoff = time.time() - _EXPIRY_SECONDS
+    for entry in os.scandir(_manifests_dir()):
+        if entry.is_file() and entry.stat().st_mtime < cutoff:
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                pass
+
+
+def normalize_content_id(value: str) -> str:
+    """Turn a digest, a ``src-id-`` tag or a full image reference into a tag."""
+    index = value.find("src-id-")
+    if index >= 0:
+        return value[index:]
+    return f"src-id-{value}"
+
+
+def load_manifest(content_id: str) -> Optional[dict[str, str]]:
+    tag = normalize_content_id(content_id)
+    path = _manifests_dir() / f"{tag}.json.gz"
+    try:
+        with gzip.open(path, "rb") as f:
+            data = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    if data.get("version") != _MANIFEST_VERSION:
+        return None
+    return data["inputs"]
+
+
+def _last_build_path(descriptor_path: Path) -> Path:
+    return _manifests_dir() / "last" / cache_key(str(descriptor_path.resolve()))
+
+
+def record_last_build(descriptor_path: Path, tag: str):
+    path = _last_build_path(descriptor_path)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(tag)
+    except OSError as e:
+        logging.warning(f"Failed to record last build of {descriptor_path}: {e}")
+
+
+def last_build(descriptor_path: Path) -> Optional[str]:
+    try:
+        return _last_build_path(descriptor_path).read_text().strip()
+    except OSError:
+        return None
+
+
+def diff_manifests(old: dict[str, str], new: dict[str, str]) -> list[str]:
+    """Describe every input that differs between two manifests, sorted by name."""
+    lines = []
+    for name in sorted(old.keys() | new.keys()):
+        old_value = old.get(name)
+        new_value = new.get(name)
+        if old_value == new_value:
+            continue
+        if old_value is None:
+            lines.append(f"added    {name}")
+        elif new_value is None:
+            lines.append(f"removed  {name}")
+        elif name.startswith(("files/", "builders/")):
+            old_mode, old_digest = old_value.split(" ", 1)
+            new_mode, new_digest = new_value.split(" ", 1)
+            changes = []
+            if old_mode != new_mode:
+                changes.append(f"mode {old_mode} -> {new_mode}")
+            if old_digest != new_digest:
+                changes.append("content")
+            lines.append(f"changed  {name} ({', '.join(changes)})")
+        elif name.startswith("external/"):
+            lines.append(f"changed  {name} ({old_value} -> {new_value})")
+        else:
+            lines.append(f"changed  {name} (value)")
+    return lines
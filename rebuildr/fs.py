@@ -1,72 +1,379 @@
-from pathlib import Path
-import shutil
+from functools import partial
+import io
+import os
+from pathlib import Path, PurePath
+import secrets
+import stat
+import sys
 import tarfile
-import tempfile
+from typing import BinaryIO, Callable, Optional
 
+from rebuildr.compress import CompressOptions, compressed_writer
 from rebuildr.stable_descriptor import (
+    ContentId,
     StableDescriptor,
+    StableFileInput,
+    StableGitHubCommitInput,
+    StableGitRepoInput,
 )
+from rebuildr.tools.git import (
+    EXTERNAL_MTIME,
+    git_archive,
+    git_fetch_to_cache,
+    run_concurrently,
+)
+from rebuildr.verify import InputCheck, InputVerifier
+
+# directory of a streamed build context holding the builder files (e.g. the
+# Dockerfile), apart from the input files at the root of the context; it is
+# ignored by the build, so COPY sees the same files as in a staged context
+STREAM_BUILDERS_DIR = ".rebuildr-builders"
+
+
+# modification time of every entry written by ``TarContext``
+TAR_MTIME = 0
+_DIR_MODE = 0o755
+
+
+class _CheckedReader(object):
+    """Passes what tarfile reads from an input file on to an ``InputCheck``."""
+
+    def __init__(self, f: BinaryIO, check: InputCheck):
+        self.f = f
+        self.check = check
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.f.read(size)
+        self.check.update(data)
+        return data
+
+
+def _add_checked(
+    tar: tarfile.TarFile,
+    info: tarfile.TarInfo,
+    f: BinaryIO,
+    st: os.stat_result,
+    check: Optional[InputCheck],
+):
+    if check is None:
+        tar.addfile(info, f)
+        return
+    check.start(st)
+    tar.addfile(info, _CheckedReader(f, check))
+    check.finish(os.fstat(f.fileno()))
+
+
+def _tar_sort_key(arcname: str) -> tuple[str, ...]:
+    # parents sort before their children, siblings by name
+    return tuple(arcname.split("/"))
 
 
 class TarContext(object):
-    def __init__(self):
-        self.temp_file = tempfile.NamedTemporaryFile()
-        self.temp_file_path = Path(self.temp_file.name)
-        self.tar = tarfile.open(self.temp_file_path, "w:")
+    """Writes the build context of a descriptor as a reproducible tar stream.
 
-    def _add_file(self, src_path: Path, arcname: Path):
-        """Add a single file to the tar archive ensuring parent directories exist.
+    Entries are written straight to ``out`` while the input files are read,
+    in sorted order, each preceded by its parent directories. Headers only
+    carry what the content id covers: the path, size and permission bits,
+    with a fixed modification time and no ownership, so descriptors with the
+    same content id produce byte-identical archives.
+    """
 
-        The tarfile module does not automatically include parent directories if
-        they are not explicitly added. This helper makes sure the final archive
-        structure matches the one created by LocalContext/prepare_from_descriptor.
-        """
+    def __init__(self, out: BinaryIO):
+        self.tar = tarfile.open(fileobj=out, mode="w|", format=tarfile.PAX_FORMAT)
+        self._dirs: set[str] = set()
 
-        # Ensure arcname is always presented as a posix path inside the archive
-        arcname = Path(str(arcname)).as_posix()
-        self.tar.add(src_path, arcname=arcname)
-
-    def __del__(self):
-        """Clean up resources when object is destroyed"""
-        if hasattr(self, "tar") and self.tar:
-            try:
-                self.tar.close()
-            except Exception:
-                pass
-        if hasattr(self, "temp_file") and self.temp_file:
-            try:
-                self.temp_file.close()
-            except Exception:
-                pass
-
-    def prepare_from_descriptor(self, descriptor: StableDescriptor):
-        """Populate the internal tar file using the descriptor inputs.
-
-        Only StableFileInput instances have an `absolute_src_path` attribute.
-        Builders can contain other dependency types (eg. StableEnvInput) which
-        should be ignored for tar creation purposes. We therefore silently skip
-        objects without the expected attributes.
-        """
+    def __enter__(self) -> "TarContext":
+        return self
 
-        # Regular file inputs
-        for file in descriptor.inputs.files:
-            if hasattr(file, "absolute_src_path") and hasattr(file, "target_path"):
-                self._add_file(file.absolute_src_path, file.target_path)
-
-        # Builder file inputs (e.g. Dockerfiles) should also be included so that
-        # the resulting context can be fed directly to `docker build`.
-        for builder in descriptor.inputs.builders:
-            # StableFileInput is the only builder variant that carries file data
-            if hasattr(builder, "absolute_src_path") and hasattr(
-                builder, "target_path"
-            ):
-                self._add_file(builder.absolute_src_path, builder.target_path)
-
-    def copy_to_file(self, path: Path):
+    def __exit__(self, exc_type, exc, tb):
+        # like TarFile, only a successful archive gets its end-of-archive
+        # marker
+        self.tar.__exit__(exc_type, exc, tb)
+
+    def close(self):
+        self.tar.close()
+
+    def _add_parents(self, arcname: str):
+        parts = arcname.split("/")[:-1]
+        for i in range(1, len(parts) + 1):
+            dirname = "/".join(parts[:i])
+            if dirname in self._dirs:
+                continue
+            info = tarfile.TarInfo(dirname)
+            info.type = tarfile.DIRTYPE
+            info.mode = _DIR_MODE
+            info.mtime = TAR_MTIME
+            self.tar.addfile(info)
+            self._dirs.add(dirname)
+
+    def _add_file(
+        self, src_path: Path, arcname: str, check: Optional[InputCheck] = None
+    ):
+        self._add_parents(arcname)
         try:
-            self.tar.close()
-            shutil.copyfile(self.temp_file_path, path)
-            # reopen file
-            self.tar = tarfile.open(self.temp_file_path, "a:")
+            with open(src_path, "rb") as f:
+                st = os.fstat(f.fileno())
+                info = tarfile.TarInfo(arcname)
+                info.size = st.st_size
+                info.mode = stat.S_IMODE(st.st_mode)
+                info.mtime = TAR_MTIME
+                _add_checked(self.tar, info, f, st, check)
         except (OSError, IOError, tarfile.TarError) as e:
-            raise RuntimeError(f"Failed to copy tar file to {path}: {e}")
+            raise RuntimeError(f"Failed to add {src_path} to the tar archive: {e}")
+
+    def prepare_from_descriptor(
+        self, descriptor: StableDescriptor, content_id: Optional[ContentId] = None
+    ):
+        """Write the input and builder files of ``descriptor`` to the archive.
+
+        Builder files (e.g. Dockerfiles) are included next to the inputs so
+        that the archive can be fed directly to ``docker build``; a builder
+        replaces an input file with the same target path, as in a staged
+        context. With ``content_id`` every file is verified against it while
+        it is written.
+        """
+        verifier = InputVerifier(content_id) if content_id is not None else None
+        entries: dict[str, tuple[Path, Optional[InputCheck]]] = {}
+        for builder, deps in (
+            (False, descriptor.inputs.files),
+            (True, descriptor.inputs.builders),
+        ):
+            for file in deps:
+                # StableFileInput is the only builder variant that carries file data
+                if isinstance(file, StableFileInput):
+                    check = None
+                    if verifier is not None:
+                        check = verifier.check(
+                            file.absolute_src_path, file.target_path, builder
+                        )
+                    entries[file.target_path.as_posix()] = (
+                        file.absolute_src_path,
+                        check,
+                    )
+
+        for arcname in sorted(entries, key=_tar_sort_key):
+            src_path, check = entries[arcname]
+            self._add_file(src_path, arcname, check)
+
+
+def _write_compressed_tar(
+    descriptor: StableDescriptor,
+    out: BinaryIO,
+    compress: CompressOptions,
+    content_id: Optional[ContentId],
+):
+    with compressed_writer(out, compress) as writer, TarContext(writer) as ctx:
+        ctx.prepare_from_descriptor(descriptor, content_id)
+
+
+def write_tar(
+    descriptor: StableDescriptor,
+    output: str,
+    compress: CompressOptions = CompressOptions(),
+    content_id: Optional[ContentId] = None,
+):
+    """Write the tar archive of ``descriptor`` to ``output``, ``-`` for stdout.
+
+    Regular files are written to a temporary file next to them that replaces
+    them once the archive is complete, so a failure leaves an existing file
+    untouched. Other existing outputs, e.g. a FIFO or ``/dev/stdout``, are
+    written to directly and never removed.
+    """
+    if output == "-":
+        _write_compressed_tar(descriptor, sys.stdout.buffer, compress, content_id)
+        sys.stdout.buffer.flush()
+        return
+
+    if os.path.exists(output) and not stat.S_ISREG(os.stat(output).st_mode):
+        with open(output, "wb") as out:
+            _write_compressed_tar(descriptor, out, compress, content_id)
+        return
+
+    # a symlink to a regular file keeps pointing to the replaced file
+    target = Path(os.path.realpath(output))
+    tmp_path = target.parent / f".{target.name}.{secrets.token_hex(8)}.tmp"
+    # created like open() would, with the mode allowed by the umask
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            _write_compressed_tar(descriptor, out, compress, content_id)
+        os.replace(tmp_path, target)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _file_tarinfo(arcname: str, st: os.stat_result) -> tarfile.TarInfo:
+    # ownership is dropped so the archive does not depend on who built it,
+    # modes and modification times are kept like in a staged context
+    info = tarfile.TarInfo(arcname)
+    info.size = st.st_size
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.mtime = st.st_mtime
+    return info
+
+
+def _add_input_file(
+    tar: tarfile.TarFile,
+    src_path: Path,
+    arcname: str,
+    check: Optional[InputCheck] = None,
+):
+    try:
+        with open(src_path, "rb") as f:
+            st = os.fstat(f.fileno())
+            _add_checked(tar, _file_tarinfo(arcname, st), f, st, check)
+    except (OSError, IOError) as e:
+        raise RuntimeError(f"Failed to add {src_path} to the build context: {e}")
+
+
+def _read_checked(src_path: Path, check: Optional[InputCheck] = None) -> bytes:
+    try:
+        with open(src_path, "rb") as f:
+            st = os.fstat(f.fileno())
+            if check is None:
+                return f.read()
+            check.start(st)
+            data = _CheckedReader(f, check).read()
+            check.finish(os.fstat(f.fileno()))
+            return data
+    except (OSError, IOError) as e:
+        raise RuntimeError(f"Failed to read {src_path}: {e}")
+
+
+def _add_bytes(tar: tarfile.TarFile, arcname: str, data: bytes):
+    info = tarfile.TarInfo(arcname)
+    info.size = len(data)
+    info.mode = 0o644
+    info.mtime = TAR_MTIME
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _add_external(
+    tar: tarfile.TarFile,
+    url: str,
+    commit: str,
+    target_path: PurePath,
+    subpath: Optional[PurePath],
+):
+    repo_path = git_fetch_to_cache(url, commit, subpath)
+    with git_archive(repo_path, commit, subpath) as p:
+        with tarfile.open(fileobj=p.stdout, mode="r|") as archive:
+            for member in archive:
+                member.name = (target_path / member.name).as_posix()
+                # like the files of a staged external
+                member.mtime = EXTERNAL_MTIME
+                member.uid = member.gid = 0
+                member.uname = member.gname = ""
+                tar.addfile(
+                    member, archive.extractfile(member) if member.isfile() else None
+                )
+    if p.returncode != 0:
+        raise RuntimeError(f"git archive of {commit} from {url} failed")
+
+
+def _stream_ignore_rules(
+    descriptor: StableDescriptor,
+    ignore_path: PurePath,
+    check: Callable[[StableFileInput, bool], Optional[InputCheck]],
+) -> bytes:
+    """The rules a staged build applies, followed by one for the builders.
+
+    Those are the rules of the ignore file next to the Dockerfile, or else
+    of ``.dockerignore`` at the root of the context.
+    """
+    sources = [
+        (builder, True)
+        for builder in descriptor.inputs.builders
+        if isinstance(builder, StableFileInput) and builder.target_path == ignore_path
+    ] + [
+        (file, False)
+        for file in descriptor.inputs.files
+        if file.target_path == PurePath(".dockerignore")
+    ]
+    rules = b""
+    if len(sources) > 0:
+        file, builder = sources[0]
+        rules = _read_checked(file.absolute_src_path, check(file, builder))
+    if len(rules) > 0 and not rules.endswith(b"\n"):
+        rules += b"\n"
+    return rules + f"/{STREAM_BUILDERS_DIR}\n".encode()
+
+
+def write_context_tar(
+    descriptor: StableDescriptor,
+    out: BinaryIO,
+    content_id: Optional[ContentId] = None,
+    dockerfile: Optional[PurePath] = None,
+):
+    """Write the build context of ``descriptor`` to ``out`` as a tar stream.
+
+    Input files and external repositories are at their target paths, as in
+    the ``src`` directory of a staged ``LocalContext``. Builder files are
+    below ``STREAM_BUILDERS_DIR``, with ``dockerfile`` they come with an
+    ignore file for it that hides them from the build. Files are read one at
+    a time while the archive is written, nothing is staged on disk. With
+    ``content_id`` every file is verified against it while it is written.
+    """
+    verifier = InputVerifier(content_id) if content_id is not None else None
+
+    def check(file: StableFileInput, builder: bool) -> Optional[InputCheck]:
+        if verifier is None:
+            return None
+        return verifier.check(file.absolute_src_path, file.target_path, builder)
+
+    externals = [
+        external
+        for external in descriptor.inputs.external
+        if isinstance(external, (StableGitHubCommitInput, StableGitRepoInput))
+    ]
+    builders = [
+        builder
+        for builder in descriptor.inputs.builders
+        if isinstance(builder, StableFileInput)
+    ]
+    ignore_path = None if dockerfile is None else PurePath(f"{dockerfile}.dockerignore")
+    # fetched concurrently up front, then archived from the cache in order
+    run_concurrently(
+        [
+            partial(git_fetch_to_cache, external.url, external.commit, external.subpath)
+            for external in externals
+        ]
+    )
+    with tarfile.open(fileobj=out, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        # manifests are sorted by target path
+        for file in descriptor.inputs.files:
+            _add_input_file(
+                tar,
+                file.absolute_src_path,
+                file.target_path.as_posix(),
+                check(file, builder=False),
+            )
+
+        for external in externals:
+            _add_external(
+                tar,
+                external.url,
+                external.commit,
+                PurePath(external.target_path),
+                external.subpath,
+            )
+
+        for builder in builders:
+            if builder.target_path != ignore_path:
+                _add_input_file(
+                    tar,
+                    builder.absolute_src_path,
+                    (PurePath(STREAM_BUILDERS_DIR) / builder.target_path).as_posix(),
+                    check(builder, builder=True),
+                )
+
+        if ignore_path is not None:
+            _add_bytes(
+                tar,
+                (PurePath(STREAM_BUILDERS_DIR) / ignore_path).as_posix(),
+                _stream_ignore_rules(descriptor, ignore_path, check),
+            )
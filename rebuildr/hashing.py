@@ -0,0 +1,155 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import hashlib
+import os
+from pathlib import Path
+import threading
+from typing import Iterator, Optional
+
+# size of the buffer files are read through while hashing
+CHUNK_SIZE = 1 << 20
+
+# files up to this size are read by the prefetch workers and handed over in
+# memory, larger ones are only hinted to the kernel and streamed by the caller
+INLINE_LIMIT = 4 * CHUNK_SIZE
+
+# algorithms content ids can be computed with
+HASH_SHA256 = "sha256"
+HASH_BLAKE2B = "blake2b"
+HASH_ALGORITHMS = (HASH_SHA256, HASH_BLAKE2B)
+
+
+def new_hasher(algorithm: str = HASH_SHA256):
+    """Return a fresh hash object for one of ``HASH_ALGORITHMS``.
+
+    BLAKE2b is truncated to 32 bytes so its digests are as long as SHA-256
+    ones and tags stay well within the docker tag length limit.
+    """
+    if algorithm == HASH_SHA256:
+        return hashlib.sha256()
+    if algorithm == HASH_BLAKE2B:
+        return hashlib.blake2b(digest_size=32)
+    raise ValueError(
+        f"Unknown hash algorithm {algorithm}, expected one of {', '.join(HASH_ALGORITHMS)}"
+    )
+
+
+_buffers = threading.local()
+
+
+def _thread_buffer() -> bytearray:
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None:
+        buffer = bytearray(CHUNK_SIZE)
+        _buffers.buffer = buffer
+    return buffer
+
+
+def hash_file(path: Path, hashers) -> int:
+    """Stream the content of ``path`` into every hasher in ``hashers``.
+
+    The file is read through a preallocated per-thread buffer, so peak memory
+    does not depend on the file size. Returns the number of bytes read.
+    """
+    buffer = _thread_buffer()
+    view = memoryview(buffer)
+    size = 0
+    try:
+        with open(path, "rb", buffering=0) as f:
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                chunk = view[:n]
+                for hasher in hashers:
+                    hasher.update(chunk)
+                size += n
+    except (OSError, IOError) as e:
+        raise RuntimeError(f"Failed to read file {path}: {e}")
+    finally:
+        view.release()
+    return size
+
+
+@dataclass
+class PrefetchedFile:
+    st: os.stat_result
+    # content and its digest, None when the file is too large to be kept in memory
+    content: Optional[bytes] = None
+    digest: Optional[str] = None
+
+
+def _prefetch(path: Path, algorithm: str) -> PrefetchedFile:
+    try:
+        with open(path, "rb", buffering=0) as f:
+            st = os.fstat(f.fileno())
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            if st.st_size > INLINE_LIMIT:
+                return PrefetchedFile(st=st)
+            content = f.read()
+    except (OSError, IOError) as e:
+        raise RuntimeError(f"Failed to read file {path}: {e}")
+
+    # hashlib releases the GIL for large updates, so digests are computed in parallel
+    hasher = new_hasher(algorithm)
+    hasher.update(content)
+    return PrefetchedFile(st=st, content=content, digest=hasher.hexdigest())
+
+
+def prefetch_files(
+    paths: list[Path], workers: int, algorithm: str = HASH_SHA256
+) -> Iterator[PrefetchedFile]:
+    """Yield a ``PrefetchedFile`` for every path, in order.
+
+    Files are opened, read and digested by a pool of ``workers`` threads in
+    any order, at most a few files per worker ahead of the consumer, so the
+    ordered consumer rarely waits on I/O while memory stays bounded.
+    """
+    window = workers * 4
+    paths = iter(paths)
+    executor = ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="rebuildr-hash"
+    )
+    try:
+        pending = deque()
+        for path in paths:
+            pending.append(executor.submit(_prefetch, path, algorithm))
+            if len(pending) >= window:
+                break
+
+        while len(pending) > 0:
+            future = pending.popleft()
+            next_path = next(paths, None)
+            if next_path is not None:
+                pending.append(executor.submit(_prefetch, next_path, algorithm))
+            yield future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def file_digest(path: Path, algorithm: str = HASH_SHA256) -> tuple[str, int]:
+    """Return the hex digest and size of the content of ``path``."""
+    hasher = new_hasher(algorithm)
+    size = hash_file(path, (hasher,))
+    return hasher.hexdigest(), size
+
+
+def digest_files(
+    paths: list[Path], workers: int, algorithm: str = HASH_SHA256
+) -> Iterator[tuple[str, int]]:
+    """Yield ``file_digest`` of every path in order, using ``workers`` threads.
+
+    Unlike ``prefetch_files`` nothing but the digests is kept, so all files can
+    be hashed concurrently.
+    """
+    if workers <= 1:
+        for path in paths:
+            yield file_digest(path, algorithm)
+        return
+
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="rebuildr-hash"
+    ) as executor:
+        yield from executor.map(file_digest, paths, [algorithm] * len(paths))
@@ -0,0 +1,120 @@
+import os
+import posixpath
+import re
+from pathlib import Path
+from typing import Optional
+
+
+def _compile(pattern: str) -> re.Pattern:
+    """Translate a .dockerignore pattern into a regular expression.
+
+    ``*`` and ``?`` do not cross ``/``, ``**`` matches any number of
+    directories and ``\\`` escapes the next character.
+    """
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "*":
+            if pattern.startswith("**", i):
+                i += 1
+                if pattern.startswith("/", i + 1):
+                    i += 1
+                    regex += "(.*/)?"
+                else:
+                    regex += ".*"
+            else:
+                regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        elif c == "[":
+            end = pattern.find("]", i + 2)
+            if end < 0:
+                regex += re.escape(c)
+            else:
+                body = pattern[i + 1 : end]
+                if body[0] in "!^":
+                    body = "^" + body[1:]
+                regex += "[" + body.replace("\\", "\\\\") + "]"
+                i = end
+        else:
+            regex += re.escape(c)
+        i += 1
+    return re.compile(f"^{regex}$")
+
+
+class ExcludeRules(object):
+    """Ordered exclude patterns with .dockerignore semantics, relative to ``base``.
+
+    A path is excluded when the last pattern matching it or one of its parent
+    directories is not negated with ``!``. Without negated patterns an
+    excluded directory can never contain included files, so walks skip it.
+    """
+
+    def __init__(self, patterns: list[str], base: Path):
+        self.base = os.fspath(base)
+        self.patterns: list[str] = []
+        self._rules: list[tuple[bool, re.Pattern]] = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if pattern == "" or pattern.startswith("#"):
+                continue
+            negated = pattern.startswith("!")
+            cleaned = posixpath.normpath(pattern[1:] if negated else pattern)
+            cleaned = cleaned.lstrip("/")
+            if cleaned in ("", "."):
+                continue
+            self.patterns.append(("!" if negated else "") + cleaned)
+            self._rules.append((negated, _compile(cleaned)))
+        self.has_negations = any(negated for negated, _ in self._rules)
+
+    def __bool__(self) -> bool:
+        return len(self._rules) > 0
+
+    def _relative(self, path: str) -> Optional[str]:
+        if not path.startswith(self.base + os.sep):
+            return None
+        relative = path[len(self.base) + 1 :]
+        if os.sep != "/":
+            relative = relative.replace(os.sep, "/")
+        return posixpath.normpath(relative)
+
+    def excludes(self, path: str) -> bool:
+        """Whether the file at absolute ``path`` is excluded."""
+        relative = self._relative(path)
+        if relative is None:
+            return False
+        parents = relative.split("/")
+        candidates = ["/".join(parents[: i + 1]) for i in range(len(parents))]
+        excluded = False
+        for negated, regex in self._rules:
+            if any(regex.match(candidate) for candidate in candidates):
+                excluded = not negated
+        return excluded
+
+    def prunes(self, directory: str) -> bool:
+        """Whether nothing below the absolute ``directory`` can be included."""
+        return not self.has_negations and self.excludes(directory)
+
+
+def read_dockerignore(dockerfile_path: Path) -> Optional[list[str]]:
+    """Patterns of the .dockerignore that applies to ``dockerfile_path``, if any.
+
+    Like docker, ``<Dockerfile>.dockerignore`` takes precedence over a
+    ``.dockerignore`` in the same directory.
+    """
+    for path in (
+        dockerfile_path.with_name(dockerfile_path.name + ".dockerignore"),
+        dockerfile_path.parent / ".dockerignore",
+    ):
+        try:
+            with open(path, "r") as f:
+                return f.read().splitlines()
+        except FileNotFoundError:
+            continue
+        except (OSError, IOError) as e:
+            raise RuntimeError(f"Failed to read {path}: {e}")
+    return None
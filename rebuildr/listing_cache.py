@@ -0,0 +1,127 @@
+import logging
+import os
+from pathlib import Path
+import time
+from typing import Optional
+
+from rebuildr.cache import (
+    atomic_write_json,
+    cache_dir,
+    cache_key,
+    file_lock,
+    read_json,
+)
+from rebuildr.digest_cache import RACY_WINDOW_NS
+
+_INDEX_VERSION = 1
+
+# entries that were not used for this long are dropped when the index is written
+_EXPIRY_DAYS = 30
+
+# entry kinds stored per name, symlinks are resolved on every run because
+# retargeting a link elsewhere does not change the directory holding it
+KIND_DIR = "d"
+KIND_FILE = "f"
+KIND_SYMLINK = "l"
+KIND_OTHER = "o"
+
+
+def fingerprint(st: os.stat_result) -> list[int]:
+    return [st.st_dev, st.st_ino, st.st_mtime_ns]
+
+
+def entry_kind(entry: os.DirEntry) -> str:
+    try:
+        if entry.is_symlink():
+            return KIND_SYMLINK
+        if entry.is_dir(follow_symlinks=False):
+            return KIND_DIR
+        if entry.is_file(follow_symlinks=False):
+            return KIND_FILE
+    except OSError:
+        pass
+    return KIND_OTHER
+
+
+def _today() -> int:
+    return int(time.time() // 86400)
+
+
+class ListingCache(object):
+    """Persistent map from directory path and mtime to the names it contains.
+
+    Adding, removing or renaming an entry updates the mtime of the directory
+    holding it, so a directory whose (dev, inode, mtime) fingerprint is
+    unchanged since it was listed still has the same entries and glob
+    expansion can skip reading it. Only the directories that changed are
+    scanned again.
+
+    Like ``DigestCache`` the index is a JSON file replaced atomically on
+    ``flush``, with concurrent writers merging their updates under a lock.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._today = _today()
+        self._started_ns = time.time_ns()
+        self._dirs: dict[str, dict] = {}
+        self._updated: set[str] = set()
+
+        data = read_json(path)
+        if data is not None and data.get("version") == _INDEX_VERSION:
+            self._dirs = data.get("dirs", {})
+
+    @staticmethod
+    def for_root(root: Path) -> "ListingCache":
+        """Open the index shard for the globs of the descriptor at ``root``."""
+        return ListingCache(cache_dir() / "listings" / f"{cache_key(str(root))}.json")
+
+    def lookup(self, dirname: str, st: os.stat_result) -> Optional[dict[str, str]]:
+        """Entry kinds by name of ``dirname``, if it is unchanged since listed."""
+        entry = self._dirs.get(dirname)
+        if entry is None or entry.get("fingerprint") != fingerprint(st):
+            return None
+        if entry.get("used") != self._today:
+            entry["used"] = self._today
+            self._updated.add(dirname)
+        return entry.get("entries")
+
+    def store(self, dirname: str, st: os.stat_result, entries: dict[str, str]):
+        """Record the entries of ``dirname`` as listed after ``st`` was taken.
+
+        Directories modified shortly before this process started are not
+        stored, an entry added within the same timestamp granule would not
+        change their mtime.
+        """
+        if st.st_mtime_ns >= self._started_ns - RACY_WINDOW_NS:
+            return
+        self._dirs[dirname] = {
+            "fingerprint": fingerprint(st),
+            "entries": entries,
+            "used": self._today,
+        }
+        self._updated.add(dirname)
+
+    def flush(self):
+        """Merge the updates made by this process into the on-disk index."""
+        if len(self._updated) == 0:
+            return
+
+        try:
+            with file_lock(self.path.with_suffix(".lock")):
+                data = read_json(self.path)
+                if data is None or data.get("version") != _INDEX_VERSION:
+                    data = {"version": _INDEX_VERSION, "dirs": {}}
+                dirs = {
+                    key: entry
+                    for key, entry in data.get("dirs", {}).items()
+                    if self._today - entry.get("used", 0) <= _EXPIRY_DAYS
+                }
+                for key in self._updated:
+                    dirs[key] = self._dirs[key]
+                atomic_write_json(self.path, {"version": _INDEX_VERSION, "dirs": dirs})
+        except OSError as e:
+            logging.warning(f"Failed to write listing cache {self.path}: {e}")
+            return
+
+        self._updated.clear()
@@ -0,0 +1,118 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Iterable, Optional
+
+from rebuildr.cache import atomic_write_json, cache_dir, cache_key, file_lock
+from rebuildr.descriptor import Descriptor, GitRepoInput
+from rebuildr.tools.git import git_ls_remote_all
+
+LOCKFILE_NAME = "rebuildr.lock"
+
+_LOCKFILE_VERSION = 1
+
+
+def lock_path(descriptor_path: str | Path) -> Path:
+    """The lock file next to the rebuildr file at ``descriptor_path``."""
+    return Path(os.path.abspath(descriptor_path)).parent / LOCKFILE_NAME
+
+
+def git_refs(descriptor: Descriptor) -> list[tuple[str, str]]:
+    """(url, ref) of every ``GitRepoInput`` external, in declaration order."""
+    return [
+        (dep.url, dep.ref)
+        for dep in descriptor.inputs.external
+        if isinstance(dep, GitRepoInput)
+    ]
+
+
+class RefLock(object):
+    """Commits that refs of ``GitRepoInput`` externals are pinned to.
+
+    The lock is a JSON file, ``rebuildr.lock`` next to the rebuildr file,
+    mapping every url to its refs and their commits. Refs found in it are
+    resolved without contacting the remote, so computing a content id needs
+    no network and does not change when a branch moves. The file is shared
+    by all rebuildr files in its directory.
+    """
+
+    def __init__(
+        self,
+        path: Optional[Path] = None,
+        refs: Optional[dict[str, dict[str, str]]] = None,
+    ):
+        self.path = path
+        self.refs: dict[str, dict[str, str]] = refs if refs is not None else {}
+
+    @staticmethod
+    def load(path: Path) -> "RefLock":
+        """Read the lock at ``path``, a missing file is an empty lock."""
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return RefLock(path)
+        except (OSError, ValueError) as e:
+            raise RuntimeError(f"Failed to read lock file {path}: {e}")
+        if data.get("version") != _LOCKFILE_VERSION:
+            raise RuntimeError(
+                f"Unsupported lock file version {data.get('version')} in {path}"
+            )
+        return RefLock(path, data.get("refs", {}))
+
+    def get(self, url: str, ref: str) -> Optional[str]:
+        return self.refs.get(url, {}).get(ref)
+
+    def set(self, url: str, ref: str, commit: str):
+        self.refs.setdefault(url, {})[ref] = commit
+
+    def unlocked(self, refs: list[tuple[str, str]]) -> list[tuple[str, str]]:
+        """The (url, ref) pairs of ``refs`` that are not in the lock."""
+        return list(dict.fromkeys(pair for pair in refs if self.get(*pair) is None))
+
+    def resolve(self, refs: list[tuple[str, str]], frozen: bool = False) -> list[str]:
+        """Commits of ``refs``, from the lock where possible.
+
+        Refs missing from the lock are resolved on their remotes, or are an
+        error when the lock is ``frozen``.
+        """
+        missing = self.unlocked(refs)
+        if len(missing) > 0 and frozen:
+            raise RuntimeError(
+                f"Refs not locked in {self.path or LOCKFILE_NAME}: "
+                + ", ".join(f"{url} {ref}" for url, ref in missing)
+                + "; run `rebuildr load-py <rebuildr-file> lock`"
+            )
+        if len(missing) > 0 and len(self.refs) > 0:
+            logging.warning(
+                f"Resolving refs not locked in {self.path}: "
+                + ", ".join(f"{url} {ref}" for url, ref in missing)
+            )
+        resolved = dict(zip(missing, git_ls_remote_all(missing)))
+        return [self.get(url, ref) or resolved[(url, ref)] for url, ref in refs]
+
+    @staticmethod
+    def update(path: Path, commits: Iterable[tuple[tuple[str, str], str]]) -> "RefLock":
+        """Record the commits of (url, ref) pairs in the lock file at ``path``.
+
+        The file is read, updated and replaced under an exclusive lock, so
+        concurrent updates for other rebuildr files sharing it keep each
+        other's refs.
+        """
+        with file_lock(cache_dir() / "locks" / f"{cache_key(str(path))}.lock"):
+            lock = RefLock.load(path)
+            for (url, ref), commit in commits:
+                lock.set(url, ref, commit)
+            lock.write()
+        return lock
+
+    def write(self):
+        """Replace the lock file with the current refs, sorted for stable diffs."""
+        # the lock is committed next to the rebuildr file, it is not private
+        atomic_write_json(
+            self.path,
+            {"version": _LOCKFILE_VERSION, "refs": self.refs},
+            indent=2,
+            mode=0o644,
+        )
@@ -0,0 +1,51 @@
+import hashlib
+from pathlib import PurePath
+from typing import Callable
+
+_DIRECTORY_MODE = 0o40000
+
+
+class _Node(object):
+    __slots__ = ("dirs", "files")
+
+    def __init__(self):
+        self.dirs: dict[str, "_Node"] = {}
+        self.files: dict[str, tuple[int, str]] = {}
+
+
+class MerkleTree(object):
+    """Tree of file digests hashed bottom-up into directory nodes, like git trees.
+
+    Each directory digest covers the sorted ``<mode> <name>\\0<digest>``
+    entries of its children, so the root digest does not depend on the
+    order files are added in.
+    """
+
+    def __init__(self, new_hasher: Callable = hashlib.sha256):
+        self._new_hasher = new_hasher
+        self._root = _Node()
+
+    def set(self, path: PurePath, mode: int, digest: str):
+        node = self._root
+        for name in path.parts[:-1]:
+            node = node.dirs.setdefault(name, _Node())
+        node.files[path.name] = (mode, digest)
+
+    def digest(self) -> str:
+        return self._digest(self._root)
+
+    def _digest(self, node: _Node) -> str:
+        entries = [
+            (name, mode, digest) for name, (mode, digest) in node.files.items()
+        ] + [
+            (name, _DIRECTORY_MODE, self._digest(child))
+            for name, child in node.dirs.items()
+        ]
+        entries.sort()
+
+        hasher = self._new_hasher()
+        hasher.update(b"tree\0")
+        for name, mode, digest in entries:
+            hasher.update(f"{mode:o} {name}\0".encode())
+            hasher.update(bytes.fromhex(digest))
+        return hasher.hexdigest()
@@ -1,12 +1,32 @@
-from dataclasses import asdict, dataclass, field
-import glob
+from array import array
+from bisect import bisect_left
+from contextlib import closing
+from dataclasses import asdict, dataclass, field, replace
 import hashlib
 import json
 import os
 from pathlib import Path, PurePath
-from typing import Optional
-
-from rebuildr.tools.git import git_ls_remote
+import time
+from typing import Iterable, Iterator, Optional, Sequence, TextIO
+
+from rebuildr.cache import env_flag, env_int
+from rebuildr.digest_cache import DigestCache
+from rebuildr.listing_cache import ListingCache
+from rebuildr.hashing import (
+    HASH_ALGORITHMS,
+    HASH_BLAKE2B,
+    HASH_SHA256,
+    PrefetchedFile,
+    digest_files,
+    hash_file,
+    new_hasher,
+    prefetch_files,
+)
+from rebuildr.merkle import MerkleTree
+from rebuildr.lockfile import RefLock, git_refs
+from rebuildr.tools.git import git_blob_ids
+from rebuildr.ignore import ExcludeRules, read_dockerignore
+from rebuildr.walk import DirectoryWalker, excluded
 from rebuildr.descriptor import (
     ArgsInput,
     Descriptor,
@@ -65,11 +85,14 @@ class StableEnvInput(BaseInput):
     def sort_key(self) -> str:
         return self.key
 
-    def hash_update(self, hasher, env: StableEnvironment):
+    def value(self, env: StableEnvironment) -> Optional[str]:
         value = env.get_env(self.key)
-
-        if value is None and self.default is not None:
+        if value is None:
             value = self.default
+        return value
+
+    def hash_update(self, hasher, env: StableEnvironment):
+        value = self.value(env)
 
         if value or value == "":
             hasher.update(self.key.encode())
@@ -98,11 +121,18 @@ class StableBuildArgsInput(BaseInput):
             hasher.update(value.encode())
 
 
+# how the files of an external repository are placed into the context: the
+# tree of the commit without a .git directory; part of every content id with
+# externals, so contexts laid out differently never share an id
+EXTERNAL_LAYOUT = "export"
+
+
 @dataclass
 class StableGitHubCommitInput(BaseInput):
     url: str
     commit: str
     target_path: str | PurePath
+    subpath: Optional[PurePath] = None
 
     def sort_key(self) -> str:
         return self.commit
@@ -110,6 +140,12 @@ class StableGitHubCommitInput(BaseInput):
     def hash_update(self, hasher):
         hasher.update(str(self.target_path).encode())
         hasher.update(self.commit.encode())
+        # only hashed when set, so ids of whole repositories stay the same
+        if self.subpath is not None:
+            hasher.update(b"subpath")
+            hasher.update(self.subpath.as_posix().encode())
+        hasher.update(b"layout")
+        hasher.update(EXTERNAL_LAYOUT.encode())
 
 
 @dataclass
@@ -117,6 +153,7 @@ class StableGitRepoInput(BaseInput):
     url: str
     commit: str
     target_path: str | PurePath
+    subpath: Optional[PurePath] = None
 
     def sort_key(self) -> str:
         return self.commit
@@ -124,6 +161,81 @@ class StableGitRepoInput(BaseInput):
     def hash_update(self, hasher):
         hasher.update(str(self.target_path).encode())
         hasher.update(self.commit.encode())
+        # only hashed when set, so ids of whole repositories stay the same
+        if self.subpath is not None:
+            hasher.update(b"subpath")
+            hasher.update(self.subpath.as_posix().encode())
+        hasher.update(b"layout")
+        hasher.update(EXTERNAL_LAYOUT.encode())
+
+
+@dataclass
+class StableExcludeInput(BaseInput):
+    # directory the pattern is relative to, relative to the descriptor
+    root: PurePath
+    pattern: str
+
+    # exclude patterns are ordered, later patterns override earlier ones, so
+    # they are hashed in declaration order instead of being sorted
+    def hash_update(self, hasher):
+        hasher.update(b"exclude")
+        hasher.update(str(self.root).encode())
+        hasher.update(self.pattern.encode())
+
+
+# content id schemes, v1 is a single hash over all inputs, v2 a Merkle tree,
+# git the same tree over git blob ids taken from the index where possible
+CONTENT_ID_V1 = "v1"
+CONTENT_ID_V2 = "v2"
+CONTENT_ID_GIT = "git"
+CONTENT_ID_SCHEMES = (CONTENT_ID_V1, CONTENT_ID_V2, CONTENT_ID_GIT)
+
+# tag qualifier of every hash algorithm, SHA-256 ids keep their original tags
+_ALGORITHM_TAG_QUALIFIERS = {HASH_SHA256: None, HASH_BLAKE2B: "b2"}
+
+
+@dataclass(frozen=True)
+class InputDigest:
+    digest: str
+    mode: int
+    size: int
+
+
+@dataclass(frozen=True)
+class ContentId:
+    """Result of hashing ``StableInputs`` for one environment.
+
+    Besides the final digest it records the per-file digests computed on the
+    way, so later phases can use them without reading the files again.
+    """
+
+    digest: str
+    files: dict[PurePath, InputDigest] = field(default_factory=dict)
+    builders: dict[PurePath, InputDigest] = field(default_factory=dict)
+    scheme: str = CONTENT_ID_V1
+    algorithm: str = HASH_SHA256
+
+    def _tag_prefix(self) -> str:
+        parts = ["src-id"]
+        if self.scheme != CONTENT_ID_V1:
+            parts.append(self.scheme)
+        if _ALGORITHM_TAG_QUALIFIERS[self.algorithm] is not None:
+            parts.append(_ALGORITHM_TAG_QUALIFIERS[self.algorithm])
+        return "-".join(parts)
+
+    def tag(self) -> str:
+        """Tag name, prefixed so ids of different schemes or algorithms never collide."""
+        return f"{self._tag_prefix()}-{self.digest}"
+
+    def metadata_key(self) -> str:
+        """Key of the digest in stable metadata, naming how it was computed.
+
+        ``sha256`` for v1 SHA-256 ids, as always, otherwise the prefix of
+        ``tag``, e.g. ``src-id-v2`` or ``src-id-b2``.
+        """
+        if self.scheme == CONTENT_ID_V1 and self.algorithm == HASH_SHA256:
+            return HASH_SHA256
+        return self._tag_prefix()
 
 
 @dataclass
@@ -142,18 +254,53 @@ class StableFileInput:
         except (OSError, IOError) as e:
             raise RuntimeError(f"Failed to read file {self.absolute_src_path}: {e}")
 
-    def hash_update(self, hasher):
+    def stat(self) -> os.stat_result:
         try:
-            mode = self.absolute_src_path.stat().st_mode
+            return self.absolute_src_path.stat()
         except (OSError, IOError) as e:
             raise RuntimeError(f"Failed to stat file {self.absolute_src_path}: {e}")
 
+    def hash_update(
+        self,
+        hasher,
+        st: Optional[os.stat_result] = None,
+        prefetched: Optional[PrefetchedFile] = None,
+        algorithm: str = HASH_SHA256,
+    ) -> InputDigest:
+        """Feed this file into ``hasher`` and return the digest of its content.
+
+        ``prefetched`` carries the stat result and, for small files, the
+        content already read by ``prefetch_files``. The content digest is
+        computed with ``algorithm``.
+        """
+        if prefetched is not None:
+            st = prefetched.st
+        if st is None:
+            st = self.stat()
+        mode = st.st_mode
+
         if not self.ignore_target_path:
             hasher.update(str(self.target_path).encode())
         # if the mode is not the default 644 then include it in the hash - only to avoid updating tests
         if mode != 0o100644:
             hasher.update(str(mode).encode())
-        hasher.update(self.read_bytes())
+
+        if prefetched is not None and prefetched.content is not None:
+            hasher.update(prefetched.content)
+            return InputDigest(
+                digest=prefetched.digest,
+                mode=mode,
+                size=len(prefetched.content),
+            )
+
+        content_hasher = new_hasher(algorithm)
+        size = hash_file(self.absolute_src_path, (hasher, content_hasher))
+
+        return InputDigest(
+            digest=content_hasher.hexdigest(),
+            mode=mode,
+            size=size,
+        )
 
     @staticmethod
     def make_stable(root_dir: Path, src: FileInput) -> "StableFileInput":
@@ -171,21 +318,253 @@ class StableFileInput:
         )
 
 
+# flags kept per manifest entry
+_SOURCE_BELOW_ROOT = 1  # the source is its root joined with the target path
+_IGNORE_TARGET_PATH = 2
+
+
+class FileManifest(Sequence[StableFileInput]):
+    """Immutable list of file inputs, sorted by target path once when built.
+
+    Entries are kept in parallel arrays of strings instead of objects holding
+    two paths each: target paths, an index into a table of distinct source
+    roots and a flag byte. For the common case of a source that is its root
+    joined with the target path, nothing but the shared root is stored. The
+    ``StableFileInput`` objects are created on access.
+
+    ``find`` looks up a target path through a dict and ``below`` answers
+    directory queries with a binary search over the sorted target paths.
+    """
+
+    __slots__ = ("_targets", "_roots", "_root_ids", "_flags", "_index")
+
+    def __init__(self, deps: Iterable[StableFileInput] = ()):
+        # stable sort, of equal target paths the first one given comes first
+        deps = sorted(deps, key=lambda x: x.sort_key())
+        roots: dict[str, int] = {}
+        self._targets: tuple[str, ...] = tuple(dep.sort_key() for dep in deps)
+        self._root_ids = array("I")
+        self._flags = bytearray()
+        for dep, target in zip(deps, self._targets):
+            source = str(dep.absolute_src_path)
+            flags = _IGNORE_TARGET_PATH if dep.ignore_target_path else 0
+            if target != "." and source.endswith(os.sep + target):
+                source = source[: -len(target) - 1]
+                flags |= _SOURCE_BELOW_ROOT
+            self._root_ids.append(roots.setdefault(source, len(roots)))
+            self._flags.append(flags)
+        self._roots: tuple[str, ...] = tuple(roots)
+        self._index: dict[str, int] = {}
+        for i, target in enumerate(self._targets):
+            self._index.setdefault(target, i)
+
+    def _entry(self, i: int) -> StableFileInput:
+        target = self._targets[i]
+        source = self._roots[self._root_ids[i]]
+        flags = self._flags[i]
+        if flags & _SOURCE_BELOW_ROOT:
+            source = os.path.join(source, target)
+        return StableFileInput(
+            target_path=PurePath(target),
+            absolute_src_path=Path(source),
+            ignore_target_path=bool(flags & _IGNORE_TARGET_PATH),
+        )
+
+    def __len__(self) -> int:
+        return len(self._targets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._entry(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("manifest index out of range")
+        return self._entry(i)
+
+    def __iter__(self) -> Iterator[StableFileInput]:
+        for i in range(len(self._targets)):
+            yield self._entry(i)
+
+    def __add__(self, other) -> list[StableFileInput]:
+        return list(self) + list(other)
+
+    def __radd__(self, other) -> list[StableFileInput]:
+        return list(other) + list(self)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, FileManifest):
+            return list(self) == list(other)
+        if isinstance(other, list):
+            return list(self) == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"FileManifest({list(self)!r})"
+
+    def target_paths(self) -> tuple[str, ...]:
+        """The target paths of all entries as strings, in order."""
+        return self._targets
+
+    def find(self, path: PurePath) -> Optional[StableFileInput]:
+        """The entry whose ``target_path`` equals ``path``, if any."""
+        i = self._index.get(str(path))
+        return None if i is None else self._entry(i)
+
+    def below(self, directory: PurePath) -> list[StableFileInput]:
+        """Entries whose ``target_path`` is below ``directory``, in order."""
+        prefix = str(directory)
+        if prefix == ".":
+            return list(self)
+        # "0" is the character after "/", so the range holds all "<prefix>/..." paths
+        start = bisect_left(self._targets, prefix + "/")
+        end = bisect_left(self._targets, prefix + "0", start)
+        return [self._entry(i) for i in range(start, end)]
+
+
+@dataclass(frozen=True)
+class HashOptions:
+    """Settings controlling how content ids are computed."""
+
+    # reuse digests of files whose stat fingerprint is unchanged since the last run
+    digest_cache: bool = True
+    # reuse directory listings unchanged since the last run when expanding globs
+    glob_cache: bool = True
+    # number of threads reading and digesting input files
+    workers: int = 1
+    # content id format, ids of different schemes get different tag prefixes
+    scheme: str = CONTENT_ID_V1
+    # hash algorithm, None leaves the choice to the descriptor (SHA-256 by default)
+    algorithm: Optional[str] = None
+    # fail instead of contacting remotes for refs missing from the lock file
+    locked: bool = False
+
+    def __post_init__(self):
+        if self.workers < 1:
+            raise ValueError(f"Hash workers must be at least 1, got {self.workers}")
+        if self.scheme not in CONTENT_ID_SCHEMES:
+            raise ValueError(
+                f"Unknown content id scheme {self.scheme}, expected one of {', '.join(CONTENT_ID_SCHEMES)}"
+            )
+        if self.algorithm is not None and self.algorithm not in HASH_ALGORITHMS:
+            raise ValueError(
+                f"Unknown hash algorithm {self.algorithm}, expected one of {', '.join(HASH_ALGORITHMS)}"
+            )
+
+    @staticmethod
+    def from_env() -> "HashOptions":
+        return HashOptions(
+            digest_cache=env_flag("REBUILDR_DIGEST_CACHE", True),
+            glob_cache=env_flag("REBUILDR_GLOB_CACHE", True),
+            workers=env_int("REBUILDR_HASH_WORKERS", 1),
+            scheme=os.getenv("REBUILDR_CONTENT_ID", CONTENT_ID_V1),
+            algorithm=os.getenv("REBUILDR_HASH_ALGORITHM") or None,
+            locked=env_flag("REBUILDR_LOCKED", False),
+        )
+
+
 @dataclass
 class StableInputs:
     envs: list[StableEnvInput]
     build_args: list[StableBuildArgsInput]
-    files: list[StableFileInput] = field(default_factory=list)
-    builders: list[StableFileInput] = field(default_factory=list)
+    files: FileManifest = field(default_factory=FileManifest)
+    builders: FileManifest = field(default_factory=FileManifest)
     external: list[StableGitHubCommitInput | StableGitRepoInput] = field(
         default_factory=list
     )
+    excludes: list[StableExcludeInput] = field(default_factory=list)
+    hashing: HashOptions = field(default_factory=HashOptions.from_env)
+
+    def __post_init__(self):
+        if not isinstance(self.files, FileManifest):
+            self.files = FileManifest(self.files)
+        if not isinstance(self.builders, FileManifest):
+            self.builders = FileManifest(self.builders)
+        # content ids are memoized per set of relevant env and build arg values
+        self._content_ids: dict[tuple, ContentId] = {}
+
+    @property
+    def algorithm(self) -> str:
+        return self.hashing.algorithm or HASH_SHA256
 
     def build_args_dict(self, env: StableEnvironment) -> dict[str, str]:
         return {build_arg.key: build_arg.value(env) for build_arg in self.build_args}
 
-    def sha_sum(self, env: StableEnvironment):
-        m = hashlib.sha256()
+    def _content_id_key(self, env: StableEnvironment) -> tuple:
+        return (
+            tuple((env_dep.key, env.get_env(env_dep.key)) for env_dep in self.envs),
+            tuple(
+                (build_arg_dep.key, env.get_build_arg(build_arg_dep.key))
+                for build_arg_dep in self.build_args
+            ),
+        )
+
+    def content_id(self, env: StableEnvironment) -> ContentId:
+        """Return the content id of these inputs, hashing them at most once.
+
+        Results are memoized per combination of the env and build arg values
+        these inputs depend on, so tags, metadata and builds all share one pass
+        over the files.
+        """
+        key = self._content_id_key(env)
+        content_id = self._content_ids.get(key)
+        if content_id is None:
+            content_id = self._compute_content_id(env)
+            self._content_ids[key] = content_id
+        return content_id
+
+    def remember_content_id(self, env: StableEnvironment, content_id: ContentId):
+        """Use a content id computed elsewhere, e.g. by the daemon, for ``env``."""
+        self._content_ids[self._content_id_key(env)] = content_id
+
+    def _digest_cache(self) -> Optional[DigestCache]:
+        if not self.hashing.digest_cache:
+            return None
+        return DigestCache.for_paths(
+            file_dep.absolute_src_path for file_dep in self.builders + self.files
+        )
+
+    def _compute_content_id(self, env: StableEnvironment) -> ContentId:
+        # manifests are sorted by target path already
+        builder_deps = list(self.builders)
+        file_deps = list(self.files)
+        cache = self._digest_cache()
+
+        if self.hashing.scheme == CONTENT_ID_V2:
+            return self._compute_content_id_tree(
+                env,
+                CONTENT_ID_V2,
+                builder_deps,
+                self._file_digests(builder_deps, cache),
+                file_deps,
+                self._file_digests(file_deps, cache),
+            )
+        if self.hashing.scheme == CONTENT_ID_GIT:
+            return self._compute_content_id_tree(
+                env,
+                CONTENT_ID_GIT,
+                builder_deps,
+                self._git_file_digests(builder_deps),
+                file_deps,
+                self._git_file_digests(file_deps),
+            )
+        return self._compute_content_id_v1(env, cache, builder_deps, file_deps)
+
+    def _compute_content_id_v1(
+        self,
+        env: StableEnvironment,
+        cache: Optional[DigestCache],
+        builder_deps: list[StableFileInput],
+        file_deps: list[StableFileInput],
+    ) -> ContentId:
+        """Single hash over all inputs concatenated in order (``src-id-``)."""
+        if cache is not None:
+            content_id = self._cached_content_id(env, cache, builder_deps, file_deps)
+            if content_id is not None:
+                return content_id
+
+        started_ns = time.time_ns()
+        m = new_hasher(self.algorithm)
         for env_dep in sorted(self.envs, key=lambda x: x.sort_key()):
             env_dep.hash_update(m, env)
 
@@ -193,32 +572,295 @@ class StableInputs:
             build_arg_dep.hash_update(m, env)
 
         # sort and iterate - order must be predictable - always
-        for builder_dep in sorted(self.builders, key=lambda x: x.sort_key()):
-            builder_dep.hash_update(m)
-
-        for file_dep in sorted(self.files, key=lambda x: x.sort_key()):
-            file_dep.hash_update(m)
+        file_inputs = builder_deps + file_deps
+        if self.hashing.workers > 1:
+            prefetched = prefetch_files(
+                [dep.absolute_src_path for dep in file_inputs],
+                self.hashing.workers,
+                self.algorithm,
+            )
+        else:
+            prefetched = (None for _ in file_inputs)
+
+        input_digests = []
+        with closing(prefetched):
+            for dep, prefetched_file in zip(file_inputs, prefetched):
+                st = dep.stat() if prefetched_file is None else prefetched_file.st
+                input_digests.append(
+                    dep.hash_update(m, st, prefetched_file, self.algorithm)
+                )
+                if cache is not None:
+                    cache.store(
+                        dep.absolute_src_path,
+                        st,
+                        self.algorithm,
+                        input_digests[-1].digest,
+                        started_ns,
+                    )
+        builder_digests = input_digests[: len(builder_deps)]
+        file_digests = input_digests[len(builder_deps) :]
 
         for external_dep in sorted(self.external, key=lambda x: x.sort_key()):
             external_dep.hash_update(m)
 
-        return m.hexdigest()
+        for exclude in self.excludes:
+            exclude.hash_update(m)
 
-    def find_file(self, path: PurePath) -> Optional[StableFileInput]:
-        """Return the file dependency whose ``target_path`` equals ``path``.
+        content_id = ContentId(
+            digest=m.hexdigest(),
+            files={dep.target_path: d for dep, d in zip(file_deps, file_digests)},
+            builders={
+                dep.target_path: d for dep, d in zip(builder_deps, builder_digests)
+            },
+            algorithm=self.algorithm,
+        )
+        if cache is not None:
+            cache.store_id(
+                self._digests_key(
+                    env, builder_deps, builder_digests, file_deps, file_digests
+                ),
+                content_id.digest,
+            )
+            cache.flush()
+        return content_id
+
+    def _compute_content_id_tree(
+        self,
+        env: StableEnvironment,
+        scheme: str,
+        builder_deps: list[StableFileInput],
+        builder_digests: list[InputDigest],
+        file_deps: list[StableFileInput],
+        file_digests: list[InputDigest],
+    ) -> ContentId:
+        """Merkle tree over per-file digests (``src-id-v2-`` and ``src-id-git-``).
+
+        Files are digested independently, so they can be taken from a cache or
+        hashed concurrently in any order, and are then combined into
+        directory nodes like git trees. The root covers the file and builder
+        trees together with envs, build args and externals.
+        """
+        files_tree = MerkleTree(lambda: new_hasher(self.algorithm))
+        for dep, input_digest in zip(file_deps, file_digests):
+            files_tree.set(dep.target_path, input_digest.mode, input_digest.digest)
+        builders_tree = MerkleTree(lambda: new_hasher(self.algorithm))
+        # the Dockerfile name does not contribute to the content id
+        dockerfiles = []
+        for dep, input_digest in zip(builder_deps, builder_digests):
+            if dep.ignore_target_path:
+                dockerfiles.append([input_digest.mode, input_digest.digest])
+            else:
+                builders_tree.set(
+                    dep.target_path, input_digest.mode, input_digest.digest
+                )
 
-        The search is performed first in ``files`` and then in ``builders``.
+        root = {
+            "version": 2,
+            "envs": [
+                [env_dep.key, env_dep.value(env)]
+                for env_dep in sorted(self.envs, key=lambda x: x.sort_key())
+            ],
+            "build_args": [
+                [build_arg_dep.key, build_arg_dep.value(env)]
+                for build_arg_dep in sorted(self.build_args, key=lambda x: x.sort_key())
+            ],
+            "builders": builders_tree.digest(),
+            "dockerfiles": sorted(dockerfiles),
+            "files": files_tree.digest(),
+            "external": [
+                [str(external_dep.target_path), external_dep.commit]
+                + (
+                    []
+                    if external_dep.subpath is None
+                    else [external_dep.subpath.as_posix()]
+                )
+                for external_dep in sorted(self.external, key=lambda x: x.sort_key())
+            ],
+        }
+        # only present when used, so ids without them stay the same
+        if len(self.external) > 0:
+            root["external_layout"] = EXTERNAL_LAYOUT
+        if len(self.excludes) > 0:
+            root["exclude"] = [
+                [str(exclude.root), exclude.pattern] for exclude in self.excludes
+            ]
+        root_hasher = new_hasher(self.algorithm)
+        root_hasher.update(
+            json.dumps(root, sort_keys=True, separators=(",", ":")).encode()
+        )
+        digest = root_hasher.hexdigest()
+
+        return ContentId(
+            digest=digest,
+            files={dep.target_path: d for dep, d in zip(file_deps, file_digests)},
+            builders={
+                dep.target_path: d for dep, d in zip(builder_deps, builder_digests)
+            },
+            scheme=scheme,
+            algorithm=self.algorithm,
+        )
+
+    def _file_digests(
+        self, deps: list[StableFileInput], cache: Optional[DigestCache]
+    ) -> list[InputDigest]:
+        """Digest every file on its own, reusing cached digests where possible."""
+        started_ns = time.time_ns()
+        digests: list[Optional[InputDigest]] = []
+        missing = []
+        for dep in deps:
+            st = dep.stat()
+            digest = None
+            if cache is not None:
+                digest = cache.lookup(dep.absolute_src_path, st, self.algorithm)
+            if digest is None:
+                missing.append((len(digests), st))
+                digests.append(None)
+            else:
+                digests.append(
+                    InputDigest(digest=digest, mode=st.st_mode, size=st.st_size)
+                )
+
+        hashed = digest_files(
+            [deps[index].absolute_src_path for index, _ in missing],
+            self.hashing.workers,
+            self.algorithm,
+        )
+        for (index, st), (digest, size) in zip(missing, hashed):
+            digests[index] = InputDigest(digest=digest, mode=st.st_mode, size=size)
+            if cache is not None:
+                cache.store(
+                    deps[index].absolute_src_path,
+                    st,
+                    self.algorithm,
+                    digest,
+                    started_ns,
+                )
+
+        if cache is not None:
+            cache.flush()
+        return digests
+
+    def _git_file_digests(self, deps: list[StableFileInput]) -> list[InputDigest]:
+        """Git blob ids of the files, read from the git index for clean files."""
+        stats = [dep.stat() for dep in deps]
+        object_ids = git_blob_ids(
+            [dep.absolute_src_path for dep in deps], self.hashing.workers
+        )
+        return [
+            InputDigest(digest=object_id, mode=st.st_mode, size=st.st_size)
+            for object_id, st in zip(object_ids, stats)
+        ]
+
+    def _cached_content_id(
+        self,
+        env: StableEnvironment,
+        cache: DigestCache,
+        builder_deps: list[StableFileInput],
+        file_deps: list[StableFileInput],
+    ) -> Optional[ContentId]:
+        """Rebuild the content id from cached digests without reading any file.
+
+        This only succeeds when every file is unchanged according to its stat
+        fingerprint and the same set of digests was hashed before.
         """
 
-        for file_dep in self.files:
-            if file_dep.target_path == path:
-                return file_dep
+        def cached_digests(deps: list[StableFileInput]) -> Optional[list[InputDigest]]:
+            digests = []
+            for dep in deps:
+                st = dep.stat()
+                digest = cache.lookup(dep.absolute_src_path, st, self.algorithm)
+                if digest is None:
+                    return None
+                digests.append(
+                    InputDigest(digest=digest, mode=st.st_mode, size=st.st_size)
+                )
+            return digests
+
+        builder_digests = cached_digests(builder_deps)
+        if builder_digests is None:
+            return None
+        file_digests = cached_digests(file_deps)
+        if file_digests is None:
+            return None
+
+        digest = cache.lookup_id(
+            self._digests_key(
+                env, builder_deps, builder_digests, file_deps, file_digests
+            )
+        )
+        if digest is None:
+            return None
+        cache.flush()
+
+        return ContentId(
+            digest=digest,
+            files={dep.target_path: d for dep, d in zip(file_deps, file_digests)},
+            builders={
+                dep.target_path: d for dep, d in zip(builder_deps, builder_digests)
+            },
+            algorithm=self.algorithm,
+        )
 
-        for file_dep in self.builders:
-            if file_dep.target_path == path:
-                return file_dep
+    def _digests_key(
+        self,
+        env: StableEnvironment,
+        builder_deps: list[StableFileInput],
+        builder_digests: list[InputDigest],
+        file_deps: list[StableFileInput],
+        file_digests: list[InputDigest],
+    ) -> str:
+        """Key identifying everything the content id is computed from.
+
+        File contents are represented by their digests, so two invocations
+        with equal keys are guaranteed to produce the same content id.
+        """
+        records = [["algorithm", self.algorithm]]
+        for env_dep in sorted(self.envs, key=lambda x: x.sort_key()):
+            records.append(
+                ["env", env_dep.key, env_dep.default, env.get_env(env_dep.key)]
+            )
+        for build_arg_dep in sorted(self.build_args, key=lambda x: x.sort_key()):
+            records.append(["build_arg", build_arg_dep.key, build_arg_dep.value(env)])
+        for kind, deps, digests in (
+            ("builder", builder_deps, builder_digests),
+            ("file", file_deps, file_digests),
+        ):
+            for dep, input_digest in zip(deps, digests):
+                records.append(
+                    [
+                        kind,
+                        str(dep.target_path),
+                        dep.ignore_target_path,
+                        input_digest.mode,
+                        input_digest.digest,
+                    ]
+                )
+        for external_dep in sorted(self.external, key=lambda x: x.sort_key()):
+            record = [
+                type(external_dep).__name__,
+                str(external_dep.target_path),
+                external_dep.commit,
+                EXTERNAL_LAYOUT,
+            ]
+            if external_dep.subpath is not None:
+                record.append(external_dep.subpath.as_posix())
+            records.append(record)
+        for exclude in self.excludes:
+            records.append(["exclude", str(exclude.root), exclude.pattern])
+        return hashlib.sha256(json.dumps(records).encode()).hexdigest()
 
-        return None
+    def sha_sum(self, env: StableEnvironment):
+        return self.content_id(env).digest
+
+    def find_file(self, path: PurePath) -> Optional[StableFileInput]:
+        """Return the file dependency whose ``target_path`` equals ``path``.
+
+        The search is performed first in ``files`` and then in ``builders``.
+        """
+        file_dep = self.files.find(path)
+        if file_dep is None:
+            file_dep = self.builders.find(path)
+        return file_dep
 
 
 @dataclass
@@ -241,11 +883,12 @@ class StableImageTarget:
         return tags
 
     def content_id_tag(self, inputs: StableInputs, env: StableEnvironment) -> str:
+        tag = inputs.content_id(env).tag()
         if self.platform is None:
-            return f"{self.repository}:src-id-{inputs.sha_sum(env)}"
+            return f"{self.repository}:{tag}"
         else:
             platform_prefix = self.platform.value.replace("/", "-")
-            return f"{self.repository}:{platform_prefix}-src-id-{inputs.sha_sum(env)}"
+            return f"{self.repository}:{platform_prefix}-{tag}"
 
 
 @dataclass(frozen=True)
@@ -254,48 +897,152 @@ class StableDescriptor:
     inputs: StableInputs
     targets: Optional[list[StableImageTarget]] = None
 
+    def content_id(self, env: StableEnvironment) -> ContentId:
+        return self.inputs.content_id(env)
+
     def sha_sum(self, env: StableEnvironment):
         return self.inputs.sha_sum(env)
 
-    def stable_inputs_dict(self, env: StableEnvironment):
-        # Remove null values and absolute_path keys recursively
-        def clean_dict(d):
-            if isinstance(d, list):
-                return [clean_dict(item) for item in d]
-            if not isinstance(d, dict):
-                return str(d)
+    def _stable_input_records(self, env: StableEnvironment) -> dict[str, Iterable]:
+        """The metadata records of every input field, produced lazily.
+
+        Records carry no null values nor absolute paths, other values are
+        rendered as strings. Env and build arg records get the value they
+        have in ``env``, if any.
+        """
+
+        def clean(dep) -> dict:
             return {
-                k: clean_dict(v)
-                for k, v in d.items()
-                if v is not None
-                and k != "absolute_src_path"
-                and k != "ignore_target_path"
+                k: str(v)
+                for k, v in asdict(dep).items()
+                if v is not None and k != "absolute_src_path"
             }
 
-        inputs = clean_dict(asdict(self.inputs))
-        envs = inputs["envs"]
-        for in_env in envs:
-            value = env.get_env(in_env["key"])
+        def with_value(dep, value: Optional[str]) -> dict:
+            record = clean(dep)
             if value:
-                in_env["value"] = value
-
-        build_args = inputs["build_args"]
-        for in_build_arg in build_args:
-            value = env.get_build_arg(in_build_arg["key"])
-            if value:
-                in_build_arg["value"] = value
+                record["value"] = value
+            return record
+
+        inputs = self.inputs
+        records = {
+            "envs": (with_value(dep, env.get_env(dep.key)) for dep in inputs.envs),
+            "build_args": (
+                with_value(dep, env.get_build_arg(dep.key)) for dep in inputs.build_args
+            ),
+            # straight from the manifests, without creating an input per file
+            "files": ({"target_path": path} for path in inputs.files.target_paths()),
+            "builders": (
+                {"target_path": path} for path in inputs.builders.target_paths()
+            ),
+            "external": (clean(dep) for dep in inputs.external),
+        }
+        if len(inputs.excludes) > 0:
+            records["excludes"] = (clean(dep) for dep in inputs.excludes)
+        return records
 
+    def stable_inputs_dict(self, env: StableEnvironment):
+        inputs = {
+            name: list(records)
+            for name, records in self._stable_input_records(env).items()
+        }
+        content_id = self.content_id(env)
         return {
             "inputs": inputs,
-            "sha256": self.sha_sum(env),
+            content_id.metadata_key(): content_id.digest,
         }
 
+    def write_stable_inputs(
+        self, env: StableEnvironment, out: TextIO, compact: bool = False
+    ):
+        """Write ``stable_inputs_dict`` to ``out`` as JSON, one record at a time.
+
+        The output is exactly ``json.dump(..., indent=4, sort_keys=True)`` of
+        ``stable_inputs_dict``, or with ``compact`` the same without any
+        whitespace, but the dict is never built.
+        """
+        if compact:
+            newline, indent, colon = "", "", ":"
+        else:
+            newline, indent, colon = "\n", "    ", ": "
+
+        def dumps(value, depth: int) -> str:
+            if compact:
+                return json.dumps(value, sort_keys=True, separators=(",", ":"))
+            text = json.dumps(value, indent=4, sort_keys=True)
+            return text.replace("\n", "\n" + indent * depth)
+
+        def write_list(records: Iterable, depth: int):
+            first = True
+            for record in records:
+                out.write(("[" if first else ",") + newline + indent * (depth + 1))
+                out.write(dumps(record, depth + 1))
+                first = False
+            out.write("[]" if first else newline + indent * depth + "]")
+
+        content_id = self.content_id(env)
+        records = self._stable_input_records(env)
+        out.write("{")
+        for i, key in enumerate(sorted(["inputs", content_id.metadata_key()])):
+            out.write(("," if i > 0 else "") + newline + indent + json.dumps(key))
+            out.write(colon)
+            if key != "inputs":
+                out.write(json.dumps(content_id.digest))
+                continue
+            out.write("{")
+            for j, name in enumerate(sorted(records)):
+                out.write(("," if j > 0 else "") + newline + indent * 2)
+                out.write(json.dumps(name) + colon)
+                write_list(records[name], 2)
+            out.write(newline + indent + "}")
+        out.write(newline + "}")
+
+    @staticmethod
+    def _make_stable_directory(
+        walker: DirectoryWalker,
+        absolute_dir: Path,
+        target_path: PurePath,
+        exclude: list[ExcludeRules],
+    ) -> list[StableFileInput]:
+        """Every file below ``absolute_dir``, hidden ones included, like ``COPY dir/``."""
+        return [
+            StableFileInput(
+                target_path=target_path / path,
+                absolute_src_path=absolute_dir / path,
+            )
+            for path in walker.files_below(absolute_dir, exclude)
+        ]
+
     @staticmethod
-    def _make_stable_files(files, root_dir: Path) -> list[StableFileInput]:
+    def _make_stable_files(
+        files,
+        root_dir: Path,
+        walker: Optional[DirectoryWalker] = None,
+        exclude: Optional[ExcludeRules] = None,
+    ) -> list[StableFileInput]:
+        """Resolve file inputs to files, skipping those matched by ``exclude``.
+
+        ``exclude`` applies to glob and directory inputs; files listed one by
+        one are always included.
+        """
+        if walker is None:
+            walker = DirectoryWalker()
+        input_exclude = [exclude] if exclude else []
         stable_files = []
         for file_dep in files:
             if isinstance(file_dep, FileInput):
-                stable_files.append(StableFileInput.make_stable(root_dir, file_dep))
+                stable_file = StableFileInput.make_stable(root_dir, file_dep)
+                if stable_file.absolute_src_path.is_dir():
+                    stable_files.extend(
+                        StableDescriptor._make_stable_directory(
+                            walker,
+                            stable_file.absolute_src_path,
+                            stable_file.target_path,
+                            input_exclude,
+                        )
+                    )
+                else:
+                    stable_files.append(stable_file)
             elif isinstance(file_dep, GlobInput):
                 glob_dep = file_dep
                 glob_root = (
@@ -309,18 +1056,20 @@ class StableDescriptor:
                         PurePath(glob_dep.target_path)
                     )
 
-                for path in glob.glob(
-                    glob_dep.pattern,
-                    root_dir=glob_root,
-                    recursive=True,
+                glob_exclude = input_exclude + [
+                    ExcludeRules(glob_dep.exclude, glob_root)
+                ]
+
+                for path in walker.glob(
+                    glob_dep.pattern, glob_root, exclude=glob_exclude
                 ):
                     path = PurePath(path)
                     absolute_src_path = glob_root / path
+                    if excluded(glob_exclude, absolute_src_path):
+                        continue
 
-                    if not absolute_src_path.exists():
-                        raise ValueError(f"File {absolute_src_path} does not exist")
-
-                    if absolute_src_path.is_file():
+                    # raises for matches that do not exist, e.g. broken symlinks
+                    if walker.is_file(absolute_src_path):
                         target_path = prepend_path / make_inner_relative_path(
                             PurePath(path)
                         )
@@ -331,25 +1080,96 @@ class StableDescriptor:
                             )
                         )
             elif isinstance(file_dep, str):
-                stable_files.append(
-                    StableFileInput(
-                        target_path=PurePath(file_dep),
-                        absolute_src_path=root_dir / PurePath(file_dep),
+                absolute_src_path = root_dir / PurePath(file_dep)
+                if absolute_src_path.is_dir():
+                    stable_files.extend(
+                        StableDescriptor._make_stable_directory(
+                            walker,
+                            absolute_src_path,
+                            make_inner_relative_path(PurePath(file_dep)),
+                            input_exclude,
+                        )
+                    )
+                else:
+                    stable_files.append(
+                        StableFileInput(
+                            target_path=PurePath(file_dep),
+                            absolute_src_path=absolute_src_path,
+                        )
                     )
-                )
             else:
                 raise ValueError(f"Unexpected input type {type(file_dep)}")
         stable_files.sort(key=lambda x: x.sort_key())
         return stable_files
 
     @staticmethod
-    def from_descriptor(
+    def _make_exclude_rules(
         descriptor: Descriptor, absolute_path: Path
+    ) -> ExcludeRules:
+        """Descriptor-wide exclude rules, the .dockerignore first, then ``Inputs.exclude``."""
+        patterns = []
+        if descriptor.inputs.dockerignore:
+            for target in descriptor.targets or []:
+                if isinstance(target, ImageTarget):
+                    dockerignore = read_dockerignore(
+                        absolute_path / (target.dockerfile or "Dockerfile")
+                    )
+                    patterns.extend(dockerignore or [])
+        patterns.extend(descriptor.inputs.exclude)
+        return ExcludeRules(patterns, absolute_path)
+
+    @staticmethod
+    def _make_stable_excludes(
+        descriptor: Descriptor, exclude: ExcludeRules, absolute_path: Path
+    ) -> list[StableExcludeInput]:
+        """Normalized exclude patterns in the order they apply.
+
+        Descriptor-wide patterns are relative to the descriptor directory,
+        patterns of a ``GlobInput`` to its ``root_dir``.
+        """
+        excludes = [
+            StableExcludeInput(root=PurePath("."), pattern=pattern)
+            for pattern in exclude.patterns
+        ]
+        for dep in descriptor.inputs.files + descriptor.inputs.builders:
+            if isinstance(dep, GlobInput) and len(dep.exclude) > 0:
+                root = PurePath(dep.root_dir if dep.root_dir is not None else ".")
+                excludes.extend(
+                    StableExcludeInput(root=root, pattern=pattern)
+                    for pattern in ExcludeRules(dep.exclude, absolute_path).patterns
+                )
+        return excludes
+
+    @staticmethod
+    def from_descriptor(
+        descriptor: Descriptor,
+        absolute_path: Path,
+        hashing: Optional[HashOptions] = None,
+        lock: Optional[RefLock] = None,
     ) -> "StableDescriptor":
+        """Resolve ``descriptor`` relative to ``absolute_path``.
+
+        Refs of git repositories are taken from ``lock`` where it has them
+        and resolved on their remotes otherwise.
+        """
         if not absolute_path.is_absolute():
             raise ValueError("absolute_path must be absolute")
+        if hashing is None:
+            hashing = HashOptions.from_env()
+        # the CLI and environment take precedence over the descriptor
+        if hashing.algorithm is None and descriptor.hash_algorithm is not None:
+            hashing = replace(hashing, algorithm=descriptor.hash_algorithm)
+        exclude = StableDescriptor._make_exclude_rules(descriptor, absolute_path)
+        exclude_deps = StableDescriptor._make_stable_excludes(
+            descriptor, exclude, absolute_path
+        )
+
+        # one walker for all inputs, so every directory is listed only once
+        walker = DirectoryWalker(
+            ListingCache.for_root(absolute_path) if hashing.glob_cache else None
+        )
         file_deps = StableDescriptor._make_stable_files(
-            descriptor.inputs.files, absolute_path
+            descriptor.inputs.files, absolute_path, walker, exclude
         )
 
         env_deps = [
@@ -364,6 +1184,13 @@ class StableDescriptor:
         ]
 
         external_deps = []
+        if lock is None:
+            lock = RefLock()
+        # refs of all git repositories are resolved at once, those that are
+        # not locked need a round trip to their remote
+        resolved_commits = iter(
+            lock.resolve(git_refs(descriptor), frozen=hashing.locked)
+        )
         for dep in descriptor.inputs.external:
             if isinstance(dep, str):
                 raise ValueError(
@@ -377,19 +1204,24 @@ class StableDescriptor:
                         url=f"https://github.com/{dep.owner}/{dep.repo}.git",
                         commit=dep.commit,
                         target_path=target_path,
+                        subpath=(
+                            None if dep.subpath is None else PurePath(dep.subpath)
+                        ),
                     )
                 )
             elif isinstance(dep, GitRepoInput):
-                if dep.target_path.is_absolute():
-                    target_path = dep.target_path.relative_to("/")
-                else:
-                    target_path = dep.target_path
+                target_path = PurePath(dep.target_path)
+                if target_path.is_absolute():
+                    target_path = target_path.relative_to("/")
 
                 external_deps.append(
                     StableGitRepoInput(
                         url=dep.url,
-                        commit=git_ls_remote(dep.url, dep.ref),
+                        commit=next(resolved_commits),
                         target_path=target_path,
+                        subpath=(
+                            None if dep.subpath is None else PurePath(dep.subpath)
+                        ),
                     )
                 )
             else:
@@ -402,7 +1234,10 @@ class StableDescriptor:
                 if not isinstance(dep, EnvInput) and not isinstance(dep, ArgsInput)
             ],
             absolute_path,
+            walker,
+            exclude,
         )
+        walker.flush()
 
         targets = []
         for target in descriptor.targets or []:
@@ -447,6 +1282,8 @@ class StableDescriptor:
             envs=env_deps,
             build_args=build_args_deps,
             external=external_deps,
+            excludes=exclude_deps,
+            hashing=hashing,
         )
 
         return StableDescriptor(
@@ -456,17 +1293,11 @@ class StableDescriptor:
         )
 
     def filter_env_and_build_args(self, env: StableEnvironment) -> StableEnvironment:
+        env_keys = {env_dep.key for env_dep in self.inputs.envs}
+        build_arg_keys = {build_arg_dep.key for build_arg_dep in self.inputs.build_args}
         return StableEnvironment(
-            env={
-                k: v
-                for k, v in env.env.items()
-                if k in [env_dep.key for env_dep in self.inputs.envs]
-            },
-            build_args={
-                k: v
-                for k, v in env.build_args.items()
-                if k in [build_arg_dep.key for build_arg_dep in self.inputs.build_args]
-            },
+            env={k: v for k, v in env.env.items() if k in env_keys},
+            build_args={k: v for k, v in env.build_args.items() if k in build_arg_keys},
         )
 
 
@@ -0,0 +1,272 @@
+import errno
+import fcntl
+import logging
+import os
+from pathlib import Path
+import shutil
+from typing import Callable, Optional, Protocol
+
+# size of the buffer checked files are copied through
+_CHUNK_SIZE = 1 << 20
+
+# How input files are placed into a build context.
+#
+# Reflinks share the data blocks with the source until either side is written
+# (btrfs, xfs, ...), hardlinks share the inode and are only used when the
+# context is read, never written, copy_file_range copies inside the kernel
+# (and may reflink or copy server side on its own) and a plain copy works
+# everywhere. ``auto`` tries them in that order and remembers what works
+# between each pair of file systems.
+STAGING_AUTO = "auto"
+STAGING_REFLINK = "reflink"
+STAGING_HARDLINK = "hardlink"
+STAGING_COPY_FILE_RANGE = "copy_file_range"
+STAGING_COPY = "copy"
+STAGING_STRATEGIES = (
+    STAGING_AUTO,
+    STAGING_REFLINK,
+    STAGING_HARDLINK,
+    STAGING_COPY_FILE_RANGE,
+    STAGING_COPY,
+)
+
+# _IOW(0x94, 9, int) from linux/fs.h
+_FICLONE = 0x40049409
+
+# errors meaning the method is not available between the two files, as
+# opposed to errors about the files themselves
+_UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EPERM,
+    errno.EMLINK,
+}
+
+
+class StagingUnsupported(Exception):
+    pass
+
+
+class StagingCheck(Protocol):
+    """Sees every byte of a staged file, e.g. ``rebuildr.verify.InputCheck``."""
+
+    def start(self, st: os.stat_result): ...
+
+    def update(self, chunk): ...
+
+    def finish(self, st: os.stat_result): ...
+
+
+def _unsupported(e: OSError) -> bool:
+    return e.errno in _UNSUPPORTED_ERRNOS
+
+
+def _clone(src_fd: int, dest_fd: int):
+    try:
+        fcntl.ioctl(dest_fd, _FICLONE, src_fd)
+    except OSError as e:
+        if _unsupported(e):
+            raise StagingUnsupported(str(e))
+        raise
+
+
+def _reflink(src_path: Path, dest_path: Path):
+    with open(src_path, "rb") as src, open(dest_path, "wb") as dest:
+        _clone(src.fileno(), dest.fileno())
+    shutil.copystat(src_path, dest_path)
+
+
+def _hardlink(src_path: Path, dest_path: Path):
+    try:
+        os.link(src_path, dest_path)
+    except OSError as e:
+        if _unsupported(e):
+            raise StagingUnsupported(str(e))
+        raise
+
+
+def _copy_file_range(src_path: Path, dest_path: Path):
+    if not hasattr(os, "copy_file_range"):
+        raise StagingUnsupported("copy_file_range is not available")
+
+    with open(src_path, "rb") as src, open(dest_path, "wb") as dest:
+        copied = 0
+        try:
+            while True:
+                n = os.copy_file_range(src.fileno(), dest.fileno(), 1 << 30)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            # only a failure on the first chunk says anything about support
+            if copied == 0 and _unsupported(e):
+                raise StagingUnsupported(str(e))
+            raise
+        # some file systems report files they cannot copy from as empty
+        if copied == 0 and os.fstat(src.fileno()).st_size > 0:
+            raise StagingUnsupported("copy_file_range copied nothing")
+    shutil.copystat(src_path, dest_path)
+
+
+def _copy(src_path: Path, dest_path: Path):
+    # copy2 preserves modification times and mode
+    shutil.copy2(src_path, dest_path)
+
+
+def _read_checked(src, dest, check: StagingCheck):
+    """Read ``src`` to the end into ``check`` and ``dest`` unless it is None."""
+    buffer = bytearray(_CHUNK_SIZE)
+    with memoryview(buffer) as view:
+        while True:
+            n = src.readinto(buffer)
+            if not n:
+                break
+            check.update(view[:n])
+            if dest is not None:
+                dest.write(view[:n])
+
+
+_METHODS: dict[str, Callable[[Path, Path], None]] = {
+    STAGING_REFLINK: _reflink,
+    STAGING_HARDLINK: _hardlink,
+    STAGING_COPY_FILE_RANGE: _copy_file_range,
+    STAGING_COPY: _copy,
+}
+
+
+def _reflink_checked(src, src_path: Path, dest_path: Path, check: StagingCheck):
+    # the clone is read back, later writes to the source cannot change it
+    with open(dest_path, "wb") as dest:
+        _clone(src.fileno(), dest.fileno())
+    with open(dest_path, "rb", buffering=0) as clone:
+        _read_checked(clone, None, check)
+
+
+def _copy_checked(src, src_path: Path, dest_path: Path, check: StagingCheck):
+    with open(dest_path, "wb") as dest:
+        _read_checked(src, dest, check)
+
+
+# methods staging a private copy of exactly the bytes a check sees;
+# copy_file_range copies inside the kernel without them, and a hardlink
+# would let later writes to the input reach the staged file
+_CHECKED_METHODS: dict[str, Callable[..., None]] = {
+    STAGING_REFLINK: _reflink_checked,
+    STAGING_COPY: _copy_checked,
+}
+
+
+def staging_from_env() -> str:
+    return os.getenv("REBUILDR_STAGING") or STAGING_AUTO
+
+
+class FileStager(object):
+    """Places files into a build context with the cheapest method that works.
+
+    With ``read_only`` the context is only ever read, e.g. by buildx, so
+    hardlinks to the inputs are allowed: writing to a staged file would
+    otherwise modify the input itself.
+    """
+
+    def __init__(self, strategy: Optional[str] = None, read_only: bool = False):
+        if strategy is None:
+            strategy = staging_from_env()
+        if strategy not in STAGING_STRATEGIES:
+            raise ValueError(
+                f"Unknown staging strategy {strategy}, expected one of {', '.join(STAGING_STRATEGIES)}"
+            )
+        if strategy == STAGING_AUTO:
+            self._candidates = [
+                method for method in _METHODS if method != STAGING_HARDLINK or read_only
+            ]
+        else:
+            self._candidates = [strategy]
+        self.strategy = strategy
+        # (source device, destination device) -> index of the first candidate
+        # that has not failed as unsupported between them
+        self._working: dict[tuple[int, int], int] = {}
+
+    def stage(
+        self, src_path: Path, dest_path: Path, check: Optional[StagingCheck] = None
+    ) -> int:
+        """Place ``src_path`` at ``dest_path``, whose parent must exist.
+
+        With ``check`` every staged byte is passed to it, see ``_stage_checked``.
+        Returns the size of the staged file.
+        """
+        if check is not None:
+            return self._stage_checked(src_path, dest_path, check)
+
+        st = os.stat(src_path)
+        key = (st.st_dev, os.stat(dest_path.parent).st_dev)
+        # never write through an earlier staged file, it may be a hardlink
+        # to an input
+        if os.path.lexists(dest_path):
+            os.unlink(dest_path)
+
+        index = self._working.get(key, 0)
+        while True:
+            method = self._candidates[index]
+            try:
+                _METHODS[method](src_path, dest_path)
+                break
+            except StagingUnsupported as e:
+                if os.path.lexists(dest_path):
+                    os.unlink(dest_path)
+                if index + 1 == len(self._candidates):
+                    raise RuntimeError(
+                        f"Cannot stage {src_path} at {dest_path} with {method}: {e}"
+                    )
+                logging.debug(f"Staging with {method} is not supported here: {e}")
+                index += 1
+        self._working[key] = index
+        return st.st_size
+
+    def _stage_checked(
+        self, src_path: Path, dest_path: Path, check: StagingCheck
+    ) -> int:
+        """Stage a private copy of ``src_path`` while passing its bytes to ``check``.
+
+        The source is opened once and its bytes are read once: a reflink is
+        read back from the clone, which later writes to the source cannot
+        change, and a copy through the buffer that writes it. Hardlinks and
+        ``copy_file_range`` cannot give that guarantee, ``auto`` skips them
+        and choosing one of them explicitly is an error.
+        """
+        if self.strategy not in _CHECKED_METHODS and self.strategy != STAGING_AUTO:
+            raise RuntimeError(
+                f"Staging with {self.strategy} cannot verify inputs, "
+                "choose another REBUILDR_STAGING or set REBUILDR_VERIFY_INPUTS=0"
+            )
+        if os.path.lexists(dest_path):
+            os.unlink(dest_path)
+        with open(src_path, "rb", buffering=0) as src:
+            st = os.fstat(src.fileno())
+            check.start(st)
+            key = (st.st_dev, os.stat(dest_path.parent).st_dev)
+            index = self._working.get(key, 0)
+            while True:
+                method = self._candidates[index]
+                if method not in _CHECKED_METHODS:
+                    index += 1
+                    continue
+                try:
+                    _CHECKED_METHODS[method](src, src_path, dest_path, check)
+                    break
+                except StagingUnsupported as e:
+                    if os.path.lexists(dest_path):
+                        os.unlink(dest_path)
+                    if index + 1 == len(self._candidates):
+                        raise RuntimeError(
+                            f"Cannot stage {src_path} at {dest_path} with {method}: {e}"
+                        )
+                    logging.debug(f"Staging with {method} is not supported here: {e}")
+                    index += 1
+                    self._working[key] = index
+            check.finish(os.fstat(src.fileno()))
+        shutil.copystat(src_path, dest_path)
+        return st.st_size
@@ -1,14 +1,36 @@
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import hashlib
+from pathlib import Path, PurePath
 import logging
+import os
+import shutil
 import subprocess
-from typing import List
+import tarfile
+from typing import Callable, List, Optional, TypeVar
+
+from rebuildr.cache import cache_dir, cache_key, env_int, file_lock
+from rebuildr.hashing import hash_file
+
+T = TypeVar("T")
+
+# modification time of the files of external repositories, 2010-10-10 11:11
+# UTC, so they do not depend on when or where they were fetched
+EXTERNAL_MTIME = 1286709060
 
 
 def set_specific_timestamps_recursively(path: Path):
-    args = ["find", str(path), "-exec", "touch", "-t", "201010101111.00", "{}", "+"]
+    """Set the modification time of the tree at ``path`` to ``EXTERNAL_MTIME``."""
     try:
-        subprocess.run(args, check=True)
-    except subprocess.CalledProcessError as e:
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in dirnames + filenames:
+                os.utime(
+                    os.path.join(dirpath, name),
+                    (EXTERNAL_MTIME, EXTERNAL_MTIME),
+                    follow_symlinks=False,
+                )
+        os.utime(path, (EXTERNAL_MTIME, EXTERNAL_MTIME))
+    except OSError as e:
         raise RuntimeError(f"Failed to set timestamps recursively for {path}: {e}")
 
 
@@ -32,20 +54,206 @@ def git_clone(url: str, target_path: Path, ref: str):
     git_checkout(target_path, ref)
 
 
-def git_better_clone(url: str, target_path: Path, ref: str):
-    if (target_path / ".git").exists():
-        logging.info(f"Reusing {target_path}")
-        git_checkout(target_path, ref, force=True)
-    else:
-        target_path.mkdir(parents=True, exist_ok=True)
-        logging.info(f"Cloning {url} to {target_path}")
-        git_command(["init", str(target_path)])
-        git_command(["remote", "add", "origin", url], cwd=str(target_path))
-        git_command(["fetch", "origin", ref], cwd=str(target_path))
-        git_checkout(target_path, ref, force=True)
+def _has_commit(repo_path: Path, commit: str) -> bool:
+    # unlike cat-file, rev-list never fetches missing objects of a partial clone
+    return (
+        git_command(
+            ["rev-list", "--no-walk", "--missing=print", commit],
+            cwd=str(repo_path),
+            capture_output=True,
+            check=False,
+        ).returncode
+        == 0
+    )
+
+
+def git_better_clone(
+    url: str, target_path: Path, ref: str, subpath: Optional[PurePath] = None
+):
+    """Place the files of ``ref`` of ``url`` at ``target_path``.
+
+    The files are exported from the shared cache repository of ``url`` (see
+    ``git_fetch_to_cache``), so a commit fetched once is placed again
+    without any network access. They are written without a ``.git``
+    directory (see ``EXTERNAL_LAYOUT`` in ``rebuildr.stable_descriptor``):
+    a checkout borrowing objects from the cache would point to host paths
+    that do not exist where the build context is used. With ``subpath``
+    only the files of that directory are fetched and exported.
+    """
+    git_export(url, target_path, ref, subpath)
+
+
+def git_export(
+    url: str, target_path: Path, commit: str, subpath: Optional[PurePath] = None
+):
+    """Replace the content of ``target_path`` with ``subpath`` of ``commit``.
+
+    Only the blobs below ``subpath``, or all of them when None, are fetched
+    into the cache repository. The files are written like ``git archive``
+    streams them, without a ``.git`` directory.
+    """
+    repo_path = git_fetch_to_cache(url, commit, subpath)
+    logging.info(
+        f"Exporting {subpath or 'files'} of {url} at {commit} to {target_path}"
+    )
+    try:
+        if target_path.exists():
+            shutil.rmtree(target_path)
+        target_path.mkdir(parents=True)
+    except (OSError, IOError) as e:
+        raise RuntimeError(f"Failed to prepare {target_path} for {url}: {e}")
+    with git_archive(repo_path, commit, subpath) as p:
+        try:
+            with tarfile.open(fileobj=p.stdout, mode="r|") as archive:
+                # modes are kept as git archive writes them, not masked by
+                # the umask; the filter only exists in newer Pythons
+                if hasattr(tarfile, "tar_filter"):
+                    archive.extractall(target_path, filter="tar")
+                else:
+                    archive.extractall(target_path)
+        except (OSError, tarfile.TarError) as e:
+            raise RuntimeError(
+                f"Failed to export {subpath or 'files'} of {commit} from {url}: {e}"
+            )
+    if p.returncode != 0:
+        raise RuntimeError(
+            f"Failed to export {subpath or 'files'} of {commit} from {url}"
+        )
     set_specific_timestamps_recursively(target_path)
 
 
+def _tree_ish(commit: str, subpath: Optional[PurePath]) -> str:
+    if subpath is None:
+        return f"{commit}^{{tree}}"
+    return f"{commit}:{subpath.as_posix()}"
+
+
+def _missing_blobs(
+    repo_path: Path, commit: str, subpath: Optional[PurePath]
+) -> list[str]:
+    """Blobs below ``subpath`` of ``commit`` not fetched into ``repo_path`` yet."""
+    listed = git_command(
+        ["rev-list", "--objects", "--missing=print", _tree_ish(commit, subpath)],
+        cwd=str(repo_path),
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if listed.returncode != 0:
+        raise RuntimeError(
+            f"Cannot list {subpath or 'files'} of {commit}: {listed.stderr.strip()}"
+        )
+    return [line[1:] for line in listed.stdout.splitlines() if line.startswith("?")]
+
+
+def _configure_partial_clone(repo_path: Path, url: str):
+    """Make ``url`` the promisor remote objects may be left out from."""
+    for key, value in [
+        ("core.repositoryformatversion", "1"),
+        ("extensions.partialClone", "origin"),
+        ("remote.origin.url", url),
+        ("remote.origin.promisor", "true"),
+        ("remote.origin.partialclonefilter", "blob:none"),
+    ]:
+        git_command(["config", key, value], cwd=str(repo_path))
+    # archives hold every file of the commit, as a checkout would, and not
+    # what .gitattributes of the repository export
+    attributes = repo_path / "info" / "attributes"
+    try:
+        attributes.parent.mkdir(parents=True, exist_ok=True)
+        attributes.write_text("* -export-ignore -export-subst\n")
+    except (OSError, IOError) as e:
+        raise RuntimeError(f"Failed to configure git cache {repo_path}: {e}")
+
+
+def git_fetch_to_cache(
+    url: str, commit: str, subpath: Optional[PurePath] = None
+) -> Path:
+    """Fetch ``commit`` of ``url`` into a bare repository in the cache directory.
+
+    There is one repository per url, shared by all builds and processes and
+    locked while it is fetched into. Only the commit itself and its trees
+    are fetched (``--depth=1 --filter=blob:none``), followed by the blobs
+    below ``subpath``, or all of them when None, in a single batch. Nothing
+    is fetched when they are there already. Every fetched commit is kept by
+    a ``refs/rebuildr/`` ref, so garbage collection never prunes objects
+    that checkouts borrow.
+    """
+    repo_path = cache_dir() / "git" / cache_key(url)
+    if (
+        (repo_path / "HEAD").exists()
+        and (repo_path / "info" / "attributes").exists()
+        and _has_commit(repo_path, commit)
+        and len(_missing_blobs(repo_path, commit, subpath)) == 0
+    ):
+        return repo_path
+    with file_lock(repo_path.with_suffix(".lock")):
+        if not (repo_path / "HEAD").exists():
+            logging.info(f"Creating git cache {repo_path} for {url}")
+            git_command(["init", "--bare", "--quiet", str(repo_path)])
+        _configure_partial_clone(repo_path, url)
+        if not _has_commit(repo_path, commit):
+            logging.info(f"Fetching {commit} from {url}")
+            git_command(
+                [
+                    "fetch",
+                    "--quiet",
+                    "--no-tags",
+                    "--depth=1",
+                    "--filter=blob:none",
+                    "origin",
+                    commit,
+                ],
+                cwd=str(repo_path),
+            )
+            git_command(
+                ["update-ref", f"refs/rebuildr/{commit}", "FETCH_HEAD^{commit}"],
+                cwd=str(repo_path),
+            )
+        missing = _missing_blobs(repo_path, commit, subpath)
+        if len(missing) > 0:
+            logging.info(f"Fetching {len(missing)} files of {commit} from {url}")
+            # the same request git makes when it fetches missing objects itself
+            git_command(
+                [
+                    "-c",
+                    "fetch.negotiationAlgorithm=noop",
+                    "fetch",
+                    "--quiet",
+                    "--no-tags",
+                    "--no-write-fetch-head",
+                    "--recurse-submodules=no",
+                    "--filter=blob:none",
+                    "--stdin",
+                    "origin",
+                ],
+                cwd=str(repo_path),
+                input="".join(f"{oid}\n" for oid in missing),
+                text=True,
+            )
+    return repo_path
+
+
+def git_archive(
+    repo_path: Path, commit: str, subpath: Optional[PurePath] = None
+) -> subprocess.Popen:
+    """Start ``git archive`` of ``commit``, its tar is read from ``stdout``.
+
+    With ``subpath`` the archive holds the content of that directory.
+    """
+    tree_ish = commit if subpath is None else _tree_ish(commit, subpath)
+    try:
+        return subprocess.Popen(
+            ["git", "-c", "tar.umask=0022", "archive", "--format=tar", tree_ish],
+            cwd=str(repo_path),
+            stdout=subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        raise RuntimeError(
+            "Git command not found. Please ensure git is installed and in PATH."
+        )
+
+
 def git_checkout(repo_path: Path, ref: str, force: bool = False):
     logging.info(f"Checking out {ref} in {repo_path}")
     args = ["checkout"]
@@ -70,3 +278,272 @@ def git_ls_remote(url: str, ref: str) -> str:
         return result.stdout.split()[0]
     except Exception as e:
         raise RuntimeError(f"Failed to list remote refs for {url}: {e}")
+
+
+def git_workers() -> int:
+    """Number of remotes contacted at once (``REBUILDR_GIT_WORKERS``, 8 by default)."""
+    workers = env_int("REBUILDR_GIT_WORKERS", 8)
+    if workers < 1:
+        raise ValueError(f"Git workers must be at least 1, got {workers}")
+    return workers
+
+
+def run_concurrently(jobs: list[Callable[[], T]]) -> list[T]:
+    """Run ``jobs`` on ``git_workers`` threads and return their results in order.
+
+    Every job runs to completion even when others fail. Failures are raised
+    afterwards in the order of the jobs, all of them in one error when there
+    are several, so what is reported does not depend on which remote
+    answered first.
+    """
+    if len(jobs) <= 1:
+        return [job() for job in jobs]
+    with ThreadPoolExecutor(
+        max_workers=min(git_workers(), len(jobs)), thread_name_prefix="rebuildr-git"
+    ) as executor:
+        futures = [executor.submit(job) for job in jobs]
+    errors = [future.exception() for future in futures if future.exception()]
+    if len(errors) == 1:
+        raise errors[0]
+    if len(errors) > 1:
+        raise RuntimeError("\n".join(str(e) for e in errors)) from errors[0]
+    return [future.result() for future in futures]
+
+
+def git_ls_remote_all(refs: list[tuple[str, str]]) -> list[str]:
+    """``git_ls_remote`` of every (url, ref) pair, resolved concurrently."""
+    unique = list(dict.fromkeys(refs))
+    commits = dict(
+        zip(
+            unique,
+            run_concurrently([partial(git_ls_remote, url, ref) for url, ref in unique]),
+        )
+    )
+    return [commits[pair] for pair in refs]
+
+
+# only regular files are taken from the index, symlinks and gitlinks are hashed directly
+_REGULAR_FILE_MODES = ("100644", "100755")
+
+
+def find_git_worktree(
+    directory: Path, cache: dict[Path, Optional[Path]]
+) -> Optional[Path]:
+    """Return the root of the git worktree containing ``directory``, if any.
+
+    ``cache`` maps already visited directories to their worktree root and is
+    filled in along the way, so inputs sharing directories walk up only once.
+    """
+    visited = []
+    current = directory
+    while True:
+        if current in cache:
+            root = cache[current]
+            break
+        visited.append(current)
+        if os.path.lexists(current / ".git"):
+            root = current
+            break
+        if current.parent == current:
+            root = None
+            break
+        current = current.parent
+    for path in visited:
+        cache[path] = root
+    return root
+
+
+def git_object_format(repo_path: Path) -> str:
+    result = git_command(
+        ["rev-parse", "--show-object-format"],
+        cwd=str(repo_path),
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    object_format = result.stdout.strip()
+    if result.returncode != 0 or object_format == "":
+        return "sha1"
+    return object_format
+
+
+def git_index_entries(repo_path: Path, pathspec: str) -> dict[str, Optional[str]]:
+    """Index state of the regular files below ``pathspec``.
+
+    Runs one ``git ls-files`` and one ``git diff-files`` for the whole
+    pathspec. Maps each path, relative to ``repo_path``, to its blob id when
+    the worktree file matches the index, or to None when it is tracked but
+    modified or its stat information cannot be trusted (assume-unchanged,
+    skip-worktree). Unmerged entries, symlinks and gitlinks are left out.
+    """
+    pathspec_args = ["--", pathspec] if pathspec != "." else []
+    ls_files = git_command(
+        ["--literal-pathspecs", "ls-files", "-s", "-v", "-z"] + pathspec_args,
+        cwd=str(repo_path),
+        capture_output=True,
+    )
+    diff_files = git_command(
+        ["--literal-pathspecs", "diff-files", "--name-only", "-z"] + pathspec_args,
+        cwd=str(repo_path),
+        capture_output=True,
+    )
+    modified = set(os.fsdecode(path) for path in diff_files.stdout.split(b"\0"))
+
+    entries = {}
+    unmerged = set()
+    for record in ls_files.stdout.split(b"\0"):
+        if not record:
+            continue
+        # <tag> <mode> <object> <stage>\t<path>
+        info, _, path = record.partition(b"\t")
+        tag, mode, object_id, stage = info.decode().split(" ")
+        path = os.fsdecode(path)
+        if stage != "0":
+            unmerged.add(path)
+        elif mode in _REGULAR_FILE_MODES:
+            clean = tag == "H" and path not in modified
+            entries[path] = object_id if clean else None
+    for path in unmerged:
+        entries.pop(path, None)
+    return entries
+
+
+# attributes under which git stores other bytes than those in the worktree
+_CONVERSION_ATTRIBUTES = ["filter", "text", "eol", "ident", "working-tree-encoding"]
+
+
+def git_converted_paths(repo_path: Path, paths: list[str]) -> set[str]:
+    """The ``paths`` whose content git converts between worktree and blob.
+
+    Runs one ``git check-attr`` for all of them. A path is converted when
+    one of ``_CONVERSION_ATTRIBUTES`` is set for it, or, with
+    ``core.autocrlf`` enabled, unless it is marked ``-text``.
+    """
+    if len(paths) == 0:
+        return set()
+    autocrlf = git_command(
+        ["config", "--get", "core.autocrlf"],
+        cwd=str(repo_path),
+        capture_output=True,
+        text=True,
+        check=False,
+    ).stdout.strip()
+    result = git_command(
+        ["check-attr", "-z", "--stdin"] + _CONVERSION_ATTRIBUTES,
+        cwd=str(repo_path),
+        input=b"".join(os.fsencode(path) + b"\0" for path in paths),
+        capture_output=True,
+    )
+    fields = result.stdout.split(b"\0")
+    converted = set()
+    binary = set()
+    # <path> NUL <attribute> NUL <info> NUL
+    for i in range(0, len(fields) - 2, 3):
+        path, attribute, info = (os.fsdecode(field) for field in fields[i : i + 3])
+        if info not in ("unspecified", "unset"):
+            converted.add(path)
+        elif attribute == "text" and info == "unset":
+            binary.add(path)
+    if autocrlf.lower() in ("true", "yes", "on", "1", "input"):
+        converted |= set(paths) - binary
+    return converted
+
+
+def git_hash_objects(repo_path: Path, paths: list[str]) -> list[str]:
+    """Blob ids git would store for ``paths``, applying the repo's filters."""
+    if len(paths) == 0:
+        return []
+    result = git_command(
+        ["hash-object", "--stdin-paths"],
+        cwd=str(repo_path),
+        input="".join(f"{path}\n" for path in paths),
+        capture_output=True,
+        text=True,
+    )
+    object_ids = result.stdout.split()
+    if len(object_ids) != len(paths):
+        raise RuntimeError(f"Unexpected output of git hash-object in {repo_path}")
+    return object_ids
+
+
+def git_blob_id(path: Path, object_format: str = "sha1") -> str:
+    """Compute the git blob id of the file at ``path`` without running git."""
+    try:
+        size = path.stat().st_size
+    except (OSError, IOError) as e:
+        raise RuntimeError(f"Failed to stat file {path}: {e}")
+    hasher = hashlib.new(object_format)
+    hasher.update(f"blob {size}\0".encode())
+    if hash_file(path, (hasher,)) != size:
+        raise RuntimeError(f"File {path} changed while it was hashed")
+    return hasher.hexdigest()
+
+
+def git_blob_ids(paths: list[Path], workers: int = 1) -> list[str]:
+    """Return the git blob id of every file in ``paths``, in order.
+
+    Blob ids are those of the bytes in the worktree. Files tracked and
+    unmodified in a git worktree take their blob id from the index without
+    being read, and modified tracked files are hashed by ``git hash-object``,
+    unless git converts their content (see ``git_converted_paths``): the
+    blob would then differ from the file. Those, untracked files, symlinks
+    and files outside any repository are hashed directly with ``workers``
+    threads. Git runs a fixed number of times per repository, independent
+    of the number of files.
+    """
+    worktrees: dict[Path, Optional[Path]] = {}
+    by_repo: dict[Path, list[tuple[int, str]]] = {}
+    object_ids: list[Optional[str]] = [None] * len(paths)
+    # (index, object format) of files hashed without git
+    direct: list[tuple[int, str]] = []
+    object_formats: dict[Path, str] = {}
+    for index, path in enumerate(paths):
+        repo_path = find_git_worktree(path.parent, worktrees)
+        if repo_path is None:
+            direct.append((index, "sha1"))
+            continue
+        by_repo.setdefault(repo_path, []).append(
+            (index, path.relative_to(repo_path).as_posix())
+        )
+
+    for repo_path, repo_files in by_repo.items():
+        object_formats[repo_path] = git_object_format(repo_path)
+        common = os.path.commonpath([rel_path for _, rel_path in repo_files])
+        entries = git_index_entries(repo_path, common or ".")
+        converted = git_converted_paths(
+            repo_path, [rel_path for _, rel_path in repo_files if rel_path in entries]
+        )
+
+        modified = []
+        for index, rel_path in repo_files:
+            tracked = (
+                rel_path in entries
+                and rel_path not in converted
+                and not os.path.islink(paths[index])
+            )
+            if tracked and entries[rel_path] is not None:
+                object_ids[index] = entries[rel_path]
+            elif tracked and "\n" not in rel_path:
+                modified.append((index, rel_path))
+            else:
+                direct.append((index, object_formats[repo_path]))
+        object_ids_of_modified = git_hash_objects(
+            repo_path, [rel_path for _, rel_path in modified]
+        )
+        for (index, _), object_id in zip(modified, object_ids_of_modified):
+            object_ids[index] = object_id
+
+    logging.debug(
+        f"Git blob ids: {len(paths) - len(direct)} from git, {len(direct)} hashed directly"
+    )
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="rebuildr-hash"
+    ) as executor:
+        hashed = executor.map(
+            git_blob_id,
+            [paths[index] for index, _ in direct],
+            [object_format for _, object_format in direct],
+        )
+        for (index, _), object_id in zip(direct, hashed):
+            object_ids[index] = object_id
+    return object_ids
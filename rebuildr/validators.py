@@ -1,4 +1,5 @@
 from pathlib import PurePath
+from typing import Optional
 
 
 def target_path_is_set(target_path: str | PurePath, klass: type):
@@ -6,6 +7,16 @@ def target_path_is_set(target_path: str | PurePath, klass: type):
         raise ValueError(f"{klass.__name__}.target_path must be set and not empty")
 
 
+def subpath_is_relative(subpath: Optional[str | PurePath], klass: type):
+    if subpath is None:
+        return
+    path = PurePath(subpath)
+    if path.is_absolute() or ".." in path.parts or str(path) == ".":
+        raise ValueError(
+            f"{klass.__name__}.subpath={subpath} must be a directory inside the repository"
+        )
+
+
 def target_path_is_not_root(target_path: str | PurePath, klass: type):
     path = PurePath(target_path)
 
@@ -0,0 +1,89 @@
+import hashlib
+import os
+from pathlib import Path, PurePath
+from typing import Optional
+
+from rebuildr.hashing import new_hasher
+from rebuildr.stable_descriptor import CONTENT_ID_GIT, ContentId, InputDigest
+
+
+# git object format of a blob id, by its length in hex digits
+_GIT_OBJECT_FORMATS = {40: "sha1", 64: "sha256"}
+
+
+def _git_blob_hasher(expected: InputDigest):
+    """A hasher producing the git blob id of a file of ``expected.size``."""
+    object_format = _GIT_OBJECT_FORMATS.get(len(expected.digest))
+    if object_format is None:
+        raise RuntimeError(f"Unknown git object id {expected.digest}")
+    hasher = hashlib.new(object_format)
+    hasher.update(f"blob {expected.size}\0".encode())
+    return hasher
+
+
+class InputCheck(object):
+    """Checks that the bytes a sink reads from an input are the hashed ones.
+
+    A sink reading the input to stage or archive it calls ``start`` with the
+    stat of the opened file, ``update`` with every chunk it reads and
+    ``finish`` with a stat taken after the last read. The build fails when
+    the file differs from what the content id was computed from or changed
+    while it was read, so the input is read once and the built image is
+    guaranteed to match its content id.
+
+    Git content ids are checked against the blob id of the bytes read,
+    which is what ``git_blob_ids`` records for every file.
+    """
+
+    def __init__(self, path: Path, expected: InputDigest, content_id: ContentId):
+        self.path = path
+        self.expected = expected
+        self.content_id = content_id
+        self.st: Optional[os.stat_result] = None
+        self.hasher = None
+        self.size = 0
+
+    def _changed(self, reason: str) -> RuntimeError:
+        return RuntimeError(
+            f"Input {self.path} {reason} since content id {self.content_id.tag()} was computed"
+        )
+
+    def start(self, st: os.stat_result):
+        if st.st_size != self.expected.size or st.st_mode != self.expected.mode:
+            raise self._changed("changed")
+        self.st = st
+        self.size = 0
+        if self.content_id.scheme == CONTENT_ID_GIT:
+            self.hasher = _git_blob_hasher(self.expected)
+        else:
+            self.hasher = new_hasher(self.content_id.algorithm)
+
+    def update(self, chunk):
+        self.hasher.update(chunk)
+        self.size += len(chunk)
+
+    def finish(self, st: os.stat_result):
+        if (
+            self.size != self.st.st_size
+            or st.st_size != self.st.st_size
+            or st.st_mtime_ns != self.st.st_mtime_ns
+        ):
+            raise self._changed("was modified while it was read")
+        if self.hasher.hexdigest() != self.expected.digest:
+            raise self._changed("changed")
+
+
+class InputVerifier(object):
+    """Hands out an ``InputCheck`` for every input file of ``content_id``."""
+
+    def __init__(self, content_id: ContentId):
+        self.content_id = content_id
+
+    def check(self, path: Path, target_path: PurePath, builder: bool) -> InputCheck:
+        digests = self.content_id.builders if builder else self.content_id.files
+        expected = digests.get(target_path)
+        if expected is None:
+            raise RuntimeError(
+                f"Input {path} is not part of content id {self.content_id.tag()}"
+            )
+        return InputCheck(path, expected, self.content_id)
@@ -0,0 +1,295 @@
+import fnmatch
+import os
+from pathlib import Path
+import re
+from typing import Iterator, Optional, Sequence
+
+from rebuildr.ignore import ExcludeRules
+from rebuildr.listing_cache import (
+    KIND_DIR,
+    KIND_FILE,
+    KIND_SYMLINK,
+    ListingCache,
+    entry_kind,
+)
+
+# Glob expansion over memoized directory listings.
+#
+# The functions below follow CPython's glob module (3.11) step by step, so a
+# pattern matches exactly what ``glob.glob(pattern, root_dir=...,
+# recursive=True)`` returns, but every directory is read with a single
+# ``os.scandir`` shared by all patterns of a descriptor, and the type
+# information of the ``DirEntry`` objects answers existence and file checks
+# without further stats.
+
+_magic_check = re.compile("([*?[])")
+
+
+def has_magic(s: str) -> bool:
+    return _magic_check.search(s) is not None
+
+
+def _ishidden(path: str) -> bool:
+    return path[0] == "."
+
+
+def _isrecursive(pattern: str) -> bool:
+    return pattern == "**"
+
+
+def _join(dirname: str, basename: str) -> str:
+    # It is common if dirname or basename is empty
+    if not dirname or not basename:
+        return dirname or basename
+    return os.path.join(dirname, basename)
+
+
+class _CachedEntry(object):
+    """The parts of ``os.DirEntry`` the walker uses, for a ``ListingCache`` hit."""
+
+    __slots__ = ("name", "path", "_kind")
+
+    def __init__(self, dirname: str, name: str, kind: str):
+        self.name = name
+        self.path = os.path.join(dirname, name)
+        self._kind = kind
+
+    def is_symlink(self) -> bool:
+        return self._kind == KIND_SYMLINK
+
+    def is_dir(self, follow_symlinks: bool = True) -> bool:
+        if self._kind == KIND_SYMLINK:
+            return follow_symlinks and os.path.isdir(self.path)
+        return self._kind == KIND_DIR
+
+    def is_file(self, follow_symlinks: bool = True) -> bool:
+        if self._kind == KIND_SYMLINK:
+            return follow_symlinks and os.path.isfile(self.path)
+        return self._kind == KIND_FILE
+
+
+class DirectoryWalker(object):
+    """Expands globs and directory inputs, reading each directory once.
+
+    One walker is shared by all inputs of a descriptor, so overlapping
+    patterns such as ``src/**/*.py`` and ``src/**/*.json`` walk ``src`` once.
+    With a ``ListingCache`` directories unchanged since an earlier run are
+    not read at all, only stat'ed.
+    """
+
+    def __init__(self, cache: Optional[ListingCache] = None):
+        self._cache = cache
+        # absolute directory -> its entries by name, None if it cannot be listed
+        self._listings: dict[str, Optional[dict[str, os.DirEntry]]] = {}
+        # exclude rules of the expansion in progress, excluded entries are
+        # dropped from listings so excluded directories are never entered
+        self._prune: Sequence[ExcludeRules] = ()
+
+    def _entries(self, dirname: str) -> Optional[dict[str, os.DirEntry]]:
+        listing = self._listings.get(dirname, False)
+        if listing is not False:
+            return listing
+        if self._cache is not None:
+            listing = self._cached_entries(dirname)
+        else:
+            try:
+                with os.scandir(dirname or os.curdir) as it:
+                    listing = {entry.name: entry for entry in it}
+            except OSError:
+                listing = None
+        self._listings[dirname] = listing
+        return listing
+
+    def _cached_entries(self, dirname: str) -> Optional[dict]:
+        path = os.path.abspath(dirname or os.curdir)
+        try:
+            # taken before listing, a change in between makes the next run rescan
+            st = os.stat(path)
+            kinds = self._cache.lookup(path, st)
+            if kinds is not None:
+                return {
+                    name: _CachedEntry(dirname, name, kind)
+                    for name, kind in kinds.items()
+                }
+            with os.scandir(dirname or os.curdir) as it:
+                listing = {entry.name: entry for entry in it}
+        except OSError:
+            return None
+        self._cache.store(
+            path, st, {name: entry_kind(entry) for name, entry in listing.items()}
+        )
+        return listing
+
+    def flush(self):
+        """Persist the directory listings read by this walker, if cached."""
+        if self._cache is not None:
+            self._cache.flush()
+
+    def _entry(self, path: str) -> Optional[os.DirEntry]:
+        dirname, basename = os.path.split(path)
+        if basename in ("", ".", ".."):
+            return None
+        listing = self._entries(dirname)
+        if listing is None:
+            return None
+        return listing.get(basename)
+
+    def _listdir(self, dirname: str, dironly: bool) -> list[str]:
+        listing = self._entries(dirname)
+        if listing is None:
+            return []
+        names = []
+        for name, entry in listing.items():
+            if self._prune and any(rules.prunes(entry.path) for rules in self._prune):
+                continue
+            try:
+                if not dironly or entry.is_dir():
+                    names.append(name)
+            except OSError:
+                pass
+        return names
+
+    def _lexists(self, pathname: str) -> bool:
+        if self._entry(pathname) is not None:
+            return True
+        # names missing from the listing may still resolve, e.g. on
+        # case-insensitive file systems
+        return os.path.lexists(pathname)
+
+    def _glob1(
+        self, dirname: str, pattern: str, dironly: bool, include_hidden: bool
+    ) -> list[str]:
+        names = self._listdir(dirname, dironly)
+        if include_hidden or not _ishidden(pattern):
+            names = (x for x in names if include_hidden or not _ishidden(x))
+        return fnmatch.filter(names, pattern)
+
+    def _glob0(self, dirname: str, basename: str, dironly: bool) -> list[str]:
+        if basename:
+            if self._lexists(_join(dirname, basename)):
+                return [basename]
+        else:
+            # paths ending with a separator only match directories
+            if os.path.isdir(dirname):
+                return [basename]
+        return []
+
+    def _glob2(
+        self, dirname: str, pattern: str, dironly: bool, include_hidden: bool
+    ) -> Iterator[str]:
+        assert _isrecursive(pattern)
+        yield pattern[:0]
+        yield from self._rlistdir(dirname, dironly, include_hidden)
+
+    def _rlistdir(
+        self, dirname: str, dironly: bool, include_hidden: bool
+    ) -> Iterator[str]:
+        names = self._listdir(dirname, dironly)
+        for x in names:
+            if include_hidden or not _ishidden(x):
+                yield x
+                path = _join(dirname, x) if dirname else x
+                entry = self._entry(path)
+                # only directories (or links to them) have anything to list
+                if entry is not None and not _is_dir(entry):
+                    continue
+                for y in self._rlistdir(path, dironly, include_hidden):
+                    yield _join(x, y)
+
+    def _iglob(
+        self,
+        pathname: str,
+        root_dir: str,
+        dironly: bool,
+        include_hidden: bool,
+    ) -> Iterator[str]:
+        dirname, basename = os.path.split(pathname)
+        if not has_magic(pathname):
+            assert not dironly
+            if basename:
+                if self._lexists(_join(root_dir, pathname)):
+                    yield pathname
+            else:
+                # patterns ending with a slash should match only directories
+                if os.path.isdir(_join(root_dir, dirname)):
+                    yield pathname
+            return
+        if not dirname:
+            if _isrecursive(basename):
+                yield from self._glob2(root_dir, basename, dironly, include_hidden)
+            else:
+                yield from self._glob1(root_dir, basename, dironly, include_hidden)
+            return
+        if dirname != pathname and has_magic(dirname):
+            dirs = self._iglob(dirname, root_dir, True, include_hidden)
+        else:
+            dirs = [dirname]
+        for dirname in dirs:
+            dir_path = _join(root_dir, dirname)
+            if not has_magic(basename):
+                names = self._glob0(dir_path, basename, dironly)
+            elif _isrecursive(basename):
+                names = self._glob2(dir_path, basename, dironly, include_hidden)
+            else:
+                names = self._glob1(dir_path, basename, dironly, include_hidden)
+            for name in names:
+                yield os.path.join(dirname, name)
+
+    def glob(
+        self,
+        pattern: str,
+        root_dir: Path,
+        include_hidden: bool = False,
+        exclude: Sequence[ExcludeRules] = (),
+    ) -> list[str]:
+        """Same as ``glob.glob(pattern, root_dir=root_dir, recursive=True)``.
+
+        Directories excluded by ``exclude`` are pruned while walking when the
+        rules allow it; callers still filter the results with
+        ``ExcludeRules.excludes`` to apply negated patterns.
+        """
+        self._prune = [rules for rules in exclude if rules and not rules.has_negations]
+        try:
+            results = self._iglob(pattern, os.fspath(root_dir), False, include_hidden)
+            if not pattern or _isrecursive(pattern[:2]):
+                # skip the empty string yielded for a leading "**"
+                return [result for i, result in enumerate(results) if result or i > 0]
+            return list(results)
+        finally:
+            self._prune = ()
+
+    def is_file(self, path: Path) -> bool:
+        """``path.is_file()``, raising ValueError when it does not exist.
+
+        Entries that are not symlinks are answered from the directory
+        listing; only symlinks need a ``stat`` to be resolved.
+        """
+        entry = self._entry(os.fspath(path))
+        if entry is not None and not entry.is_symlink():
+            return entry.is_file(follow_symlinks=False)
+        if not path.exists():
+            raise ValueError(f"File {path} does not exist")
+        return path.is_file()
+
+    def files_below(
+        self, directory: Path, exclude: Sequence[ExcludeRules] = ()
+    ) -> list[str]:
+        """Relative paths of all files below ``directory``, hidden ones included."""
+        return [
+            path
+            for path in self.glob("**", directory, include_hidden=True, exclude=exclude)
+            if path
+            and not excluded(exclude, directory / path)
+            and self.is_file(directory / path)
+        ]
+
+
+def excluded(exclude: Sequence[ExcludeRules], path: Path) -> bool:
+    return any(rules.excludes(os.fspath(path)) for rules in exclude)
+
+
+def _is_dir(entry: os.DirEntry) -> bool:
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
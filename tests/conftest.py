@@ -0,0 +1,7 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache_dir(tmp_path_factory, monkeypatch):
+    """Keep persistent rebuildr caches out of the user's home directory."""
+    monkeypatch.setenv("REBUILDR_CACHE_DIR", str(tmp_path_factory.mktemp("cache")))
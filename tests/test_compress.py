@@ -0,0 +1,81 @@
+import gzip
+import io
+import lzma
+from pathlib import Path
+import random
+import tarfile
+
+import pytest
+
+from rebuildr.cli import load_py_desc, parse_compress_option
+from rebuildr.compress import (
+    COMPRESS_GZIP,
+    COMPRESS_XZ,
+    CompressOptions,
+    ParallelGzipWriter,
+)
+from rebuildr.fs import write_tar
+
+from tests.utils import resolve_current_dir
+
+current_dir = resolve_current_dir(__file__)
+
+
+def _data(size: int) -> bytes:
+    rng = random.Random(size)
+    words = [b"import", b"def", b"return", b"self", b"value", b"\n", b"    "]
+    return b" ".join(rng.choice(words) for _ in range(size // 4))[:size]
+
+
+def _parallel_gzip(data: bytes, workers: int, writes: int = 7) -> bytes:
+    out = io.BytesIO()
+    with ParallelGzipWriter(out, workers=workers, chunk_size=1000) as writer:
+        step = len(data) // writes + 1
+        for i in range(0, len(data), step):
+            writer.write(data[i : i + step])
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("size", [0, 999, 1000, 25_000])
+def test_parallel_gzip_is_a_valid_gzip_stream(size: int):
+    data = _data(size)
+    compressed = _parallel_gzip(data, workers=4)
+
+    assert gzip.decompress(compressed) == data
+    assert compressed == _parallel_gzip(data, workers=1, writes=3)
+
+
+@pytest.mark.parametrize(
+    "compression,decompress",
+    [(COMPRESS_GZIP, gzip.decompress), (COMPRESS_XZ, lzma.decompress)],
+)
+def test_write_tar_compresses_the_archive(tmp_path: Path, compression, decompress):
+    desc = load_py_desc(current_dir / "basic" / "simple.rebuildr.py")
+    plain = tmp_path / "ctx.tar"
+    write_tar(desc, str(plain))
+    compressed = tmp_path / f"ctx.tar.{compression}"
+    write_tar(desc, str(compressed), CompressOptions(compression, level=9))
+
+    assert decompress(compressed.read_bytes()) == plain.read_bytes()
+    with tarfile.open(compressed) as tar:
+        assert sorted(tar.getnames()) == [
+            "simple.Dockerfile",
+            "test.txt",
+            "test_renamed.txt",
+        ]
+
+
+def test_compress_options():
+    compress = CompressOptions()
+    for arg in ["--compress=xz", "--compress-level=1", "--compress-workers=3"]:
+        compress = parse_compress_option(arg, compress)
+    assert compress == CompressOptions(COMPRESS_XZ, level=1, workers=3)
+
+    for bad in [
+        "--compress=zip",
+        "--compress-level=10",
+        "--compress-workers=x",
+        "--gzip",
+    ]:
+        with pytest.raises(ValueError):
+            parse_compress_option(bad, compress)
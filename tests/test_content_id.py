@@ -0,0 +1,130 @@
+import hashlib
+import os
+from pathlib import PurePath
+import tracemalloc
+
+import pytest
+
+from rebuildr import hashing
+from rebuildr.cli import load_py_desc
+from rebuildr.descriptor import Descriptor, GlobInput, Inputs
+from rebuildr.hashing import CHUNK_SIZE
+from rebuildr.stable_descriptor import (
+    HashOptions,
+    StableDescriptor,
+    StableEnvironment,
+    StableFileInput,
+)
+
+from tests.utils import count_hashed_files, resolve_current_dir
+
+current_dir = resolve_current_dir(__file__)
+
+
+def test_content_id_is_computed_once(monkeypatch):
+    desc = load_py_desc(current_dir / "basic" / "simple.rebuildr.py")
+    env = StableEnvironment({"_TEST_VALUE_IS_NEVER_SET_ON_TEST_SYSTEM": ""}, {})
+    calls = count_hashed_files(monkeypatch)
+
+    target = desc.targets[0]
+    content_id = desc.content_id(env)
+    assert len(calls) == 3
+
+    assert desc.sha_sum(env) == content_id.digest
+    assert target.content_id_tag(desc.inputs, env).endswith(content_id.digest)
+    assert target.image_tags(desc.inputs, env) == [
+        target.content_id_tag(desc.inputs, env)
+    ]
+    assert desc.stable_inputs_dict(env)["sha256"] == content_id.digest
+    assert len(calls) == 3
+
+
+def test_content_id_depends_on_env_values(monkeypatch):
+    desc = load_py_desc(current_dir / "basic" / "simple.rebuildr.py")
+    calls = count_hashed_files(monkeypatch)
+
+    empty = desc.content_id(
+        StableEnvironment({"_TEST_VALUE_IS_NEVER_SET_ON_TEST_SYSTEM": ""}, {})
+    )
+    other = desc.content_id(
+        StableEnvironment({"_TEST_VALUE_IS_NEVER_SET_ON_TEST_SYSTEM": "other"}, {})
+    )
+    # unrelated env values do not invalidate the memoized result
+    again = desc.content_id(
+        StableEnvironment(
+            {"_TEST_VALUE_IS_NEVER_SET_ON_TEST_SYSTEM": "", "UNRELATED": "1"}, {}
+        )
+    )
+
+    assert empty.digest != other.digest
+    assert again is empty
+    assert len(calls) == 6
+
+
+def test_content_id_records_file_digests():
+    desc = load_py_desc(current_dir / "basic" / "simple.rebuildr.py")
+    content_id = desc.content_id(StableEnvironment({}, {}))
+
+    expected = hashlib.sha256(
+        (current_dir / "basic" / "test.txt").read_bytes()
+    ).hexdigest()
+    assert sorted(str(path) for path in content_id.files) == [
+        "test.txt",
+        "test_renamed.txt",
+    ]
+    for input_digest in content_id.files.values():
+        assert input_digest.digest == expected
+        assert input_digest.size == len(
+            (current_dir / "basic" / "test.txt").read_bytes()
+        )
+    assert [str(path) for path in content_id.builders] == ["simple.Dockerfile"]
+
+
+def test_large_file_is_hashed_in_chunks(tmp_path):
+    data = os.urandom(CHUNK_SIZE) * 3 + b"tail"
+    (tmp_path / "large.bin").write_bytes(data)
+    os.chmod(tmp_path / "large.bin", 0o644)
+    dep = StableFileInput(
+        target_path=PurePath("large.bin"),
+        absolute_src_path=tmp_path / "large.bin",
+    )
+
+    tracemalloc.start()
+    hasher = hashlib.sha256()
+    input_digest = dep.hash_update(hasher)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # byte-identical to hashing the whole content at once
+    assert hasher.hexdigest() == hashlib.sha256(b"large.bin" + data).hexdigest()
+    assert input_digest.digest == hashlib.sha256(data).hexdigest()
+    assert input_digest.size == len(data)
+    assert peak < len(data) // 2
+
+
+def test_parallel_hashing_matches_sequential(tmp_path, monkeypatch):
+    # make some of the files exceed the in-memory prefetch limit
+    monkeypatch.setattr(hashing, "INLINE_LIMIT", 1024)
+    for i in range(50):
+        directory = tmp_path / f"dir{i % 7}"
+        directory.mkdir(exist_ok=True)
+        (directory / f"file{i}.bin").write_bytes(os.urandom(i * 97))
+    os.chmod(tmp_path / "dir3" / "file10.bin", 0o755)
+
+    descriptor = Descriptor(inputs=Inputs(files=[GlobInput(pattern="**/*.bin")]))
+    env = StableEnvironment({}, {})
+    sequential = StableDescriptor.from_descriptor(
+        descriptor, tmp_path, hashing=HashOptions(digest_cache=False)
+    ).content_id(env)
+    parallel = StableDescriptor.from_descriptor(
+        descriptor, tmp_path, hashing=HashOptions(digest_cache=False, workers=4)
+    ).content_id(env)
+
+    assert parallel == sequential
+
+
+def test_invalid_hash_workers_names_the_variable(monkeypatch):
+    monkeypatch.setenv("REBUILDR_HASH_WORKERS", "many")
+
+    with pytest.raises(ValueError, match="REBUILDR_HASH_WORKERS: many"):
+        HashOptions.from_env()
@@ -0,0 +1,121 @@
+from pathlib import Path
+import socket
+import threading
+
+import pytest
+
+from rebuildr import cli
+from rebuildr import daemon as daemon_module
+from rebuildr.cli import load_desc, load_py_desc
+from rebuildr.daemon import Daemon, query_daemon, socket_path
+from rebuildr.stable_descriptor import HashOptions, StableEnvironment
+
+DESCRIPTOR = """
+from rebuildr.descriptor import *
+
+image = Descriptor(
+    inputs=Inputs(
+        files=[GlobInput(pattern="src/**/*.py")],
+        builders=[EnvInput("DAEMON_TEST_ENV")],
+    ),
+    targets=[ImageTarget(repository="example/daemon", tag="latest")],
+)
+"""
+
+
+@pytest.fixture
+def daemon():
+    daemon = Daemon(socket_path())
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+    yield daemon
+    daemon.stop()
+    thread.join()
+
+
+def _make_tree(root: Path) -> Path:
+    (root / "src" / "pkg").mkdir(parents=True)
+    (root / "src" / "main.py").write_text("print('hello')")
+    (root / "src" / "pkg" / "util.py").write_text("X = 1")
+    (root / "Dockerfile").write_text("FROM scratch")
+    (root / "rebuildr.py").write_text(DESCRIPTOR)
+    return root / "rebuildr.py"
+
+
+def _assert_same_as_local(path: Path, build_args: dict[str, str]):
+    desc, env = load_desc(str(path), build_args)
+    local = load_py_desc(path)
+    assert desc.content_id(env) == local.content_id(env)
+    assert desc.stable_inputs_dict(env) == local.stable_inputs_dict(env)
+    assert desc.targets == local.targets
+
+
+def test_without_daemon_falls_back(tmp_path: Path):
+    path = _make_tree(tmp_path)
+    hashing = HashOptions()
+    assert query_daemon(path, StableEnvironment({}, {}), hashing) is None
+    _assert_same_as_local(path, {})
+
+
+def test_daemon_answers_content_id(tmp_path: Path, daemon, monkeypatch):
+    path = _make_tree(tmp_path)
+    monkeypatch.setenv("DAEMON_TEST_ENV", "one")
+    _assert_same_as_local(path, {})
+    expected = load_py_desc(path).content_id(StableEnvironment({}, {}))
+
+    executed = []
+    original = cli.exec_py_desc
+    monkeypatch.setattr(
+        cli, "exec_py_desc", lambda p: executed.append(p) or original(p)
+    )
+    env = StableEnvironment({}, {})
+    for _ in range(2):
+        desc = query_daemon(path, env, HashOptions())
+        assert desc.content_id(env) == expected
+    assert executed == []
+
+
+def test_daemon_keeps_excludes(tmp_path: Path, daemon):
+    path = _make_tree(tmp_path)
+    path.write_text(
+        DESCRIPTOR.replace(
+            'GlobInput(pattern="src/**/*.py")',
+            'GlobInput(pattern="**/*.py", root_dir="src", exclude=["pkg/**"])',
+        )
+    )
+    _assert_same_as_local(path, {})
+
+    desc, env = load_desc(str(path), {})
+    assert desc.stable_inputs_dict(env)["inputs"]["excludes"] != []
+    assert desc.inputs.sha_sum(env) == load_py_desc(path).inputs.sha_sum(env)
+
+
+def test_daemon_sees_changes(tmp_path: Path, daemon):
+    path = _make_tree(tmp_path)
+    _assert_same_as_local(path, {})
+
+    (tmp_path / "src" / "main.py").write_text("print('changed')")
+    _assert_same_as_local(path, {})
+
+    (tmp_path / "src" / "pkg" / "new").mkdir()
+    (tmp_path / "src" / "pkg" / "new" / "added.py").write_text("added")
+    _assert_same_as_local(path, {})
+
+    (tmp_path / "src" / "pkg" / "util.py").unlink()
+    _assert_same_as_local(path, {})
+
+
+def test_hung_daemon_falls_back(tmp_path: Path, monkeypatch):
+    path = _make_tree(tmp_path)
+    monkeypatch.setattr(daemon_module, "_QUERY_TIMEOUT_SECONDS", 0.1)
+    # accepts connections but never answers
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(str(socket_path()))
+        server.listen()
+        assert query_daemon(path, StableEnvironment({}, {}), HashOptions()) is None
+
+
+def test_daemon_can_be_disabled(tmp_path: Path, daemon, monkeypatch):
+    path = _make_tree(tmp_path)
+    monkeypatch.setenv("REBUILDR_DAEMON", "0")
+    assert query_daemon(path, StableEnvironment({}, {}), HashOptions()) is None
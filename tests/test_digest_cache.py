@@ -0,0 +1,108 @@
+import os
+from pathlib import Path
+import time
+
+import pytest
+
+from rebuildr import digest_cache
+from rebuildr.descriptor import Descriptor, FileInput, GlobInput, Inputs
+from rebuildr.stable_descriptor import (
+    HashOptions,
+    StableDescriptor,
+    StableEnvironment,
+)
+
+from tests.utils import count_hashed_files
+
+
+@pytest.fixture
+def no_racy_window(monkeypatch):
+    # files created by the tests are always fresh, their ctime cannot be backdated
+    monkeypatch.setattr(digest_cache, "RACY_WINDOW_NS", 0)
+
+
+def _make_tree(root: Path):
+    (root / "sub").mkdir()
+    (root / "a.txt").write_text("a")
+    (root / "sub" / "b.txt").write_text("b")
+    past = time.time() - 60
+    for path in (root / "a.txt", root / "sub" / "b.txt"):
+        os.utime(path, (past, past))
+
+
+def _load(root: Path, digest_cache: bool = True) -> StableDescriptor:
+    desc = StableDescriptor.from_descriptor(
+        Descriptor(inputs=Inputs(files=[GlobInput(pattern="**/*.txt")])), root
+    )
+    desc.inputs.hashing = HashOptions(digest_cache=digest_cache)
+    return desc
+
+
+def test_warm_tree_is_not_read(tmp_path: Path, monkeypatch, no_racy_window):
+    _make_tree(tmp_path)
+    env = StableEnvironment({}, {})
+    cold = _load(tmp_path).content_id(env)
+
+    calls = count_hashed_files(monkeypatch)
+    warm = _load(tmp_path).content_id(env)
+
+    assert calls == []
+    assert warm.digest == cold.digest
+    assert warm.files == cold.files
+
+
+def test_changed_file_is_rehashed(tmp_path: Path, monkeypatch, no_racy_window):
+    _make_tree(tmp_path)
+    env = StableEnvironment({}, {})
+    cold = _load(tmp_path).content_id(env)
+
+    (tmp_path / "a.txt").write_text("changed")
+    calls = count_hashed_files(monkeypatch)
+    changed = _load(tmp_path).content_id(env)
+
+    assert len(calls) == 2
+    assert changed.digest != cold.digest
+    assert changed.digest == _load(tmp_path, digest_cache=False).content_id(env).digest
+
+
+def test_racy_files_are_not_cached(tmp_path: Path, monkeypatch):
+    _make_tree(tmp_path)
+    env = StableEnvironment({}, {})
+    _load(tmp_path).content_id(env)
+
+    calls = count_hashed_files(monkeypatch)
+    _load(tmp_path).content_id(env)
+
+    assert len(calls) == 2
+
+
+def test_disabled_cache_reads_every_time(tmp_path: Path, monkeypatch):
+    _make_tree(tmp_path)
+    env = StableEnvironment({}, {})
+    _load(tmp_path, digest_cache=False).content_id(env)
+
+    calls = count_hashed_files(monkeypatch)
+    _load(tmp_path, digest_cache=False).content_id(env)
+
+    assert len(calls) == 2
+    assert not (Path(os.environ["REBUILDR_CACHE_DIR"]) / "digests").exists()
+
+
+def test_env_switch_disables_cache(monkeypatch):
+    monkeypatch.setenv("REBUILDR_DIGEST_CACHE", "0")
+    assert HashOptions.from_env().digest_cache is False
+    monkeypatch.delenv("REBUILDR_DIGEST_CACHE")
+    assert HashOptions.from_env().digest_cache is True
+
+
+def test_explicit_file_inputs_share_cache(tmp_path: Path, monkeypatch, no_racy_window):
+    _make_tree(tmp_path)
+    env = StableEnvironment({}, {})
+    descriptor = Descriptor(inputs=Inputs(files=[FileInput("a.txt")]))
+    cold = StableDescriptor.from_descriptor(descriptor, tmp_path).content_id(env)
+
+    calls = count_hashed_files(monkeypatch)
+    warm = StableDescriptor.from_descriptor(descriptor, tmp_path).content_id(env)
+
+    assert calls == []
+    assert warm.digest == cold.digest
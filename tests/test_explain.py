@@ -0,0 +1,106 @@
+import gzip
+import os
+from pathlib import Path
+
+from rebuildr.cli import explain, parse_and_print_py, record_input_manifest
+from rebuildr.descriptor import Descriptor, EnvInput, GlobInput, Inputs
+from rebuildr.explain import (
+    diff_manifests,
+    input_manifest,
+    last_build,
+    load_manifest,
+    record_last_build,
+)
+from rebuildr.stable_descriptor import StableDescriptor, StableEnvironment
+
+
+def _load(root: Path) -> StableDescriptor:
+    return StableDescriptor.from_descriptor(
+        Descriptor(
+            inputs=Inputs(
+                files=[GlobInput(pattern="**/*.txt")],
+                builders=[EnvInput("SECRET")],
+            )
+        ),
+        root,
+    )
+
+
+def _manifest(root: Path, env: StableEnvironment) -> dict[str, str]:
+    desc = _load(root)
+    return input_manifest(desc.inputs, desc.content_id(env), env)
+
+
+def test_diff_names_changed_inputs(tmp_path: Path):
+    (tmp_path / "a.txt").write_text("a")
+    (tmp_path / "b.txt").write_text("b")
+    old = _manifest(tmp_path, StableEnvironment({"SECRET": "one"}, {}))
+
+    (tmp_path / "a.txt").write_text("changed")
+    os.chmod(tmp_path / "b.txt", 0o755)
+    (tmp_path / "c.txt").write_text("c")
+    new = _manifest(tmp_path, StableEnvironment({"SECRET": "two"}, {}))
+
+    assert diff_manifests(old, new) == [
+        "changed  envs/SECRET (value)",
+        "changed  files/a.txt (content)",
+        "changed  files/b.txt (mode 100644 -> 100755)",
+        "added    files/c.txt",
+    ]
+    assert diff_manifests(new, new) == []
+
+
+def test_manifest_round_trip_hides_env_values(tmp_path: Path):
+    (tmp_path / "a.txt").write_text("a")
+    desc = _load(tmp_path)
+    env = StableEnvironment({"SECRET": "hunter2"}, {})
+    content_id = record_input_manifest(desc, env)
+
+    assert load_manifest(content_id.digest) == input_manifest(
+        desc.inputs, content_id, env
+    )
+    assert load_manifest(f"registry/image:{content_id.tag()}") is not None
+    assert load_manifest("src-id-unknown") is None
+
+    stored = Path(os.environ["REBUILDR_CACHE_DIR"]) / "manifests"
+    with gzip.open(stored / f"{content_id.tag()}.json.gz", "rb") as f:
+        assert b"hunter2" not in f.read()
+
+
+def test_explain_against_last_build(tmp_path: Path, monkeypatch, capsys):
+    (tmp_path / "a.txt").write_text("a")
+    descriptor_path = tmp_path / "rebuildr.py"
+    descriptor_path.write_text(
+        "from rebuildr.descriptor import *\n"
+        "image = Descriptor(inputs=Inputs(files=[GlobInput(pattern='**/*.txt')]))\n"
+    )
+    assert last_build(descriptor_path) is None
+
+    env = StableEnvironment.from_os_env({})
+    desc = StableDescriptor.from_descriptor(
+        Descriptor(inputs=Inputs(files=[GlobInput(pattern="**/*.txt")])), tmp_path
+    )
+    record_last_build(descriptor_path, record_input_manifest(desc, env).tag())
+
+    (tmp_path / "a.txt").write_text("changed")
+    explain(str(descriptor_path), {}, None)
+
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[1:] == ["changed  files/a.txt (content)"]
+
+
+def test_parsing_records_no_manifest(tmp_path: Path, capsys):
+    (tmp_path / "a.txt").write_text("a")
+    (tmp_path / "Dockerfile").write_text("FROM scratch")
+    descriptor_path = tmp_path / "rebuildr.py"
+    descriptor_path.write_text(
+        "from rebuildr.descriptor import *\n"
+        "image = Descriptor(\n"
+        "    inputs=Inputs(files=[GlobInput(pattern='**/*.txt')]),\n"
+        "    targets=[ImageTarget(repository='example/explain', tag='latest')],\n"
+        ")\n"
+    )
+
+    parse_and_print_py(str(descriptor_path), {})
+
+    assert not (Path(os.environ["REBUILDR_CACHE_DIR"]) / "manifests").exists()
@@ -0,0 +1,271 @@
+import io
+from pathlib import Path, PurePath
+import shutil
+import tarfile
+import threading
+import time
+
+import pytest
+
+from rebuildr import context, stable_descriptor
+from rebuildr.cache import cache_dir
+from rebuildr.context import LocalContext
+from rebuildr.descriptor import Descriptor, GitRepoInput, Inputs
+from rebuildr.fs import write_context_tar
+from rebuildr.stable_descriptor import (
+    HashOptions,
+    StableDescriptor,
+    StableEnvironment,
+    StableGitRepoInput,
+    StableInputs,
+)
+from rebuildr.tools import git
+from rebuildr.tools.git import (
+    git_better_clone,
+    git_fetch_to_cache,
+    git_ls_remote_all,
+)
+
+from tests.utils import run_git
+
+
+def _commit(repo: Path, content: str) -> str:
+    (repo / "lib.txt").write_text(content)
+    run_git(repo, "add", ".")
+    run_git(repo, "commit", "-q", "-m", content)
+    return run_git(repo, "rev-parse", "HEAD")
+
+
+def _remote(root: Path) -> Path:
+    remote = root / "remote"
+    remote.mkdir()
+    run_git(remote, "init", "-q")
+    run_git(remote, "config", "uploadpack.allowAnySHA1InWant", "true")
+    run_git(remote, "config", "uploadpack.allowFilter", "true")
+    return remote
+
+
+def _monorepo(root: Path) -> tuple[str, str, str]:
+    """A file:// remote, which honours --depth and --filter, with two commits."""
+    remote = _remote(root)
+    for directory in ["a", "b"]:
+        (remote / directory).mkdir()
+        (remote / directory / f"{directory}.txt").write_text(directory)
+    first = _commit(remote, "first")
+    second = _commit(remote, "second")
+    return f"file://{remote}", first, second
+
+
+def test_checkouts_are_exported_from_the_cache(tmp_path: Path):
+    remote = _remote(tmp_path)
+    (remote / ".gitattributes").write_text("lib.txt export-ignore\n")
+    first = _commit(remote, "first")
+
+    git_better_clone(str(remote), tmp_path / "a", first)
+    # the remote is not needed for a commit that is in the cache already
+    moved = tmp_path / "moved"
+    remote.rename(moved)
+    git_better_clone(str(remote), tmp_path / "b", first)
+
+    for checkout in [tmp_path / "a", tmp_path / "b"]:
+        # every file of the commit, export attributes do not apply
+        assert (checkout / "lib.txt").read_text() == "first"
+        # nothing refers to the cache, which the build does not have
+        assert not (checkout / ".git").exists()
+    assert len(list((cache_dir() / "git").glob("*.lock"))) == 1
+
+
+def test_reused_checkout_fetches_new_commits_into_the_cache(tmp_path: Path):
+    remote = _remote(tmp_path)
+    first = _commit(remote, "first")
+    git_better_clone(str(remote), tmp_path / "a", first)
+
+    second = _commit(remote, "second")
+    git_better_clone(str(remote), tmp_path / "a", second)
+    assert (tmp_path / "a" / "lib.txt").read_text() == "second"
+
+    cache_path = git_fetch_to_cache(str(remote), second)
+    shutil.rmtree(remote)
+    # both commits are kept by refs, so gc does not prune them
+    run_git(cache_path, "gc", "-q", "--prune=now")
+    git_better_clone(str(remote), tmp_path / "b", first)
+    assert (tmp_path / "b" / "lib.txt").read_text() == "first"
+
+
+def test_fetch_is_shallow_and_sparse(tmp_path: Path):
+    url, first, second = _monorepo(tmp_path)
+
+    git_better_clone(url, tmp_path / "a", second, PurePath("a"))
+
+    assert sorted(p.name for p in (tmp_path / "a").iterdir()) == ["a.txt"]
+    cache_path = git_fetch_to_cache(url, second, PurePath("a"))
+    assert git._has_commit(cache_path, second)
+    assert not git._has_commit(cache_path, first)
+    # only the blobs of the subpath were fetched
+    assert git._missing_blobs(cache_path, second, PurePath("a")) == []
+    assert len(git._missing_blobs(cache_path, second, PurePath("b"))) == 1
+
+    git_better_clone(url, tmp_path / "whole", second)
+    assert (tmp_path / "whole" / "b" / "b.txt").read_text() == "b"
+    assert git._missing_blobs(cache_path, second, None) == []
+
+
+def test_missing_subpath_fails(tmp_path: Path):
+    url, _, second = _monorepo(tmp_path)
+
+    with pytest.raises(RuntimeError, match="Cannot list c of"):
+        git_better_clone(url, tmp_path / "c", second, PurePath("c"))
+
+
+def test_subpath_is_streamed_and_hashed(tmp_path: Path):
+    url, _, second = _monorepo(tmp_path)
+
+    def descriptor(subpath) -> StableDescriptor:
+        return StableDescriptor(
+            absolute_path=tmp_path,
+            inputs=StableInputs(
+                envs=[],
+                build_args=[],
+                files=[],
+                builders=[],
+                external=[
+                    StableGitRepoInput(
+                        url=url,
+                        commit=second,
+                        target_path=PurePath("vendor"),
+                        subpath=subpath,
+                    )
+                ],
+            ),
+        )
+
+    out = io.BytesIO()
+    write_context_tar(descriptor(PurePath("b")), out)
+    out.seek(0)
+    with tarfile.open(fileobj=out, mode="r:") as tar:
+        assert tar.extractfile("vendor/b.txt").read() == b"b"
+        assert "vendor/a.txt" not in tar.getnames()
+
+    env = StableEnvironment({}, {})
+    ids = {
+        descriptor(subpath).content_id(env).digest
+        for subpath in [None, PurePath("a"), PurePath("b")]
+    }
+    assert len(ids) == 3
+
+
+def test_refs_are_resolved_concurrently(monkeypatch):
+    # every lookup waits for all the others, so this only passes when they
+    # run at the same time
+    barrier = threading.Barrier(3, timeout=10)
+
+    def ls_remote(url: str, ref: str) -> str:
+        barrier.wait()
+        return f"{url}@{ref}"
+
+    monkeypatch.setattr(git, "git_ls_remote", ls_remote)
+    refs = [("a", "main"), ("b", "main"), ("a", "main"), ("c", "v1")]
+
+    assert git_ls_remote_all(refs) == ["a@main", "b@main", "a@main", "c@v1"]
+
+
+def test_failures_are_reported_in_declaration_order(monkeypatch):
+    def ls_remote(url: str, ref: str) -> str:
+        if url != "ok":
+            raise RuntimeError(f"Failed to list remote refs for {url}")
+        return "commit"
+
+    monkeypatch.setattr(git, "git_ls_remote", ls_remote)
+
+    with pytest.raises(RuntimeError) as e:
+        git_ls_remote_all([("second", "x"), ("ok", "x"), ("first", "x")])
+    assert str(e.value).splitlines() == [
+        "Failed to list remote refs for second",
+        "Failed to list remote refs for first",
+    ]
+
+
+def test_content_id_does_not_depend_on_workers(tmp_path: Path, monkeypatch):
+    url, _, second = _monorepo(tmp_path)
+    branch = run_git(tmp_path / "remote", "branch", "--show-current")
+    descriptor = Descriptor(
+        inputs=Inputs(
+            external=[
+                GitRepoInput(url=url, ref=branch, target_path=f"vendor/{name}")
+                for name in ["a", "b", "c"]
+            ]
+        )
+    )
+    env = StableEnvironment({}, {})
+
+    def content_id(workers: str) -> str:
+        monkeypatch.setenv("REBUILDR_GIT_WORKERS", workers)
+        stable = StableDescriptor.from_descriptor(descriptor, tmp_path)
+        assert [dep.commit for dep in stable.inputs.external] == [second] * 3
+        return stable.content_id(env).digest
+
+    assert content_id("1") == content_id("8")
+
+
+def test_nested_externals_are_staged_in_declaration_order(tmp_path: Path, monkeypatch):
+    url, _, second = _monorepo(tmp_path)
+    placed = []
+
+    def clone(url, target_path, commit, subpath=None):
+        # the outer external is slower to export than the nested one
+        if target_path.name == "vendor":
+            time.sleep(0.2)
+        git_better_clone(url, target_path, commit, subpath)
+        placed.append(target_path.relative_to(ctx.src_path()).as_posix())
+
+    monkeypatch.setattr(context, "git_better_clone", clone)
+    externals = [
+        StableGitRepoInput(url=url, commit=second, target_path=PurePath(target))
+        for target in ["vendor", "vendor/nested"]
+    ]
+    descriptor = StableDescriptor(
+        absolute_path=tmp_path,
+        inputs=StableInputs(
+            envs=[], build_args=[], files=[], builders=[], external=externals
+        ),
+    )
+    ctx = LocalContext(tmp_path / "ctx")
+
+    ctx.prepare_from_descriptor(descriptor)
+
+    assert placed == ["vendor", "vendor/nested"]
+    # the later external is placed inside the earlier one, not removed by it
+    assert (ctx.src_path() / "vendor" / "a" / "a.txt").read_text() == "a"
+    assert (ctx.src_path() / "vendor" / "nested" / "b" / "b.txt").read_text() == "b"
+
+
+@pytest.mark.parametrize("scheme", ["v1", "v2"])
+def test_content_id_covers_the_external_layout(
+    tmp_path: Path, monkeypatch, scheme: str
+):
+    def content_id() -> str:
+        return (
+            StableDescriptor(
+                absolute_path=tmp_path,
+                inputs=StableInputs(
+                    envs=[],
+                    build_args=[],
+                    files=[],
+                    builders=[],
+                    external=[
+                        StableGitRepoInput(
+                            url="https://example.com/lib.git",
+                            commit="0" * 40,
+                            target_path=PurePath("vendor"),
+                        )
+                    ],
+                    hashing=HashOptions(scheme=scheme, digest_cache=False),
+                ),
+            )
+            .content_id(StableEnvironment({}, {}))
+            .digest
+        )
+
+    exported = content_id()
+    monkeypatch.setattr(stable_descriptor, "EXTERNAL_LAYOUT", "checkout")
+    assert content_id() != exported
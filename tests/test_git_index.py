@@ -0,0 +1,110 @@
+import os
+from pathlib import Path, PurePath
+import shutil
+
+from rebuildr.descriptor import Descriptor, GlobInput, Inputs
+from rebuildr.stable_descriptor import (
+    CONTENT_ID_GIT,
+    HashOptions,
+    StableDescriptor,
+    StableEnvironment,
+)
+from rebuildr.tools import git
+
+from tests.utils import run_git
+
+
+def _make_repo(root: Path) -> Path:
+    (root / "src").mkdir(parents=True)
+    (root / "src" / "main.py").write_text("print('hello')")
+    (root / "src" / "run.sh").write_text("#!/bin/sh")
+    os.chmod(root / "src" / "run.sh", 0o755)
+    (root / "README.md").write_text("readme")
+    run_git(root, "init", "-q")
+    run_git(root, "add", ".")
+    run_git(root, "commit", "-q", "-m", "initial")
+    return root
+
+
+def _content_id(root: Path):
+    return StableDescriptor.from_descriptor(
+        Descriptor(inputs=Inputs(files=[GlobInput(pattern="**/*")])),
+        root,
+        HashOptions(scheme=CONTENT_ID_GIT),
+    ).content_id(StableEnvironment({}, {}))
+
+
+def _count_direct_hashes(monkeypatch) -> list:
+    hashed = []
+    original = git.git_blob_id
+
+    def recording_git_blob_id(path, *args):
+        hashed.append(path)
+        return original(path, *args)
+
+    monkeypatch.setattr(git, "git_blob_id", recording_git_blob_id)
+    return hashed
+
+
+def test_clean_files_are_not_read(tmp_path: Path, monkeypatch):
+    repo = _make_repo(tmp_path / "repo")
+    hashed = _count_direct_hashes(monkeypatch)
+    content_id = _content_id(repo)
+
+    assert hashed == []
+    assert content_id.tag() == f"src-id-git-{content_id.digest}"
+    assert content_id.files[PurePath("README.md")].digest == run_git(
+        repo, "rev-parse", "HEAD:README.md"
+    )
+
+
+def test_ids_match_outside_of_repository(tmp_path: Path):
+    repo = _make_repo(tmp_path / "repo")
+    copy = tmp_path / "copy"
+    shutil.copytree(repo, copy, ignore=shutil.ignore_patterns(".git"))
+
+    assert _content_id(repo).digest == _content_id(copy).digest
+
+
+def test_modified_and_untracked_files(tmp_path: Path, monkeypatch):
+    repo = _make_repo(tmp_path / "repo")
+    before = _content_id(repo)
+
+    (repo / "src" / "main.py").write_text("print('changed')")
+    (repo / "src" / "new.py").write_text("new")
+    os.symlink("main.py", repo / "src" / "link.py")
+    hashed = _count_direct_hashes(monkeypatch)
+    after = _content_id(repo)
+
+    assert sorted(hashed) == [repo / "src" / "link.py", repo / "src" / "new.py"]
+    assert after.digest != before.digest
+    assert after.files[PurePath("src/main.py")].digest == run_git(
+        repo, "hash-object", "src/main.py"
+    )
+    assert (
+        after.files[PurePath("src/link.py")].digest
+        == after.files[PurePath("src/main.py")].digest
+    )
+    assert after.files[PurePath("src/new.py")].digest == run_git(
+        repo, "hash-object", "src/new.py"
+    )
+
+
+def test_converted_files_are_hashed_as_they_are_on_disk(tmp_path: Path, monkeypatch):
+    repo = _make_repo(tmp_path / "repo")
+    (repo / ".gitattributes").write_text("*.txt text\n")
+    (repo / "crlf.txt").write_bytes(b"a\r\nb\r\n")
+    run_git(repo, "add", ".")
+    run_git(repo, "commit", "-q", "-m", "crlf")
+    hashed = _count_direct_hashes(monkeypatch)
+    content_id = _content_id(repo)
+
+    # the index holds the normalized blob, the context gets the CRLF file
+    assert hashed == [repo / "crlf.txt"]
+    assert content_id.files[PurePath("crlf.txt")].digest == git.git_blob_id(
+        repo / "crlf.txt"
+    )
+    assert content_id.files[PurePath("crlf.txt")].digest != run_git(
+        repo, "rev-parse", "HEAD:crlf.txt"
+    )
+    assert git.git_converted_paths(repo, ["crlf.txt", "README.md"]) == {"crlf.txt"}
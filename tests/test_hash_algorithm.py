@@ -0,0 +1,114 @@
+import hashlib
+import io
+import json
+from pathlib import Path, PurePath
+
+import pytest
+
+from rebuildr.descriptor import Descriptor, GlobInput, Inputs
+from rebuildr.stable_descriptor import (
+    CONTENT_ID_GIT,
+    CONTENT_ID_V2,
+    HashOptions,
+    StableDescriptor,
+    StableEnvironment,
+)
+
+
+def _write_tree(root: Path):
+    (root / "src").mkdir()
+    (root / "src" / "main.py").write_text("print('hello')")
+    (root / "README.md").write_text("readme")
+
+
+def _load(
+    root: Path, hashing: HashOptions, hash_algorithm: str | None = None
+) -> StableDescriptor:
+    return StableDescriptor.from_descriptor(
+        Descriptor(
+            inputs=Inputs(files=[GlobInput(pattern="**/*")]),
+            hash_algorithm=hash_algorithm,
+        ),
+        root,
+        hashing,
+    )
+
+
+def test_sha256_ids_are_unchanged_by_default(tmp_path: Path):
+    _write_tree(tmp_path)
+    env = StableEnvironment({}, {})
+    default = _load(tmp_path, HashOptions()).content_id(env)
+    sha256 = _load(tmp_path, HashOptions(algorithm="sha256")).content_id(env)
+
+    assert default == sha256
+    assert default.tag() == f"src-id-{default.digest}"
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_blake2b_ids_are_namespaced(tmp_path: Path, workers: int):
+    _write_tree(tmp_path)
+    env = StableEnvironment({}, {})
+    sha256 = _load(tmp_path, HashOptions()).content_id(env)
+    blake2b = _load(
+        tmp_path, HashOptions(algorithm="blake2b", workers=workers)
+    ).content_id(env)
+
+    assert blake2b.tag() == f"src-id-b2-{blake2b.digest}"
+    assert len(blake2b.digest) == 64
+    assert blake2b.digest != sha256.digest
+    assert (
+        blake2b.files[PurePath("README.md")].digest
+        == hashlib.blake2b(b"readme", digest_size=32).hexdigest()
+    )
+
+
+def test_descriptor_algorithm_and_override(tmp_path: Path):
+    _write_tree(tmp_path)
+    env = StableEnvironment({}, {})
+
+    from_descriptor = _load(tmp_path, HashOptions(), "blake2b").content_id(env)
+    assert from_descriptor.algorithm == "blake2b"
+
+    overridden = _load(tmp_path, HashOptions(algorithm="sha256"), "blake2b")
+    assert overridden.content_id(env).algorithm == "sha256"
+
+
+def test_v2_blake2b_tag(tmp_path: Path):
+    _write_tree(tmp_path)
+    content_id = _load(
+        tmp_path, HashOptions(scheme=CONTENT_ID_V2, algorithm="blake2b")
+    ).content_id(StableEnvironment({}, {}))
+
+    assert content_id.tag() == f"src-id-v2-b2-{content_id.digest}"
+
+
+@pytest.mark.parametrize(
+    "scheme, algorithm, key",
+    [
+        ("v1", "sha256", "sha256"),
+        ("v1", "blake2b", "src-id-b2"),
+        (CONTENT_ID_V2, "sha256", "src-id-v2"),
+        (CONTENT_ID_V2, "blake2b", "src-id-v2-b2"),
+        (CONTENT_ID_GIT, "sha256", "src-id-git"),
+    ],
+)
+def test_metadata_names_the_content_id_scheme(
+    tmp_path: Path, scheme: str, algorithm: str, key: str
+):
+    _write_tree(tmp_path)
+    desc = _load(
+        tmp_path, HashOptions(scheme=scheme, algorithm=algorithm, digest_cache=False)
+    )
+    env = StableEnvironment({}, {})
+    out = io.StringIO()
+    desc.write_stable_inputs(env, out)
+
+    metadata = json.loads(out.getvalue())
+    assert metadata == desc.stable_inputs_dict(env)
+    assert metadata[key] == desc.content_id(env).digest
+    assert sorted(metadata) == sorted(["inputs", key])
+
+
+def test_unknown_algorithm_is_rejected():
+    with pytest.raises(ValueError, match="Unknown hash algorithm md5"):
+        HashOptions(algorithm="md5")
@@ -0,0 +1,131 @@
+import glob
+import os
+from pathlib import Path
+import random
+import shutil
+import time
+
+import pytest
+
+from rebuildr.listing_cache import ListingCache
+from rebuildr.walk import DirectoryWalker
+
+PATTERNS = ["**", "**/*.py", "*/", "a/**/*.txt", "*/*/*", "**/.*"]
+
+
+class _Tree(object):
+    """A directory tree whose directories get a distinct past mtime on every change.
+
+    Real changes may land within the same timestamp granule as the listing
+    that preceded them; the cache never stores such racy listings, so the
+    tests backdate modified directories to exercise the cached path.
+    """
+
+    def __init__(self, root: Path, seed: int):
+        self.root = root
+        self.rng = random.Random(seed)
+        self.clock = int(time.time()) - 3600
+        self.dirs = [root]
+        self.files = []
+
+    def _touched(self, *dirs: Path):
+        for directory in dirs:
+            self.clock += 1
+            os.utime(directory, (self.clock, self.clock))
+
+    def _name(self) -> str:
+        stem = self.rng.choice(["x", "y", "z", ".h", "n"]) + str(self.rng.randrange(50))
+        return stem + self.rng.choice([".py", ".txt", ""])
+
+    def mutate(self):
+        action = self.rng.choice(["add", "add", "mkdir", "remove", "rename", "rmdir"])
+        if action == "add":
+            parent = self.rng.choice(self.dirs)
+            path = parent / self._name()
+            if not path.exists():
+                path.write_text("x")
+                self.files.append(path)
+                self._touched(parent)
+        elif action == "mkdir":
+            parent = self.rng.choice(self.dirs)
+            path = parent / self.rng.choice(["a", "b", "c", ".d"])
+            if not path.exists():
+                path.mkdir()
+                self.dirs.append(path)
+                self._touched(parent)
+        elif action == "remove" and self.files:
+            path = self.files.pop(self.rng.randrange(len(self.files)))
+            path.unlink()
+            self._touched(path.parent)
+        elif action == "rename" and self.files:
+            path = self.files.pop(self.rng.randrange(len(self.files)))
+            target = self.rng.choice(self.dirs) / self._name()
+            if target.exists():
+                self.files.append(path)
+                return
+            path.rename(target)
+            self.files.append(target)
+            self._touched(path.parent, target.parent)
+        elif action == "rmdir" and len(self.dirs) > 1:
+            path = self.dirs[self.rng.randrange(1, len(self.dirs))]
+            shutil.rmtree(path)
+            self.dirs = [d for d in self.dirs if not d.is_relative_to(path)]
+            self.files = [f for f in self.files if not f.is_relative_to(path)]
+            self._touched(path.parent)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_cached_glob_matches_stdlib_after_mutations(tmp_path: Path, seed: int):
+    root = tmp_path / "tree"
+    root.mkdir()
+    tree = _Tree(root, seed)
+    for _ in range(40):
+        tree.mutate()
+
+    cache_path = tmp_path / "listings.json"
+    for _ in range(15):
+        walker = DirectoryWalker(ListingCache(cache_path))
+        for pattern in PATTERNS:
+            assert walker.glob(pattern, root) == glob.glob(
+                pattern, root_dir=root, recursive=True
+            )
+        walker.flush()
+        for _ in range(tree.rng.randrange(1, 5)):
+            tree.mutate()
+
+
+def test_unchanged_directories_are_not_listed(tmp_path: Path, monkeypatch):
+    root = tmp_path / "tree"
+    (root / "a" / "b").mkdir(parents=True)
+    (root / "a" / "b" / "x.py").write_text("x")
+    (root / "c").mkdir()
+    past = time.time() - 60
+    for directory in [root, root / "a", root / "a" / "b", root / "c"]:
+        os.utime(directory, (past, past))
+
+    cache_path = tmp_path / "listings.json"
+    walker = DirectoryWalker(ListingCache(cache_path))
+    walker.glob("**/*.py", root)
+    walker.flush()
+
+    (root / "c" / "y.py").write_text("y")
+    listed = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        listed.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", counting_scandir)
+    walker = DirectoryWalker(ListingCache(cache_path))
+
+    assert sorted(walker.glob("**/*.py", root)) == ["a/b/x.py", "c/y.py"]
+    assert listed == [os.path.join(root, "c")]
+
+
+def test_fresh_directories_are_not_stored(tmp_path: Path):
+    (tmp_path / "x.py").write_text("x")
+    cache = ListingCache(tmp_path / "listings.json")
+    DirectoryWalker(cache).glob("*.py", tmp_path)
+
+    assert cache.lookup(str(tmp_path), os.stat(tmp_path)) is None
@@ -0,0 +1,135 @@
+import json
+from pathlib import Path
+import threading
+
+import pytest
+
+from rebuildr.cli import load_py_desc, print_outdated, write_lock
+from rebuildr.lockfile import LOCKFILE_NAME, RefLock
+from rebuildr.stable_descriptor import HashOptions
+from rebuildr.tools import git
+
+from tests.utils import run_git
+
+DESCRIPTOR = """
+from rebuildr.descriptor import *
+
+image = Descriptor(
+    inputs=Inputs(
+        external=[GitRepoInput(url="{url}", ref="{ref}", target_path="vendor")]
+    )
+)
+"""
+
+
+def _commit(repo: Path, content: str) -> str:
+    (repo / "lib.txt").write_text(content)
+    run_git(repo, "add", ".")
+    run_git(repo, "commit", "-q", "-m", content)
+    return run_git(repo, "rev-parse", "HEAD")
+
+
+@pytest.fixture
+def remote(tmp_path: Path) -> Path:
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    run_git(remote, "init", "-q")
+    _commit(remote, "first")
+    return remote
+
+
+def _descriptor(root: Path, remote: Path) -> Path:
+    root.mkdir(exist_ok=True)
+    branch = run_git(remote, "branch", "--show-current")
+    path = root / "rebuildr.py"
+    path.write_text(DESCRIPTOR.format(url=f"file://{remote}", ref=branch))
+    return path
+
+
+def _offline(monkeypatch):
+    def ls_remote(url: str, ref: str) -> str:
+        raise AssertionError(f"{url} {ref} resolved over the network")
+
+    monkeypatch.setattr(git, "git_ls_remote", ls_remote)
+
+
+def _commit_of(path: Path, **options) -> str:
+    desc = load_py_desc(path, HashOptions(digest_cache=False, **options))
+    return desc.inputs.external[0].commit
+
+
+def test_locked_refs_are_resolved_offline(tmp_path: Path, remote: Path, monkeypatch):
+    path = _descriptor(tmp_path / "app", remote)
+    locked = run_git(remote, "rev-parse", "HEAD")
+    write_lock(str(path))
+
+    # the branch moving does not change the content id until locked again
+    moved = _commit(remote, "second")
+    ls_remote = git.git_ls_remote
+    _offline(monkeypatch)
+    assert _commit_of(path) == locked
+    assert _commit_of(path, locked=True) == locked
+
+    monkeypatch.setattr(git, "git_ls_remote", ls_remote)
+    write_lock(str(path))
+    assert _commit_of(path) == moved
+
+
+def test_locked_fails_for_refs_missing_from_the_lock(
+    tmp_path: Path, remote: Path, monkeypatch
+):
+    path = _descriptor(tmp_path / "app", remote)
+    head = run_git(remote, "rev-parse", "HEAD")
+
+    # without a lock the ref is resolved on the remote unless --locked
+    assert _commit_of(path) == head
+    _offline(monkeypatch)
+    with pytest.raises(RuntimeError, match="Refs not locked in"):
+        _commit_of(path, locked=True)
+
+
+def test_lock_keeps_refs_of_other_descriptors(tmp_path: Path, remote: Path):
+    root = tmp_path / "app"
+    root.mkdir()
+    lock = RefLock(root / LOCKFILE_NAME)
+    lock.set("https://example.com/other.git", "main", "0" * 40)
+    lock.write()
+
+    path = _descriptor(root, remote)
+    write_lock(str(path))
+
+    data = json.loads((root / LOCKFILE_NAME).read_text())
+    assert set(data["refs"]) == {"https://example.com/other.git", f"file://{remote}"}
+
+
+def test_concurrent_updates_keep_all_refs(tmp_path: Path):
+    path = tmp_path / LOCKFILE_NAME
+    threads = [
+        threading.Thread(
+            target=RefLock.update,
+            args=(path, [((f"https://example.com/{i}.git", "main"), f"{i:040}")]),
+        )
+        for i in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(RefLock.load(path).refs) == 8
+    assert oct(path.stat().st_mode & 0o777) == oct(0o644)
+
+
+def test_outdated_reports_moved_refs(tmp_path: Path, remote: Path, capsys):
+    path = _descriptor(tmp_path / "app", remote)
+    locked = run_git(remote, "rev-parse", "HEAD")
+    write_lock(str(path))
+    capsys.readouterr()
+
+    print_outdated(str(path))
+    assert capsys.readouterr().out == "all refs are up to date\n"
+
+    moved = _commit(remote, "second")
+    with pytest.raises(SystemExit):
+        print_outdated(str(path))
+    assert f"{locked} -> {moved}" in capsys.readouterr().out
@@ -0,0 +1,64 @@
+from pathlib import Path, PurePath
+
+from rebuildr.stable_descriptor import FileManifest, StableFileInput, StableInputs
+
+
+def _dep(target: str, source: str, ignore_target_path: bool = False):
+    return StableFileInput(
+        target_path=PurePath(target),
+        absolute_src_path=Path(source),
+        ignore_target_path=ignore_target_path,
+    )
+
+
+DEPS = [
+    _dep("src/b.py", "/repo/src/b.py"),
+    _dep("src/a.py", "/repo/src/a.py"),
+    _dep("src.txt", "/repo/src.txt"),
+    _dep("site/index.md", "/repo/docs/index.md"),
+    _dep("src/pkg/x.py", "/repo/src/pkg/x.py"),
+    _dep("Dockerfile", "/repo/Dockerfile", ignore_target_path=True),
+    _dep("src/a.py", "/elsewhere/a.py"),
+]
+
+
+def test_manifest_round_trips_sorted_entries():
+    manifest = FileManifest(DEPS)
+
+    assert manifest == sorted(DEPS, key=lambda x: x.sort_key())
+    assert len(manifest) == len(DEPS)
+    assert manifest[-1] == _dep("src/pkg/x.py", "/repo/src/pkg/x.py")
+    assert manifest[:1] == [_dep("Dockerfile", "/repo/Dockerfile", True)]
+
+
+def test_manifest_lookups():
+    manifest = FileManifest(DEPS)
+
+    # the first of several entries with the same target path wins, like a scan
+    assert manifest.find(PurePath("src/a.py")).absolute_src_path == Path(
+        "/repo/src/a.py"
+    )
+    assert manifest.find(PurePath("src")) is None
+    assert [str(dep.target_path) for dep in manifest.below(PurePath("src"))] == [
+        "src/a.py",
+        "src/a.py",
+        "src/b.py",
+        "src/pkg/x.py",
+    ]
+    assert [str(dep.target_path) for dep in manifest.below(PurePath("src/pkg"))] == [
+        "src/pkg/x.py"
+    ]
+    assert manifest.below(PurePath(".")) == list(manifest)
+
+
+def test_inputs_accept_lists():
+    inputs = StableInputs(envs=[], build_args=[], files=DEPS[:2], builders=DEPS[5:6])
+
+    assert isinstance(inputs.files, FileManifest)
+    assert inputs.find_file(PurePath("src/a.py")) == DEPS[1]
+    assert inputs.find_file(PurePath("Dockerfile")) == DEPS[5]
+    assert [str(dep.target_path) for dep in inputs.files + inputs.builders] == [
+        "src/a.py",
+        "src/b.py",
+        "Dockerfile",
+    ]
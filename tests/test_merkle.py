@@ -0,0 +1,163 @@
+import hashlib
+import os
+from pathlib import Path, PurePath
+
+from rebuildr import digest_cache, stable_descriptor
+from rebuildr.descriptor import Descriptor, GlobInput, ImageTarget, Inputs
+from rebuildr.merkle import MerkleTree
+from rebuildr.stable_descriptor import (
+    CONTENT_ID_V2,
+    HashOptions,
+    StableDescriptor,
+    StableEnvironment,
+    StableFileInput,
+)
+
+
+def _digest(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def test_digest_does_not_depend_on_order():
+    files = {
+        PurePath("a.txt"): _digest(b"a"),
+        PurePath("src/main.py"): _digest(b"main"),
+        PurePath("src/lib/util.py"): _digest(b"util"),
+        PurePath("docs/readme.md"): _digest(b"readme"),
+    }
+    tree = MerkleTree()
+    for path, digest in files.items():
+        tree.set(path, 0o100644, digest)
+    reversed_tree = MerkleTree()
+    for path, digest in reversed(list(files.items())):
+        reversed_tree.set(path, 0o100644, digest)
+
+    assert tree.digest() == reversed_tree.digest()
+
+
+def test_mode_and_location_change_digest():
+    tree = MerkleTree()
+    tree.set(PurePath("a/b.txt"), 0o100644, _digest(b"b"))
+    moved = MerkleTree()
+    moved.set(PurePath("a.b.txt"), 0o100644, _digest(b"b"))
+    executable = MerkleTree()
+    executable.set(PurePath("a/b.txt"), 0o100755, _digest(b"b"))
+
+    assert len({tree.digest(), moved.digest(), executable.digest()}) == 3
+
+
+def test_later_set_replaces_file():
+    tree = MerkleTree()
+    tree.set(PurePath("dir/b.txt"), 0o100644, _digest(b"old"))
+    tree.set(PurePath("dir/b.txt"), 0o100644, _digest(b"b"))
+
+    only_new = MerkleTree()
+    only_new.set(PurePath("dir/b.txt"), 0o100644, _digest(b"b"))
+
+    assert tree.digest() == only_new.digest()
+
+
+def _write_tree(root: Path):
+    (root / "src" / "lib").mkdir(parents=True)
+    (root / "Dockerfile").write_text("FROM scratch\n")
+    (root / "a.txt").write_text("a")
+    (root / "src" / "main.py").write_text("main")
+    (root / "src" / "lib" / "util.py").write_text("util")
+
+
+def _load(root: Path, **options) -> StableDescriptor:
+    descriptor = Descriptor(
+        targets=[ImageTarget(repository="example.com/app")],
+        inputs=Inputs(files=[GlobInput(pattern="**/*.*")]),
+    )
+    return StableDescriptor.from_descriptor(
+        descriptor,
+        root,
+        hashing=HashOptions(digest_cache=False, scheme=CONTENT_ID_V2, **options),
+    )
+
+
+def test_v2_content_id_tag_is_namespaced(tmp_path: Path):
+    _write_tree(tmp_path)
+    env = StableEnvironment({}, {})
+    desc = _load(tmp_path)
+    content_id = desc.content_id(env)
+
+    v1 = StableDescriptor.from_descriptor(
+        Descriptor(inputs=Inputs(files=[GlobInput(pattern="**/*.*")])),
+        tmp_path,
+        hashing=HashOptions(digest_cache=False),
+    ).content_id(env)
+
+    assert content_id.tag() == f"src-id-v2-{content_id.digest}"
+    assert desc.targets[0].content_id_tag(desc.inputs, env) == (
+        f"example.com/app:src-id-v2-{content_id.digest}"
+    )
+    assert v1.tag() == f"src-id-{v1.digest}"
+    assert v1.digest != content_id.digest
+
+
+def test_v2_content_id_is_independent_of_workers(tmp_path: Path):
+    _write_tree(tmp_path)
+    env = StableEnvironment({}, {})
+
+    assert _load(tmp_path).content_id(env) == _load(tmp_path, workers=4).content_id(env)
+
+
+def test_v2_only_rehashes_changed_files(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(digest_cache, "RACY_WINDOW_NS", 0)
+    _write_tree(tmp_path)
+    env = StableEnvironment({}, {})
+    descriptor = Descriptor(
+        targets=[ImageTarget(repository="example.com/app")],
+        inputs=Inputs(files=[GlobInput(pattern="**/*.*")]),
+    )
+    hashing = HashOptions(scheme=CONTENT_ID_V2)
+    before = StableDescriptor.from_descriptor(descriptor, tmp_path, hashing)
+    before_id = before.content_id(env)
+
+    (tmp_path / "src" / "main.py").write_text("changed")
+    hashed = []
+    original = stable_descriptor.digest_files
+
+    def recording_digest_files(paths, *args):
+        hashed.extend(paths)
+        return original(paths, *args)
+
+    monkeypatch.setattr(stable_descriptor, "digest_files", recording_digest_files)
+    after_id = StableDescriptor.from_descriptor(
+        descriptor, tmp_path, hashing
+    ).content_id(env)
+
+    assert hashed == [tmp_path / "src" / "main.py"]
+    assert after_id.digest != before_id.digest
+    assert after_id.digest == _load(tmp_path).content_id(env).digest
+
+
+def test_v2_ignores_dockerfile_name(tmp_path: Path):
+    _write_tree(tmp_path)
+    os.rename(tmp_path / "Dockerfile", tmp_path / "other.Dockerfile")
+    env = StableEnvironment({}, {})
+    renamed = StableDescriptor.from_descriptor(
+        Descriptor(
+            targets=[
+                ImageTarget(repository="example.com/app", dockerfile="other.Dockerfile")
+            ],
+            inputs=Inputs(files=[GlobInput(pattern="**/*.py")]),
+        ),
+        tmp_path,
+        hashing=HashOptions(digest_cache=False, scheme=CONTENT_ID_V2),
+    )
+    renamed_id = renamed.content_id(env)
+    os.rename(tmp_path / "other.Dockerfile", tmp_path / "Dockerfile")
+    original = StableDescriptor.from_descriptor(
+        Descriptor(
+            targets=[ImageTarget(repository="example.com/app")],
+            inputs=Inputs(files=[GlobInput(pattern="**/*.py")]),
+        ),
+        tmp_path,
+        hashing=HashOptions(digest_cache=False, scheme=CONTENT_ID_V2),
+    )
+
+    assert renamed_id.digest == original.content_id(env).digest
+    assert isinstance(original.inputs.builders[0], StableFileInput)
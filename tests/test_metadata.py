@@ -0,0 +1,79 @@
+import io
+import json
+from pathlib import Path
+
+import pytest
+
+from rebuildr.cli import load_py_desc
+from rebuildr.descriptor import (
+    ArgsInput,
+    Descriptor,
+    EnvInput,
+    GlobInput,
+    ImageTarget,
+    Inputs,
+)
+from rebuildr.stable_descriptor import (
+    StableDescriptor,
+    StableEnvironment,
+    StableGitHubCommitInput,
+)
+
+from tests.utils import resolve_current_dir
+
+current_dir = resolve_current_dir(__file__)
+
+
+def _descriptor(root: Path) -> StableDescriptor:
+    (root / "src").mkdir()
+    for path in ["Dockerfile", "src/a.py", "src/b.txt", "src/ünï.py"]:
+        (root / path).write_text(path)
+    desc = StableDescriptor.from_descriptor(
+        Descriptor(
+            inputs=Inputs(
+                files=[GlobInput(pattern="src/*", exclude=["*.txt"])],
+                builders=[
+                    EnvInput(key="SET"),
+                    EnvInput(key="UNSET", default="d"),
+                    ArgsInput(key="VERSION"),
+                ],
+                exclude=["**/.git"],
+            ),
+            targets=[ImageTarget(repository="test")],
+        ),
+        root,
+    )
+    desc.inputs.external.append(
+        StableGitHubCommitInput(
+            url="https://github.com/o/r", commit="c0ffee", target_path="vendor/r"
+        )
+    )
+    return desc
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_streamed_metadata_matches_json_dump(tmp_path: Path, compact: bool):
+    desc = _descriptor(tmp_path)
+    env = StableEnvironment({"SET": "1"}, {"VERSION": "2"})
+
+    out = io.StringIO()
+    desc.write_stable_inputs(env, out, compact)
+
+    if compact:
+        expected = json.dumps(
+            desc.stable_inputs_dict(env), sort_keys=True, separators=(",", ":")
+        )
+    else:
+        expected = json.dumps(desc.stable_inputs_dict(env), indent=4, sort_keys=True)
+    assert out.getvalue() == expected
+
+
+def test_streamed_metadata_layout():
+    desc = load_py_desc(current_dir / "basic" / "simple_with_glob.rebuildr.py")
+    env = StableEnvironment({}, {})
+
+    out = io.StringIO()
+    desc.write_stable_inputs(env, out)
+
+    assert json.loads(out.getvalue()) == desc.stable_inputs_dict(env)
+    assert out.getvalue().startswith('{\n    "inputs": {\n        "build_args": [],\n')
@@ -0,0 +1,118 @@
+import os
+from pathlib import Path, PurePath
+import time
+
+import pytest
+
+from rebuildr import context
+from rebuildr.context import LocalContext
+from rebuildr.stable_descriptor import StableDescriptor, StableFileInput, StableInputs
+from rebuildr.staging import FileStager
+
+
+@pytest.fixture
+def no_racy_window(monkeypatch):
+    # files created by the tests are always fresh, their ctime cannot be backdated
+    monkeypatch.setattr(context, "RACY_WINDOW_NS", 0)
+
+
+def _descriptor(root: Path, files: dict[str, str]) -> StableDescriptor:
+    return StableDescriptor(
+        absolute_path=root,
+        inputs=StableInputs(
+            envs=[],
+            build_args=[],
+            files=[
+                StableFileInput(
+                    target_path=PurePath(target), absolute_src_path=root / source
+                )
+                for target, source in files.items()
+            ],
+            builders=[
+                StableFileInput(
+                    target_path=PurePath("Dockerfile"),
+                    absolute_src_path=root / "Dockerfile",
+                    ignore_target_path=True,
+                )
+            ],
+        ),
+    )
+
+
+def _tree(root: Path) -> dict[str, str]:
+    return {
+        str(path.relative_to(root)): path.read_text()
+        for path in sorted(root.rglob("*"))
+        if path.is_file()
+    }
+
+
+def _sync(root: Path, files: dict[str, str], monkeypatch) -> tuple[dict, list]:
+    staged = []
+    stage = FileStager.stage
+
+    def counting_stage(self, src_path, dest_path, check=None):
+        staged.append(str(dest_path.relative_to(ctx.root_dir)))
+        return stage(self, src_path, dest_path, check)
+
+    monkeypatch.setattr(FileStager, "stage", counting_stage)
+    with LocalContext.persistent(("test", str(root))) as ctx:
+        ctx.prepare_from_descriptor(_descriptor(root, files))
+        tree = _tree(ctx.root_dir)
+    monkeypatch.setattr(FileStager, "stage", stage)
+    return tree, sorted(staged)
+
+
+def test_persistent_context_is_synced_incrementally(
+    tmp_path: Path, monkeypatch, no_racy_window
+):
+    for name in ["Dockerfile", "a.txt", "b.txt", "c.txt"]:
+        (tmp_path / name).write_text(name)
+
+    tree, staged = _sync(tmp_path, {"a.txt": "a.txt", "d/b.txt": "b.txt"}, monkeypatch)
+    assert tree == {
+        "Dockerfile": "Dockerfile",
+        "src/a.txt": "a.txt",
+        "src/d/b.txt": "b.txt",
+    }
+    assert staged == ["Dockerfile", "src/a.txt", "src/d/b.txt"]
+
+    tree, staged = _sync(tmp_path, {"a.txt": "a.txt", "d/b.txt": "b.txt"}, monkeypatch)
+    assert staged == []
+
+    # a changed source, a removed input and a file replacing a directory
+    time.sleep(0.01)
+    (tmp_path / "a.txt").write_text("changed")
+    tree, staged = _sync(tmp_path, {"a.txt": "a.txt", "d": "c.txt"}, monkeypatch)
+    assert tree == {
+        "Dockerfile": "Dockerfile",
+        "src/a.txt": "changed",
+        "src/d": "c.txt",
+    }
+    assert staged == ["src/a.txt", "src/d"]
+
+
+def test_persistent_context_repairs_modified_copies(
+    tmp_path: Path, monkeypatch, no_racy_window
+):
+    for name in ["Dockerfile", "a.txt"]:
+        (tmp_path / name).write_text(name)
+    _sync(tmp_path, {"a.txt": "a.txt"}, monkeypatch)
+
+    with LocalContext.persistent(("test", str(tmp_path))) as ctx:
+        (ctx.src_path() / "a.txt").write_text("tampered")
+        (ctx.src_path() / "stray.txt").write_text("stray")
+        os.makedirs(ctx.src_path() / "empty" / "dir")
+
+    tree, staged = _sync(tmp_path, {"a.txt": "a.txt"}, monkeypatch)
+    assert tree == {"Dockerfile": "Dockerfile", "src/a.txt": "a.txt"}
+    assert staged == ["src/a.txt"]
+
+
+def test_fresh_sources_are_staged_again(tmp_path: Path, monkeypatch):
+    for name in ["Dockerfile", "a.txt"]:
+        (tmp_path / name).write_text(name)
+    _sync(tmp_path, {"a.txt": "a.txt"}, monkeypatch)
+
+    _, staged = _sync(tmp_path, {"a.txt": "a.txt"}, monkeypatch)
+    assert staged == ["Dockerfile", "src/a.txt"]
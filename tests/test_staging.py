@@ -0,0 +1,130 @@
+import errno
+import logging
+import os
+from pathlib import Path
+
+import pytest
+
+from rebuildr import staging
+from rebuildr.context import LocalContext
+from rebuildr.stable_descriptor import StableDescriptor
+from rebuildr.staging import (
+    STAGING_COPY,
+    STAGING_COPY_FILE_RANGE,
+    STAGING_HARDLINK,
+    FileStager,
+)
+
+from tests.utils import files_descriptor
+
+
+def _source(root: Path) -> Path:
+    src = root / "input.sh"
+    src.write_bytes(b"#!/bin/sh\n" * 1000)
+    os.chmod(src, 0o755)
+    os.utime(src, (1_000_000_000, 1_000_000_000))
+    return src
+
+
+@pytest.mark.parametrize(
+    "strategy", [STAGING_COPY, STAGING_COPY_FILE_RANGE, STAGING_HARDLINK, "auto"]
+)
+def test_staged_file_keeps_content_and_metadata(tmp_path: Path, strategy: str):
+    src = _source(tmp_path)
+    dest = tmp_path / "dest.sh"
+    FileStager(strategy, read_only=True).stage(src, dest)
+
+    assert dest.read_bytes() == src.read_bytes()
+    assert dest.stat().st_mode == src.stat().st_mode
+    assert dest.stat().st_mtime == src.stat().st_mtime
+
+
+def test_auto_hardlinks_only_read_only_contexts(tmp_path: Path, monkeypatch):
+    def no_reflink(src_path, dest_path):
+        raise staging.StagingUnsupported("no reflinks")
+
+    monkeypatch.setitem(staging._METHODS, staging.STAGING_REFLINK, no_reflink)
+    src = _source(tmp_path)
+
+    FileStager("auto").stage(src, tmp_path / "copied.sh")
+    FileStager("auto", read_only=True).stage(src, tmp_path / "linked.sh")
+
+    assert not os.path.samefile(src, tmp_path / "copied.sh")
+    assert os.path.samefile(src, tmp_path / "linked.sh")
+
+
+def test_auto_remembers_unsupported_methods(tmp_path: Path, monkeypatch):
+    attempts = []
+
+    def no_reflink(src_path, dest_path):
+        attempts.append(dest_path)
+        open(dest_path, "wb").close()
+        raise staging.StagingUnsupported(os.strerror(errno.EOPNOTSUPP))
+
+    monkeypatch.setitem(staging._METHODS, staging.STAGING_REFLINK, no_reflink)
+    src = _source(tmp_path)
+    stager = FileStager("auto")
+    for name in ["a", "b", "c"]:
+        stager.stage(src, tmp_path / name)
+
+    assert attempts == [tmp_path / "a"]
+    assert (tmp_path / "c").read_bytes() == src.read_bytes()
+
+
+def test_restaging_never_writes_through_a_hardlink(tmp_path: Path):
+    src = _source(tmp_path)
+    other = tmp_path / "other.txt"
+    other.write_text("other")
+    dest = tmp_path / "dest"
+
+    FileStager(STAGING_HARDLINK).stage(src, dest)
+    FileStager(STAGING_COPY).stage(other, dest)
+
+    assert dest.read_text() == "other"
+    assert src.read_bytes() == b"#!/bin/sh\n" * 1000
+
+
+def test_unsupported_explicit_strategy_fails(tmp_path: Path, monkeypatch):
+    def no_reflink(src_path, dest_path):
+        raise staging.StagingUnsupported("no reflinks")
+
+    monkeypatch.setitem(staging._METHODS, staging.STAGING_REFLINK, no_reflink)
+    src = _source(tmp_path)
+
+    with pytest.raises(RuntimeError, match="with reflink"):
+        FileStager(staging.STAGING_REFLINK).stage(src, tmp_path / "dest")
+    assert not (tmp_path / "dest").exists()
+
+    with pytest.raises(ValueError, match="Unknown staging strategy"):
+        FileStager("symlink")
+
+
+def _descriptor(root: Path, targets: list[str]) -> StableDescriptor:
+    sources = [root / f"in{i}" for i in range(len(targets))]
+    for source, target in zip(sources, targets):
+        source.write_text(target)
+    return files_descriptor(root, targets, sources)
+
+
+def test_context_stages_files_in_parallel(tmp_path: Path, caplog):
+    (tmp_path / "inputs").mkdir()
+    targets = [f"d{i % 7}/sub{i % 3}/f{i}.txt" for i in range(200)]
+    desc = _descriptor(tmp_path / "inputs", targets)
+    ctx = LocalContext.from_path(tmp_path / "ctx", workers=4)
+
+    with caplog.at_level(logging.INFO):
+        ctx.prepare_from_descriptor(desc)
+
+    for target in targets:
+        assert (ctx.src_path() / target).read_text() == target
+    assert "Staged 200 files" in caplog.text
+    assert "files/s" in caplog.text
+
+
+def test_context_rejects_files_used_as_directories(tmp_path: Path):
+    (tmp_path / "inputs").mkdir()
+    desc = _descriptor(tmp_path / "inputs", ["a", "a/b"])
+    ctx = LocalContext.from_path(tmp_path / "ctx")
+
+    with pytest.raises(ValueError, match="is a file but should be a directory"):
+        ctx.prepare_from_descriptor(desc)
@@ -0,0 +1,153 @@
+import io
+import os
+from pathlib import Path, PurePath
+import stat
+import subprocess
+import tarfile
+
+import pytest
+
+from rebuildr.build import _ContextPipe
+from rebuildr.cli import load_py_desc
+from rebuildr.context import LocalContext
+from rebuildr.fs import STREAM_BUILDERS_DIR, write_context_tar
+from rebuildr.stable_descriptor import StableGitRepoInput
+
+from tests.utils import resolve_current_dir, run_git
+
+current_dir = resolve_current_dir(__file__)
+
+
+def test_context_tar_holds_files_builders_and_externals(tmp_path: Path):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    run_git(repo, "init", "--quiet")
+    (repo / "lib.txt").write_text("lib")
+    run_git(repo, "add", ".")
+    run_git(repo, "commit", "--quiet", "-m", "initial")
+    commit = run_git(repo, "rev-parse", "HEAD")
+
+    desc = load_py_desc(current_dir / "basic" / "simple.rebuildr.py")
+    desc.inputs.external.append(
+        StableGitRepoInput(url=str(repo), commit=commit, target_path=PurePath("vendor"))
+    )
+    out = io.BytesIO()
+    write_context_tar(desc, out, dockerfile=PurePath("simple.Dockerfile"))
+
+    out.seek(0)
+    with tarfile.open(fileobj=out, mode="r:") as tar:
+        assert tar.getnames() == [
+            "test.txt",
+            "test_renamed.txt",
+            "vendor/lib.txt",
+            f"{STREAM_BUILDERS_DIR}/simple.Dockerfile",
+            f"{STREAM_BUILDERS_DIR}/simple.Dockerfile.dockerignore",
+        ]
+        assert tar.extractfile("vendor/lib.txt").read() == b"lib"
+        ignore = tar.extractfile(
+            f"{STREAM_BUILDERS_DIR}/simple.Dockerfile.dockerignore"
+        )
+        assert ignore.read() == f"/{STREAM_BUILDERS_DIR}\n".encode()
+        assert {(m.uid, m.gid, m.uname, m.gname) for m in tar} == {(0, 0, "", "")}
+
+
+def _tree(root: Path) -> dict[str, tuple]:
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = Path(dirpath) / name
+            st = path.lstat()
+            if stat.S_ISLNK(st.st_mode):
+                entry = ("link", os.readlink(path))
+            elif stat.S_ISDIR(st.st_mode):
+                entry = ("dir",)
+            else:
+                entry = (
+                    "file",
+                    path.read_bytes(),
+                    stat.S_IMODE(st.st_mode),
+                    int(st.st_mtime),
+                )
+            tree[path.relative_to(root).as_posix()] = entry
+    return tree
+
+
+def test_streamed_context_matches_the_staged_one(tmp_path: Path):
+    repo = tmp_path / "repo"
+    (repo / "bin").mkdir(parents=True)
+    run_git(repo, "init", "--quiet")
+    (repo / "lib.txt").write_text("lib")
+    (repo / "bin" / "run").write_text("#!/bin/sh\n")
+    (repo / "bin" / "run").chmod(0o755)
+    (repo / "link").symlink_to("lib.txt")
+    # applies to git archive, but not to the files of a staged external
+    (repo / ".gitattributes").write_text("lib.txt export-ignore\n")
+    run_git(repo, "add", ".")
+    run_git(repo, "commit", "--quiet", "-m", "initial")
+    commit = run_git(repo, "rev-parse", "HEAD")
+
+    desc = load_py_desc(current_dir / "basic" / "simple.rebuildr.py")
+    desc.inputs.external.append(
+        StableGitRepoInput(url=str(repo), commit=commit, target_path=PurePath("vendor"))
+    )
+    ctx = LocalContext(tmp_path / "staged")
+    ctx.prepare_from_descriptor(desc)
+
+    out = io.BytesIO()
+    write_context_tar(desc, out, dockerfile=PurePath("simple.Dockerfile"))
+    out.seek(0)
+    streamed = tmp_path / "streamed"
+    with tarfile.open(fileobj=out, mode="r:") as tar:
+        tar.extractall(streamed)
+    # the build does not see the builder files
+    assert (streamed / STREAM_BUILDERS_DIR / "simple.Dockerfile").exists()
+    tree = {
+        path: entry
+        for path, entry in _tree(streamed).items()
+        if path.split("/")[0] != STREAM_BUILDERS_DIR
+    }
+
+    assert tree == _tree(ctx.src_path())
+    assert "vendor/lib.txt" in tree and "vendor/.git" not in tree
+
+
+def test_stream_ignore_file_keeps_the_context_rules(tmp_path: Path):
+    (tmp_path / "Dockerfile").write_text("FROM scratch\n")
+    (tmp_path / ".dockerignore").write_text("*.log")
+    (tmp_path / "rebuildr.py").write_text(
+        "from rebuildr.descriptor import *\n"
+        "image = Descriptor(\n"
+        "    targets=[ImageTarget(dockerfile='Dockerfile', repository='test')],\n"
+        "    inputs=Inputs(files=[FileInput('.dockerignore')]),\n"
+        ")\n"
+    )
+    desc = load_py_desc(tmp_path / "rebuildr.py")
+
+    out = io.BytesIO()
+    write_context_tar(desc, out, dockerfile=PurePath("Dockerfile"))
+    out.seek(0)
+    with tarfile.open(fileobj=out, mode="r:") as tar:
+        ignore = tar.extractfile(f"{STREAM_BUILDERS_DIR}/Dockerfile.dockerignore")
+        assert ignore.read() == f"*.log\n/{STREAM_BUILDERS_DIR}\n".encode()
+        assert tar.extractfile(".dockerignore").read() == b"*.log"
+
+
+def test_context_pipe_feeds_the_builder(tmp_path: Path):
+    desc = load_py_desc(current_dir / "basic" / "simple.rebuildr.py")
+
+    with _ContextPipe(lambda out: write_context_tar(desc, out)) as stdin:
+        listing = subprocess.run(
+            ["tar", "-tf", "-"], stdin=stdin, check=True, capture_output=True, text=True
+        ).stdout.split()
+
+    assert "test.txt" in listing
+
+
+def test_context_pipe_reports_writer_errors():
+    def failing_writer(out):
+        out.write(b"partial")
+        raise RuntimeError("Failed to add input")
+
+    with pytest.raises(RuntimeError, match="Failed to add input"):
+        with _ContextPipe(failing_writer) as stdin:
+            subprocess.run(["cat"], stdin=stdin, capture_output=True)
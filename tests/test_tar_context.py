@@ -1,11 +1,17 @@
+import io
+import os
 from pathlib import Path
+import sys
 import tarfile
+import threading
+
+import pytest
 
 from rebuildr.cli import load_py_desc
-from rebuildr.fs import TarContext
+from rebuildr.fs import TarContext, write_tar
 from rebuildr.validators import target_path_is_not_root, target_path_is_set
 
-from tests.utils import resolve_current_dir
+from tests.utils import files_descriptor, resolve_current_dir
 
 
 def test_tar_context_includes_files_and_builders(tmp_path: Path):
@@ -14,11 +20,8 @@ def test_tar_context_includes_files_and_builders(tmp_path: Path):
     current_dir = resolve_current_dir(__file__)
     desc = load_py_desc(current_dir / "basic" / "simple.rebuildr.py")
 
-    tc = TarContext()
-    tc.prepare_from_descriptor(desc)
-
     output_tar = tmp_path / "ctx.tar"
-    tc.copy_to_file(output_tar)
+    write_tar(desc, str(output_tar))
 
     assert output_tar.exists()
 
@@ -33,6 +36,88 @@ def test_tar_context_includes_files_and_builders(tmp_path: Path):
     ]
 
 
+def test_tar_context_is_reproducible(tmp_path: Path):
+    targets = ["b/c/z.txt", "a.txt", "b/y.txt", "b-x.txt"]
+    archives = []
+    for i, clock in enumerate([1_000_000, 2_000_000]):
+        root = tmp_path / str(i)
+        for target in targets:
+            (root / target).parent.mkdir(parents=True, exist_ok=True)
+            (root / target).write_text(target)
+            os.utime(root / target, (clock, clock))
+        out = io.BytesIO()
+        with TarContext(out) as ctx:
+            ctx.prepare_from_descriptor(files_descriptor(root, targets))
+        archives.append(out.getvalue())
+
+    assert archives[0] == archives[1]
+    with tarfile.open(fileobj=io.BytesIO(archives[0]), mode="r:") as tar:
+        assert tar.getnames() == [
+            "a.txt",
+            "b",
+            "b/c",
+            "b/c/z.txt",
+            "b/y.txt",
+            "b-x.txt",
+        ]
+        assert {(m.mtime, m.uid, m.gid, m.uname, m.gname) for m in tar} == {
+            (0, 0, 0, "", "")
+        }
+        assert tar.extractfile("b/c/z.txt").read() == b"b/c/z.txt"
+
+
+def test_write_tar_streams_to_stdout(tmp_path: Path, monkeypatch):
+    (tmp_path / "a.txt").write_text("a")
+    out = io.BytesIO()
+    monkeypatch.setattr(sys, "stdout", io.TextIOWrapper(out))
+
+    write_tar(files_descriptor(tmp_path, ["a.txt"]), "-")
+
+    with tarfile.open(fileobj=io.BytesIO(out.getvalue()), mode="r:") as tar:
+        assert tar.extractfile("a.txt").read() == b"a"
+
+
+def test_write_tar_removes_partial_output(tmp_path: Path):
+    output_tar = tmp_path / "ctx.tar"
+    with pytest.raises(RuntimeError):
+        write_tar(files_descriptor(tmp_path, ["missing.txt"]), str(output_tar))
+
+    assert not output_tar.exists()
+    assert os.listdir(tmp_path) == []
+
+
+def test_write_tar_keeps_existing_output_on_failure(tmp_path: Path):
+    (tmp_path / "a.txt").write_text("a")
+    output_tar = tmp_path / "ctx.tar"
+    link = tmp_path / "link.tar"
+    link.symlink_to(output_tar)
+    write_tar(files_descriptor(tmp_path, ["a.txt"]), str(link))
+    previous = output_tar.read_bytes()
+
+    with pytest.raises(RuntimeError):
+        write_tar(files_descriptor(tmp_path, ["missing.txt"]), str(link))
+
+    assert link.is_symlink()
+    assert output_tar.read_bytes() == previous
+    assert sorted(os.listdir(tmp_path)) == ["a.txt", "ctx.tar", "link.tar"]
+
+
+def test_write_tar_writes_into_fifo(tmp_path: Path):
+    (tmp_path / "a.txt").write_text("a")
+    fifo = tmp_path / "ctx.fifo"
+    os.mkfifo(fifo)
+    received = []
+    reader = threading.Thread(target=lambda: received.append(fifo.read_bytes()))
+    reader.start()
+
+    write_tar(files_descriptor(tmp_path, ["a.txt"]), str(fifo))
+    reader.join()
+
+    with tarfile.open(fileobj=io.BytesIO(received[0]), mode="r:") as tar:
+        assert tar.extractfile("a.txt").read() == b"a"
+    assert fifo.exists()
+
+
 def test_validators_target_path_checks():
     # target_path_is_set should raise when path is empty or None
     for bad in ["", None]:
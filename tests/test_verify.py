@@ -0,0 +1,146 @@
+import io
+import os
+from pathlib import Path, PurePath
+import tarfile
+
+import pytest
+
+from rebuildr import staging as staging_module
+from rebuildr.context import LocalContext
+from rebuildr.fs import write_context_tar
+from rebuildr.stable_descriptor import (
+    CONTENT_ID_GIT,
+    CONTENT_ID_V2,
+    HashOptions,
+    StableDescriptor,
+    StableEnvironment,
+    StableFileInput,
+    StableInputs,
+)
+from rebuildr.staging import (
+    STAGING_COPY,
+    STAGING_COPY_FILE_RANGE,
+    STAGING_HARDLINK,
+    STAGING_REFLINK,
+    FileStager,
+)
+from rebuildr.verify import InputVerifier
+
+
+def _descriptor(root: Path, scheme: str) -> StableDescriptor:
+    for name in ["Dockerfile", "a.txt", "b.sh"]:
+        (root / name).write_text(name * 1000)
+    os.chmod(root / "b.sh", 0o755)
+    return StableDescriptor(
+        absolute_path=root,
+        inputs=StableInputs(
+            envs=[],
+            build_args=[],
+            files=[
+                StableFileInput(
+                    target_path=PurePath(name), absolute_src_path=root / name
+                )
+                for name in ["a.txt", "b.sh"]
+            ],
+            builders=[
+                StableFileInput(
+                    target_path=PurePath("Dockerfile"),
+                    absolute_src_path=root / "Dockerfile",
+                    ignore_target_path=True,
+                )
+            ],
+            hashing=HashOptions(scheme=scheme, digest_cache=False),
+        ),
+    )
+
+
+@pytest.mark.parametrize("scheme", ["v1", CONTENT_ID_V2, CONTENT_ID_GIT])
+@pytest.mark.parametrize("staging", ["auto", STAGING_COPY])
+def test_staging_verifies_inputs(tmp_path: Path, scheme: str, staging: str):
+    desc = _descriptor(tmp_path, scheme)
+    content_id = desc.content_id(StableEnvironment({}, {}))
+
+    ctx = LocalContext(tmp_path / "ctx", staging=staging, read_only=True)
+    ctx.prepare_from_descriptor(desc, content_id)
+    assert (ctx.src_path() / "b.sh").read_bytes() == (tmp_path / "b.sh").read_bytes()
+    assert os.access(ctx.src_path() / "b.sh", os.X_OK)
+
+    (tmp_path / "a.txt").write_text("A" * 3000)
+    with pytest.raises(RuntimeError, match="a.txt changed since content id"):
+        LocalContext(
+            tmp_path / "other", staging=staging, read_only=True
+        ).prepare_from_descriptor(desc, content_id)
+
+
+def test_verified_read_only_contexts_are_copied(tmp_path: Path, monkeypatch):
+    def no_reflink(src, src_path, dest_path, check):
+        raise staging_module.StagingUnsupported("no reflinks")
+
+    monkeypatch.setitem(staging_module._CHECKED_METHODS, STAGING_REFLINK, no_reflink)
+    desc = _descriptor(tmp_path, "v1")
+    content_id = desc.content_id(StableEnvironment({}, {}))
+
+    ctx = LocalContext(tmp_path / "ctx", read_only=True)
+    ctx.prepare_from_descriptor(desc, content_id)
+
+    # writing to an input later does not change what was verified
+    assert not os.path.samefile(ctx.src_path() / "a.txt", tmp_path / "a.txt")
+    assert not os.path.samefile(ctx.root_dir / "Dockerfile", tmp_path / "Dockerfile")
+
+
+@pytest.mark.parametrize("staging", [STAGING_COPY_FILE_RANGE, STAGING_HARDLINK])
+def test_unverifiable_strategies_fail(tmp_path: Path, staging: str):
+    desc = _descriptor(tmp_path, "v1")
+    content_id = desc.content_id(StableEnvironment({}, {}))
+    src = tmp_path / "a.txt"
+    check = InputVerifier(content_id).check(src, PurePath("a.txt"), builder=False)
+
+    with pytest.raises(RuntimeError, match=f"{staging} cannot verify inputs"):
+        FileStager(staging, read_only=True).stage(src, tmp_path / "staged.txt", check)
+    assert not (tmp_path / "staged.txt").exists()
+
+
+def test_streamed_context_verifies_inputs(tmp_path: Path):
+    desc = _descriptor(tmp_path, "v1")
+    content_id = desc.content_id(StableEnvironment({}, {}))
+
+    out = io.BytesIO()
+    write_context_tar(desc, out, content_id)
+    out.seek(0)
+    with tarfile.open(fileobj=out, mode="r:") as tar:
+        assert tar.extractfile("a.txt").read() == (tmp_path / "a.txt").read_bytes()
+
+    (tmp_path / "Dockerfile").write_text("FROM scratch")
+    with pytest.raises(RuntimeError, match="Dockerfile changed since content id"):
+        write_context_tar(desc, io.BytesIO(), content_id)
+
+
+def test_modification_while_staging_fails(tmp_path: Path):
+    desc = _descriptor(tmp_path, "v1")
+    content_id = desc.content_id(StableEnvironment({}, {}))
+    src = tmp_path / "a.txt"
+    check = InputVerifier(content_id).check(src, PurePath("a.txt"), builder=False)
+
+    update = check.update
+
+    def touching_update(chunk):
+        update(chunk)
+        os.utime(src, (1_000_000_000, 1_000_000_000))
+
+    check.update = touching_update
+    with pytest.raises(RuntimeError, match="was modified while it was read"):
+        FileStager(STAGING_COPY).stage(src, tmp_path / "staged.txt", check)
+
+
+def test_git_ids_are_verified_by_digest(tmp_path: Path):
+    desc = _descriptor(tmp_path, CONTENT_ID_GIT)
+    content_id = desc.content_id(StableEnvironment({}, {}))
+    src = tmp_path / "a.txt"
+    st = src.stat()
+
+    # same size and modification time, other bytes
+    src.write_text("b" * st.st_size)
+    os.utime(src, ns=(st.st_atime_ns, st.st_mtime_ns))
+    check = InputVerifier(content_id).check(src, PurePath("a.txt"), builder=False)
+    with pytest.raises(RuntimeError, match="a.txt changed since content id"):
+        FileStager(STAGING_COPY).stage(src, tmp_path / "staged.txt", check)
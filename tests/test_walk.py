@@ -0,0 +1,203 @@
+import glob
+import os
+from pathlib import Path, PurePath
+
+import pytest
+
+from rebuildr.descriptor import Descriptor, FileInput, GlobInput, ImageTarget, Inputs
+from rebuildr.stable_descriptor import StableDescriptor, StableEnvironment
+from rebuildr.walk import DirectoryWalker
+
+PATTERNS = [
+    "**",
+    "**/*",
+    "**/*.py",
+    "**/.*",
+    ".*",
+    "*",
+    "*/",
+    "src",
+    "src/",
+    "src/**",
+    "src/**/",
+    "src/**/*.py",
+    "./src/*.py",
+    "src/[ab]*.py",
+    "src/*/*.json",
+    "src/pkg/../a.py",
+    "*/**/*.json",
+    "linked/**/*.json",
+    "missing/**/*.py",
+    "missing.txt",
+    "README.md",
+]
+
+
+def _make_tree(root: Path):
+    (root / "src" / "pkg" / "deep").mkdir(parents=True)
+    (root / "src" / ".hidden").mkdir()
+    (root / "docs").mkdir()
+    for path in [
+        "README.md",
+        ".env",
+        "src/a.py",
+        "src/b.py",
+        "src/c.txt",
+        "src/.secret.py",
+        "src/pkg/config.json",
+        "src/pkg/deep/x.py",
+        "src/.hidden/y.py",
+        "docs/index.md",
+    ]:
+        (root / path).write_text(path)
+    os.symlink("src/pkg", root / "linked")
+    os.symlink("a.py", root / "src" / "alias.py")
+
+
+@pytest.mark.parametrize("pattern", PATTERNS)
+def test_glob_matches_stdlib(tmp_path: Path, pattern: str):
+    _make_tree(tmp_path)
+    walker = DirectoryWalker()
+    assert walker.glob(pattern, tmp_path) == glob.glob(
+        pattern, root_dir=tmp_path, recursive=True
+    )
+
+
+def test_each_directory_is_listed_once(tmp_path: Path, monkeypatch):
+    _make_tree(tmp_path)
+    listed = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        listed.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", counting_scandir)
+    walker = DirectoryWalker()
+    for pattern in PATTERNS:
+        walker.glob(pattern, tmp_path)
+
+    assert len(listed) == len(set(listed))
+
+
+def test_broken_symlink_is_reported(tmp_path: Path):
+    _make_tree(tmp_path)
+    os.symlink("nowhere.py", tmp_path / "src" / "broken.py")
+    with pytest.raises(ValueError, match="broken.py does not exist"):
+        StableDescriptor._make_stable_files([GlobInput(pattern="src/*.py")], tmp_path)
+
+
+def test_directory_inputs(tmp_path: Path):
+    _make_tree(tmp_path)
+    files = StableDescriptor._make_stable_files(
+        ["src/", FileInput(path="docs", target_path="/site")], tmp_path
+    )
+
+    assert [str(f.target_path) for f in files] == [
+        "site/index.md",
+        "src/.hidden/y.py",
+        "src/.secret.py",
+        "src/a.py",
+        "src/alias.py",
+        "src/b.py",
+        "src/c.txt",
+        "src/pkg/config.json",
+        "src/pkg/deep/x.py",
+    ]
+    assert files[1].absolute_src_path == tmp_path / "src" / ".hidden" / "y.py"
+
+
+def test_descriptor_expansion_is_unchanged(tmp_path: Path):
+    _make_tree(tmp_path)
+    desc = StableDescriptor.from_descriptor(
+        Descriptor(
+            inputs=Inputs(
+                files=[
+                    GlobInput(pattern="src/**/*.py"),
+                    GlobInput(pattern="**/*.json", target_path="config"),
+                    GlobInput(pattern="*.md", root_dir="docs"),
+                ]
+            )
+        ),
+        tmp_path,
+    )
+
+    expected = []
+    for pattern, root, prefix in [
+        ("src/**/*.py", tmp_path, PurePath(".")),
+        ("**/*.json", tmp_path, PurePath("config")),
+        ("*.md", tmp_path / "docs", PurePath(".")),
+    ]:
+        for path in glob.glob(pattern, root_dir=root, recursive=True):
+            if (root / path).is_file():
+                expected.append((prefix / path, root / path))
+    assert sorted(expected) == sorted(
+        (f.target_path, f.absolute_src_path) for f in desc.inputs.files
+    )
+
+
+def test_excluded_directories_are_not_walked(tmp_path: Path, monkeypatch):
+    _make_tree(tmp_path)
+    listed = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        listed.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", counting_scandir)
+    desc = StableDescriptor.from_descriptor(
+        Descriptor(
+            inputs=Inputs(
+                files=[GlobInput(pattern="**", exclude=["pkg"], root_dir="src")],
+                exclude=["docs", "**/*.txt"],
+            )
+        ),
+        tmp_path,
+    )
+
+    assert sorted(str(f.target_path) for f in desc.inputs.files) == [
+        "a.py",
+        "alias.py",
+        "b.py",
+    ]
+    assert os.fspath(tmp_path / "src" / "pkg") not in listed
+    assert os.fspath(tmp_path / "docs") not in listed
+
+
+def test_negated_exclude_keeps_files(tmp_path: Path):
+    _make_tree(tmp_path)
+    files = StableDescriptor._make_stable_files(
+        [GlobInput(pattern="src/**/*.py", exclude=["src/pkg", "!src/pkg/deep"])],
+        tmp_path,
+    )
+
+    assert [str(f.target_path) for f in files] == [
+        "src/a.py",
+        "src/alias.py",
+        "src/b.py",
+        "src/pkg/deep/x.py",
+    ]
+
+
+def test_excludes_change_content_id(tmp_path: Path):
+    _make_tree(tmp_path)
+    (tmp_path / "Dockerfile").write_text("FROM scratch")
+    env = StableEnvironment.from_os_env()
+
+    def content_id(**kwargs):
+        desc = StableDescriptor.from_descriptor(
+            Descriptor(
+                inputs=Inputs(files=["src/"], **kwargs),
+                targets=[ImageTarget(repository="test")],
+            ),
+            tmp_path,
+        )
+        return desc.inputs.sha_sum(env)
+
+    plain = content_id()
+    assert content_id(exclude=["src/never"]) != plain
+    assert content_id(dockerignore=True) == plain
+
+    (tmp_path / ".dockerignore").write_text("# comment\nsrc/never\n")
+    assert content_id(dockerignore=True) == content_id(exclude=["src/never"])
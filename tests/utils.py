@@ -1,6 +1,56 @@
 import os
-from pathlib import Path
+from pathlib import Path, PurePath
+
+from rebuildr.stable_descriptor import StableDescriptor, StableFileInput, StableInputs
+from rebuildr.tools.git import git_command
 
 
 def resolve_current_dir(path: str) -> Path:
     return Path(os.path.dirname(os.path.abspath(path)))
+
+
+def files_descriptor(
+    root: Path, targets: list[str], sources: list[Path] | None = None
+) -> StableDescriptor:
+    """Describe a build whose only inputs are ``targets``, read from ``sources``.
+
+    Each target is read from the same relative path under ``root`` unless
+    ``sources`` names its source file explicitly.
+    """
+    if sources is None:
+        sources = [root / target for target in targets]
+    return StableDescriptor(
+        absolute_path=root,
+        inputs=StableInputs(
+            envs=[],
+            build_args=[],
+            files=[
+                StableFileInput(target_path=PurePath(target), absolute_src_path=source)
+                for target, source in zip(targets, sources)
+            ],
+            builders=[],
+        ),
+    )
+
+
+def run_git(repo: Path, *args: str) -> str:
+    """Run git in ``repo`` with a test identity and return its stripped stdout."""
+    return git_command(
+        ["-c", "user.name=Test", "-c", "user.email=test@example.com", *args],
+        cwd=str(repo),
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+
+
+def count_hashed_files(monkeypatch) -> list:
+    """Record the target path of every input file hashed from now on."""
+    calls = []
+    original = StableFileInput.hash_update
+
+    def counting_hash_update(self, hasher, *args):
+        calls.append(self.target_path)
+        return original(self, hasher, *args)
+
+    monkeypatch.setattr(StableFileInput, "hash_update", counting_hash_update)
+    return calls